@@ -1,38 +1,1502 @@
+import time
+_import_started = time.perf_counter()  # Start of the startup report, see startup_report()
 import sqlite3
-from flask import Flask, request, jsonify
-import openai
+from flask import Flask, Request, Response, request, jsonify, stream_with_context, has_request_context
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.utils import secure_filename
 import threading
-import time
+import atexit
+import queue
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 import os
+import sys
+import math
 import mimetypes
+import tempfile
+import io
+from contextlib import contextmanager
+import bisect
+import functools
 import csv
 import json
-import fitz  # PyMuPDF
-import requests  # Add this line
+import re
+import hashlib
+import hmac
+import socket
+import uuid
+import base64
+import importlib
+import zlib
+from collections import OrderedDict, deque, namedtuple
 import logging
-from google.cloud import language_v1  # Add this line
 
-DB_FILE = "database.sqlite"
+np = None  # numpy, optional and imported by load_numpy() for the semantic memory of past messages
+
+try:
+    import fcntl  # File locks between worker processes (not on Windows, where only threads are locked)
+except ImportError:
+    fcntl = None
+
+# Startup cost per stage in seconds: module imports, create_app() steps, and the heavy
+# dependencies (openai, fitz, google.cloud.language_v1, tiktoken, numpy) imported on first use by lazy_import()
+startup_times = {"imports": time.perf_counter() - _import_started}
+
+@contextmanager
+def startup_stage(name):
+    """Record the duration of a startup stage in startup_times."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_times[name] = time.perf_counter() - start
+
+def lazy_import(name):
+    """Import a heavy module on first use, so only the endpoints that need it pay for it."""
+    module = sys.modules.get(name)
+    if module is None:
+        with startup_stage(f"import {name}"):
+            module = importlib.import_module(name)
+    return module
+
+DB_FILE = os.getenv("DB_FILE", "database.sqlite")
 app = Flask(__name__)
 
+# Serving: the development server (python app.py) or a WSGI server loading wsgi:application
+APP_WARMUP = os.getenv("APP_WARMUP", "off")  # Load lazy dependencies at startup: "off", "background" or "blocking"
+APP_HOST = os.getenv("APP_HOST", "127.0.0.1")
+APP_PORT = int(os.getenv("APP_PORT", "5000"))
+APP_DEBUG = os.getenv("APP_DEBUG", "0") == "1"
+RUN_SCHEDULER = os.getenv("RUN_SCHEDULER", "1") == "1"  # Compete to be the one process running summaries
+SCHEDULER_LEASE_SECONDS = float(os.getenv("SCHEDULER_LEASE_SECONDS", "30"))  # A dead leader is replaced after this
+
+# SQLite tuning for the per-thread connection pool
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))  # Page cache per connection
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(128 * 1024 * 1024)))  # Bytes memory-mapped
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))  # Prepared statements kept per connection
+
+# Optional write-behind mode: messages and entities are committed in groups by a background thread
+DB_WRITE_BEHIND = os.getenv("DB_WRITE_BEHIND", "0") == "1"
+WRITE_QUEUE_SIZE = int(os.getenv("WRITE_QUEUE_SIZE", "10000"))
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "500"))
+WRITE_FLUSH_INTERVAL = float(os.getenv("WRITE_FLUSH_INTERVAL", "0.05"))  # Seconds
+WRITE_PUT_TIMEOUT = float(os.getenv("WRITE_PUT_TIMEOUT", "5"))  # Max seconds a request waits on a full queue
+
+# In-process cache of the per-user prompt context (profile, top entities, recent messages)
+CONTEXT_CACHE_USERS = int(os.getenv("CONTEXT_CACHE_USERS", "2000"))
+CONTEXT_CACHE_MAX_BYTES = int(os.getenv("CONTEXT_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+CONTEXT_CACHE_TTL = float(os.getenv("CONTEXT_CACHE_TTL", "600"))  # Seconds
+# Check cached contexts against context_versions, so writes of other worker processes are seen
+CONTEXT_CACHE_VALIDATE = os.getenv("CONTEXT_CACHE_VALIDATE", "1") == "1"
+CONTEXT_HISTORY_SIZE = 10
+CONTEXT_TOP_ENTITIES = 5
+
+# Semantic memory: local embeddings of each user's messages and summaries, searched for the prompt
+MEMORY_ENABLED = os.getenv("MEMORY_ENABLED", "1") == "1"  # Also needs numpy
+MEMORY_DIR = os.getenv("MEMORY_DIR", "")  # Defaults to <database file>-memory
+MEMORY_DIM = int(os.getenv("MEMORY_DIM", "256"))  # Size of the built-in hashing embeddings
+MEMORY_EMBEDDER = os.getenv("MEMORY_EMBEDDER", "")  # "module:function" mapping a list of texts to an (n, dim) array
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", "3"))
+MEMORY_MIN_SCORE = float(os.getenv("MEMORY_MIN_SCORE", "0.2"))  # Cosine similarity below this is not relevant
+MEMORY_OPEN_USERS = int(os.getenv("MEMORY_OPEN_USERS", "256"))  # Per-user indexes kept open
+
+# Token budget of the Rustybot system prompt
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "800"))
+PROMPT_MAX_TURN_TOKENS = int(os.getenv("PROMPT_MAX_TURN_TOKENS", "150"))  # Longer messages are clipped
+PROMPT_MAX_SUMMARY_TOKENS = int(os.getenv("PROMPT_MAX_SUMMARY_TOKENS", "300"))
+
+# Background summaries: only users with new messages (tracked in dirty_users) are visited
+SUMMARY_INTERVAL_SECONDS = float(os.getenv("SUMMARY_INTERVAL_SECONDS", "3600"))
+SUMMARY_MIN_MESSAGES = int(os.getenv("SUMMARY_MIN_MESSAGES", "10"))  # New messages needed for a summary
+SUMMARY_COOLDOWN_HOURS = float(os.getenv("SUMMARY_COOLDOWN_HOURS", "24"))
+SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", "4"))
+SUMMARY_RATE_PER_MINUTE = float(os.getenv("SUMMARY_RATE_PER_MINUTE", "30"))  # Global limit of summary calls, 0 = off
+SUMMARY_BATCH = int(os.getenv("SUMMARY_BATCH", "500"))  # Max users per pass
+SUMMARY_INCREMENTAL = os.getenv("SUMMARY_INCREMENTAL", "1") == "1"  # Only summarise messages since the last summary
+
+# Uploads are streamed straight into uniquely named spool files while the request is parsed
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", tempfile.gettempdir())
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(200 * 1024 * 1024)))
+NLP_MAX_CHARS = 1000000  # Google NLP rejects bigger documents
+
+# Full-text search (/search): source -> (table, text column), each indexed by an FTS5 table "<table>_fts"
+SEARCH_SOURCES = {
+    "messages": ("user_messages", "content"),
+    "conversations": ("conversations", "thread"),
+    "summaries": ("user_summaries", "summary"),
+}
+SEARCH_MAX_LIMIT = int(os.getenv("SEARCH_MAX_LIMIT", "100"))
+SEARCH_TOKEN = os.getenv("SEARCH_TOKEN")  # Moderators send "Authorization: Bearer <token>", /search is off without one
+
+# Full-document PDF extraction is split in page ranges across a process pool
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(os.cpu_count() or 2)))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "16"))
+
+# Results of file analyzers cached by content hash; bump a version when its analyzer changes
+ANALYSIS_CACHE_MAX_BYTES = int(os.getenv("ANALYSIS_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+ANALYSIS_CACHE_MAX_AGE_DAYS = float(os.getenv("ANALYSIS_CACHE_MAX_AGE_DAYS", "30"))
+# Background jobs for file processing: workers per job kind, retries with exponential backoff
+UPLOAD_ASYNC_DEFAULT = os.getenv("UPLOAD_ASYNC_DEFAULT", "0") == "1"  # /upload_file answers with a job id
+JOB_WORKERS = os.getenv("JOB_WORKERS", "upload=2,process_file=2")
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", "5"))  # Seconds, doubled on each retry
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "600"))  # Renewed while a job runs, retried once it expires
+JOB_MAX_PRIORITY = int(os.getenv("JOB_MAX_PRIORITY", "10"))  # Bound of the priority a client can ask for
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1"))
+
+ANALYZER_VERSIONS = {
+    "upload_decision": 1,
+    "google_entities": 1,
+    "process_file": 1,
+    "summary": 1,
+}
+
 # Configure OpenAI with environment variable (safer)
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if not OPENAI_API_KEY:
     raise ValueError("🚨 ERROR: The 'OPENAI_API_KEY' environment variable is not set.")
-client = openai.OpenAI(api_key=OPENAI_API_KEY)
 
 GOOGLE_APPLICATION_CREDENTIALS = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+GOOGLE_NLP_ENDPOINT = os.getenv("GOOGLE_NLP_ENDPOINT")  # e.g. http://127.0.0.1:8090, a local stand-in over REST
+
+# Profile updates from chat messages: keywords found in the detected entities set a profile category
+PROFILE_UPDATES = os.getenv("PROFILE_UPDATES", "1") == "1"  # Done in ask_rust's background entity analysis
+PROFILE_KEYWORDS_FILE = os.getenv("PROFILE_KEYWORDS_FILE", "")  # JSON {"keyword": "category"}, replaces the defaults
+PROFILE_MIN_MAGNITUDE = float(os.getenv("PROFILE_MIN_MAGNITUDE", "0.6"))  # Calmer messages don't change the profile
+
+# Typical phrases indicating liking or preference
+PROFILE_KEYWORDS = {
+    "construction": "interest",
+    "raiding": "interest",
+    "defense": "interest",
+    "playing solo": "style",
+    "team": "style",
+    "bothers me": "tone",
+    "hate": "tone"
+}
+
+# Cache of Google NLP results, keyed by a hash of the normalized text
+NLP_CACHE_SIZE = int(os.getenv("NLP_CACHE_SIZE", "5000"))
+NLP_CACHE_TTL = float(os.getenv("NLP_CACHE_TTL", "86400"))  # Seconds
+NLP_CACHE_PERSIST = os.getenv("NLP_CACHE_PERSIST", "0") == "1"  # Also keep results in SQLite
+NLP_CACHE_MAX_ROWS = int(os.getenv("NLP_CACHE_MAX_ROWS", "200000"))  # Rows kept in SQLite, oldest dropped first
+
+# ask_rust runs entity analysis in the background pool, next to the OpenAI call
+ASK_RUST_CONCURRENT = os.getenv("ASK_RUST_CONCURRENT", "1") == "1"
+BACKGROUND_WORKERS = int(os.getenv("BACKGROUND_WORKERS", "8"))
+NLP_DEADLINE_SECONDS = float(os.getenv("NLP_DEADLINE_SECONDS", "3"))  # Max time for one Google NLP call
+LLM_DEADLINE_SECONDS = float(os.getenv("LLM_DEADLINE_SECONDS", "60"))  # Max time for one gpt-4o call
+
+# Latency buckets (seconds) of the /metrics histograms
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Admission control of OpenAI calls: excess requests get a fast 429 with Retry-After (a rate of 0 disables a limit)
+OPENAI_USER_RATE_PER_MINUTE = float(os.getenv("OPENAI_USER_RATE_PER_MINUTE", "20"))
+OPENAI_USER_BURST = int(os.getenv("OPENAI_USER_BURST", "5"))
+OPENAI_GLOBAL_RATE_PER_SECOND = float(os.getenv("OPENAI_GLOBAL_RATE_PER_SECOND", "10"))
+OPENAI_GLOBAL_BURST = int(os.getenv("OPENAI_GLOBAL_BURST", "20"))
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "2"))  # Max seconds a request queues for a global token
+ADMISSION_MAX_WAITERS = int(os.getenv("ADMISSION_MAX_WAITERS", "64"))  # Requests allowed to queue at once
+OPENAI_COALESCE = os.getenv("OPENAI_COALESCE", "1") == "1"  # Identical concurrent requests share one upstream call
+
+# Cache of /ask_general answers and /generate_image URLs: an in-memory LRU in front of SQLite
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))  # Responses kept in memory
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # SQLite tier
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "86400"))  # Seconds, for answers
+RESPONSE_CACHE_IMAGE_TTL = float(os.getenv("RESPONSE_CACHE_IMAGE_TTL", "3000"))  # DALL-E URLs expire after an hour
+
+# /ask_rust/batch: messages per request, and users answered in parallel across all batches
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "50"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+
+# Shared pool for work that must not block the request thread
+background = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="background")
+batch_pool = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix="batch")
 
 logging.basicConfig(level=logging.INFO)
 
+def _metric_labels(labels):
+    """Format (name, value) pairs as a Prometheus label set."""
+    if not labels:
+        return ""
+    parts = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+class Metrics:
+    """Counters and latency histograms per endpoint and stage, rendered in Prometheus text format.
+
+    Recording is a dict lookup and a few additions under a lock, cheap enough for the hot path.
+    """
+
+    TYPES = {
+        "app_request_seconds": ("histogram", "HTTP request latency until the response is returned (first byte for streams)"),
+        "app_stage_seconds": ("histogram", "Latency of one stage of a request or background task"),
+        "app_stage_errors_total": ("counter", "Stages that raised an exception"),
+        "app_llm_tokens_total": ("counter", "OpenAI tokens used, by kind (prompt or completion)"),
+        "app_llm_time_to_first_token_seconds": ("histogram", "Time until the first token of a streamed completion"),
+    }
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._histograms = {}  # (name, labels) -> [count per bucket..., count above the last, sum, count]
+        self._counters = {}  # (name, labels) -> value
+        self._collectors = {}  # prefix -> function returning a dict of stats
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def endpoint(self):
+        """What the current work is done for: the active scope, the Flask endpoint or 'background'."""
+        scope = getattr(self._local, "scope", None)
+        if scope is not None:
+            return scope
+        if has_request_context():
+            return request.endpoint or "unknown"
+        return "background"
+
+    @contextmanager
+    def scope(self, endpoint):
+        """Attribute the stages timed inside (e.g. in a worker thread) to an endpoint."""
+        previous = getattr(self._local, "scope", None)
+        self._local.scope = endpoint
+        try:
+            yield
+        finally:
+            self._local.scope = previous
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            values = self._histograms.get(key)
+            if values is None:
+                values = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            values[index] += 1
+            values[-2] += seconds
+            values[-1] += 1
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, stage):
+        """Time a block as a stage of the current endpoint, counting the ones that raise."""
+        endpoint = self.endpoint()
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("app_stage_errors_total", stage=stage, endpoint=endpoint)
+            raise
+        finally:
+            self.observe("app_stage_seconds", time.perf_counter() - start, stage=stage, endpoint=endpoint)
+
+    def timed(self, stage):
+        """Decorator version of timer()."""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record_usage(self, usage, stage):
+        """Count the tokens of an OpenAI response's usage (None when the API didn't report it)."""
+        if usage is None:
+            return
+        endpoint = self.endpoint()
+        self.inc("app_llm_tokens_total", int(usage.prompt_tokens or 0), stage=stage, endpoint=endpoint, kind="prompt")
+        self.inc("app_llm_tokens_total", int(usage.completion_tokens or 0), stage=stage, endpoint=endpoint,
+                 kind="completion")
+
+    def add_collector(self, prefix, collect):
+        """Export the numbers of collect() (e.g. a stats() method) as gauges named <prefix>_<key>.
+
+        Adding a prefix again replaces its collector (e.g. the app of a second create_app() call).
+        """
+        with self._lock:
+            self._collectors[prefix] = collect
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            histograms = sorted((key, list(values)) for key, values in self._histograms.items())
+            counters = sorted(self._counters.items())
+            collectors = list(self._collectors.items())
+
+        lines = []
+        declared = set()
+
+        def declare(name, type="gauge", help=None):
+            if name not in declared:
+                declared.add(name)
+                type, help = self.TYPES.get(name, (type, help or name))
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {type}")
+
+        for (name, labels), values in histograms:
+            declare(name)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                lines.append(f"{name}_bucket{_metric_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_metric_labels(labels)} {values[-2]:.6f}")
+            lines.append(f"{name}_count{_metric_labels(labels)} {values[-1]}")
+        for (name, labels), value in counters:
+            declare(name)
+            lines.append(f"{name}{_metric_labels(labels)} {value}")
+
+        for prefix, collect in collectors:
+            try:
+                stats = collect()
+            except Exception as e:
+                logging.warning(f"⚠️ Error collecting {prefix} metrics: {e}")
+                continue
+            for key, value in stats.items():
+                if isinstance(value, bool):
+                    value = int(value)
+                if not isinstance(value, (int, float)):
+                    continue  # Nested or text values stay in the JSON stats endpoints
+                name = re.sub(r"[^a-zA-Z0-9_]", "_", f"app_{prefix}_{key}")
+                declare(name, "gauge", f"{prefix} {key}")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def _dedupe_user_profile(cursor):
+    """Keep only the newest row per (user_id, category) before making the pair unique."""
+    cursor.execute("""
+        DELETE FROM user_profile
+        WHERE id NOT IN (
+            SELECT MAX(id) FROM user_profile GROUP BY user_id, category
+        )
+    """)
+
+# Per-user entity aggregate: importance decays with this half-life.
+# Scores are stored "forward decayed" (scaled up relative to an epoch) so the
+# ranking never has to be recomputed and top-k reads come straight from an index.
+# The weights double every half-life, so the epoch kept in decay_epochs is moved
+# forward (and the stored scores scaled down) before they could overflow a float.
+ENTITY_HALF_LIFE_DAYS = float(os.getenv("ENTITY_HALF_LIFE_DAYS", "7"))
+ENTITY_DECAY_EPOCH = 1704067200  # 2024-01-01 UTC, first epoch
+ENTITY_REBASE_HALF_LIVES = 64  # Weights stay below about 2 ** 64
+
+def _decay_weight(unix_time, epoch=ENTITY_DECAY_EPOCH):
+    """Forward-decay weight of an event at unix_time (a stored score times the weight of 'now' ** -1)."""
+    return 2 ** ((unix_time - epoch) / (ENTITY_HALF_LIFE_DAYS * 86400))
+
+def _entity_decay_epoch(conn, now):
+    """Current epoch of entity_stats, re-based first if it is too old (call inside a write transaction)."""
+    epoch = conn.execute("SELECT epoch FROM decay_epochs WHERE name = 'entity_stats'").fetchone()[0]
+    if now - epoch > ENTITY_REBASE_HALF_LIVES * ENTITY_HALF_LIFE_DAYS * 86400:
+        # 2 ** -x underflows to 0 for scores too old to matter instead of raising
+        conn.execute("UPDATE entity_stats SET decayed_importance = decayed_importance * ?",
+                     (2 ** ((epoch - now) / (ENTITY_HALF_LIFE_DAYS * 86400)),))
+        conn.execute("UPDATE decay_epochs SET epoch = ? WHERE name = 'entity_stats'", (now,))
+        logging.info(f"🧮 Entity decay epoch moved to {time.strftime('%Y-%m-%d', time.gmtime(now))}")
+        epoch = now
+    return epoch
+
+ENTITY_STATS_UPSERT = """
+    INSERT INTO entity_stats (user_id, entity, type, mentions, max_importance, decayed_importance, last_seen)
+    VALUES (?, ?, ?, 1, ?, ?, ?)
+    ON CONFLICT (user_id, entity, type) DO UPDATE SET
+        mentions = mentions + 1,
+        max_importance = MAX(max_importance, excluded.max_importance),
+        decayed_importance = decayed_importance + excluded.decayed_importance,
+        last_seen = MAX(last_seen, excluded.last_seen)
+"""
+
+# Every write that changes a user's prompt context adds to their version, by one per ContextCache.on_*()
+# call, so a cached context is current only if its version matches the database
+CONTEXT_VERSION_BUMP = """
+    INSERT INTO context_versions (user_id, version) VALUES (?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET version = version + excluded.version
+"""
+
+def _backfill_entity_stats(cursor):
+    """Build entity_stats from the raw detected_entities rows (one-shot, streamed in chunks)."""
+    cursor.execute("DELETE FROM entity_stats")
+    rows = cursor.connection.execute("""
+        SELECT user_id, entity, type, importance, timestamp, CAST(strftime('%s', timestamp) AS INTEGER)
+        FROM detected_entities
+    """)
+    while True:
+        chunk = rows.fetchmany(5000)
+        if not chunk:
+            break
+        cursor.executemany(ENTITY_STATS_UPSERT, [
+            (user_id, entity, type, importance, importance * _decay_weight(seen), timestamp)
+            for user_id, entity, type, importance, timestamp, seen in chunk
+        ])
+
+def _add_summary_last_message_id(cursor):
+    """Remember up to which message each summary goes (ALTER TABLE has no IF NOT EXISTS)."""
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(user_summaries)")]
+    if "last_message_id" not in columns:
+        cursor.execute("ALTER TABLE user_summaries ADD COLUMN last_message_id INTEGER")
+
+def _add_job_leases(cursor):
+    """Lease columns of running jobs, renewed by the worker (see JobQueue._heartbeat)."""
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(jobs)")]
+    if "lease_owner" not in columns:
+        cursor.execute("ALTER TABLE jobs ADD COLUMN lease_owner TEXT")
+    if "lease_expires" not in columns:
+        cursor.execute("ALTER TABLE jobs ADD COLUMN lease_expires REAL")
+    # Jobs already running keep the time they had under the old rule
+    cursor.execute("UPDATE jobs SET lease_expires = updated_at + ? WHERE status = 'running' AND lease_expires IS NULL",
+                   (JOB_LEASE_SECONDS,))
+
+def _fts_steps(table, column):
+    """SQL of an external-content FTS5 index on table(column, user_id), its sync triggers and backfill."""
+    fts = f"{table}_fts"
+    return [
+        f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+            {column}, user_id, content='{table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{fts}_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts} (rowid, {column}, user_id) VALUES (NEW.id, NEW.{column}, NEW.user_id);
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{fts}_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {column}, user_id) VALUES ('delete', OLD.id, OLD.{column}, OLD.user_id);
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{fts}_update AFTER UPDATE OF {column}, user_id ON {table} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {column}, user_id) VALUES ('delete', OLD.id, OLD.{column}, OLD.user_id);
+            INSERT INTO {fts} (rowid, {column}, user_id) VALUES (NEW.id, NEW.{column}, NEW.user_id);
+        END
+        """,
+        f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')",  # Index the existing rows
+        f"INSERT INTO {fts} ({fts}, rank) VALUES ('rank', 'bm25(1.0, 0.0)')",  # Rank on the text only
+    ]
+
+def fts_query(text, column, user_id=None):
+    """Turn free text into a safe FTS5 query: every word must match the text column, word* matches a prefix."""
+    terms = [f'"{word}"{star}' for word, star in re.findall(r"([^\W_]+)(\*?)", text)]
+    if not terms:
+        raise ValueError("The search needs at least one word.")
+    query = f"{column} : ({' AND '.join(terms)})"
+    user_tokens = re.findall(r"[^\W_]+", user_id or "")
+    if user_tokens:
+        # Narrows the match to the user's rows inside the index, the exact user_id is checked in SQL
+        query += f' AND user_id : ^"{" ".join(user_tokens)}"'
+    return query
+
+# Ordered schema migrations: (version, description, steps).
+# A step is an SQL statement or a callable receiving a cursor. Steps must be idempotent.
+MIGRATIONS = [
+    (1, "hot-path indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_user_messages_user_ts ON user_messages (user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user_ts ON conversations (user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_user_summaries_user_ts ON user_summaries (user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_important_messages_user_ts ON important_messages (user_id, timestamp)",
+        # Covers get_detected_entities completely, no table lookup needed
+        "CREATE INDEX IF NOT EXISTS idx_detected_entities_user_importance "
+        "ON detected_entities (user_id, importance DESC, entity, type)",
+    ]),
+    (2, "unique user_profile (user_id, category)", [
+        _dedupe_user_profile,
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_user_profile_user_category ON user_profile (user_id, category)",
+    ]),
+    (3, "per-user entity aggregate", [
+        """
+        CREATE TABLE IF NOT EXISTS entity_stats (
+            user_id TEXT NOT NULL,
+            entity TEXT NOT NULL,
+            type TEXT NOT NULL,
+            mentions INTEGER NOT NULL,
+            max_importance REAL NOT NULL,
+            decayed_importance REAL NOT NULL,  -- Forward-decayed sum, see _decay_weight()
+            last_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, entity, type)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_entity_stats_user_score ON entity_stats (user_id, decayed_importance DESC)",
+        _backfill_entity_stats,
+    ]),
+    (4, "persistent NLP cache", [
+        """
+        CREATE TABLE IF NOT EXISTS nlp_cache (
+            key TEXT PRIMARY KEY,  -- sha256 of the normalized text
+            result TEXT NOT NULL,  -- JSON with entities and sentiment
+            created_at REAL NOT NULL
+        )
+        """,
+    ]),
+    (5, "dirty user tracking for incremental summaries", [
+        _add_summary_last_message_id,
+        """
+        CREATE TABLE IF NOT EXISTS dirty_users (
+            user_id TEXT PRIMARY KEY,
+            new_messages INTEGER NOT NULL,  -- Messages not covered by a summary yet
+            last_message_id INTEGER NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_dirty_users_pending ON dirty_users (new_messages)",
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_user_messages_dirty AFTER INSERT ON user_messages
+        BEGIN
+            INSERT INTO dirty_users (user_id, new_messages, last_message_id)
+            VALUES (NEW.user_id, 1, NEW.id)
+            ON CONFLICT (user_id) DO UPDATE SET
+                new_messages = new_messages + 1,
+                last_message_id = NEW.id,
+                updated_at = CURRENT_TIMESTAMP;
+        END
+        """,
+        """
+        INSERT OR IGNORE INTO dirty_users (user_id, new_messages, last_message_id)
+        SELECT user_id, COUNT(*), MAX(id) FROM user_messages GROUP BY user_id
+        """,
+    ]),
+    (6, "per-page PDF text cache", [
+        """
+        CREATE TABLE IF NOT EXISTS pdf_pages (
+            file_hash TEXT NOT NULL,  -- sha256 of the PDF
+            page INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            PRIMARY KEY (file_hash, page)
+        ) WITHOUT ROWID
+        """,
+    ]),
+    (7, "content-addressed analysis cache", [
+        """
+        CREATE TABLE IF NOT EXISTS analysis_cache (
+            content_hash TEXT NOT NULL,  -- sha256 of the uploaded file
+            analyzer TEXT NOT NULL,  -- Analyzer name and variant, e.g. "process_file:pages=None"
+            version INTEGER NOT NULL,  -- See ANALYZER_VERSIONS
+            result TEXT NOT NULL,  -- JSON
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_used REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (content_hash, analyzer, version)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_analysis_cache_last_used ON analysis_cache (last_used)",
+        "CREATE INDEX IF NOT EXISTS idx_analysis_cache_created ON analysis_cache (created_at)",
+    ]),
+    (8, "background job queue", [
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,  -- Handler name, e.g. "upload" or "process_file"
+            user_id TEXT NOT NULL,
+            status TEXT CHECK(status IN ('queued', 'running', 'done', 'failed')) NOT NULL DEFAULT 'queued',
+            priority INTEGER NOT NULL DEFAULT 0,  -- Higher runs first
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL,
+            payload TEXT NOT NULL,  -- JSON
+            result TEXT,  -- JSON
+            error TEXT,
+            run_after REAL NOT NULL,  -- Unix time, used for retry backoff
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs (kind, status, priority DESC)",
+    ]),
+    (9, "full-text search", [step for table, column in SEARCH_SOURCES.values() for step in _fts_steps(table, column)]),
+    (10, "leases for leader election", [
+        """
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,  -- e.g. "scheduler"
+            owner TEXT NOT NULL,  -- host:pid:random of the holder
+            expires_at REAL NOT NULL  -- Unix time
+        ) WITHOUT ROWID
+        """,
+    ]),
+    (11, "OpenAI response cache", [
+        """
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,  -- request_key() of the upstream request
+            kind TEXT NOT NULL,  -- "chat" or "image"
+            response TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            last_used REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON response_cache (last_used)",
+        "CREATE INDEX IF NOT EXISTS idx_response_cache_expires ON response_cache (expires_at)",
+    ]),
+    (12, "prompt context versions", [
+        """
+        CREATE TABLE IF NOT EXISTS context_versions (
+            user_id TEXT PRIMARY KEY,
+            version INTEGER NOT NULL  -- See CONTEXT_VERSION_BUMP
+        ) WITHOUT ROWID
+        """,
+    ]),
+    (13, "NLP cache eviction", [
+        "CREATE INDEX IF NOT EXISTS idx_nlp_cache_created ON nlp_cache (created_at)",
+    ]),
+    (14, "per-user id order indexes", [
+        # Memory rebuilds read a user's rows in id order, summaries the ones after an id
+        "CREATE INDEX IF NOT EXISTS idx_user_messages_user_id ON user_messages (user_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_user_summaries_user_id ON user_summaries (user_id, id)",
+    ]),
+    (15, "movable entity decay epoch", [
+        """
+        CREATE TABLE IF NOT EXISTS decay_epochs (
+            name TEXT PRIMARY KEY,
+            epoch REAL NOT NULL  -- See _entity_decay_epoch()
+        ) WITHOUT ROWID
+        """,
+        f"INSERT OR IGNORE INTO decay_epochs (name, epoch) VALUES ('entity_stats', {ENTITY_DECAY_EPOCH})",
+    ]),
+    (16, "job leases", [
+        _add_job_leases,
+        "CREATE INDEX IF NOT EXISTS idx_jobs_lease ON jobs (lease_expires) WHERE status = 'running'",
+    ]),
+]
+
+# SQL of the hot queries, shared by the methods that run them and QUERY_PLAN_CHECKS
+CONVERSATION_THREAD_QUERY = "SELECT thread FROM conversations WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?"
+USER_HISTORY_QUERY = "SELECT type, content FROM user_messages WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?"
+IMPORTANT_MESSAGES_QUERY = "SELECT message FROM important_messages WHERE user_id = ? ORDER BY timestamp DESC"
+DETECTED_ENTITIES_QUERY = (
+    "SELECT entity, type, importance FROM detected_entities WHERE user_id = ? ORDER BY importance DESC")
+TOP_ENTITIES_QUERY = (
+    "SELECT entity, type, mentions, max_importance, decayed_importance, "
+    "(SELECT epoch FROM decay_epochs WHERE name = 'entity_stats') FROM entity_stats "
+    "WHERE user_id = ? ORDER BY decayed_importance DESC LIMIT ?")
+LATEST_SUMMARY_QUERY = "SELECT summary FROM user_summaries WHERE user_id = ? ORDER BY timestamp DESC LIMIT 1"
+PROFILE_QUERY = "SELECT category, content FROM user_profile WHERE user_id = ?"
+CONTEXT_VERSION_QUERY = "SELECT version FROM context_versions WHERE user_id = ?"
+MEMORY_MESSAGES_QUERY = "SELECT type, content FROM user_messages WHERE user_id = ? ORDER BY id"
+MEMORY_SUMMARIES_QUERY = "SELECT summary FROM user_summaries WHERE user_id = ? ORDER BY id"
+PDF_PAGES_QUERY = "SELECT page, text FROM pdf_pages WHERE file_hash = ? AND page >= ? AND page < ?"
+ANALYSIS_CACHE_QUERY = (
+    "SELECT result FROM analysis_cache "
+    "WHERE content_hash = ? AND analyzer = ? AND version = ? AND created_at >= ?")
+JOBS_CLAIM_QUERY = """
+    UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ?, lease_owner = ?, lease_expires = ?
+    WHERE id = (
+        SELECT id FROM jobs
+        WHERE kind = ? AND status = 'queued' AND run_after <= ?
+        ORDER BY priority DESC, id
+        LIMIT 1
+    )
+    RETURNING id, payload, attempts, max_attempts
+"""
+JOBS_REQUEUE_QUERY = """
+    UPDATE jobs SET status = 'queued', lease_owner = NULL, updated_at = ?
+    WHERE status = 'running' AND lease_expires < ?
+"""
+DIRTY_USERS_QUERY = "SELECT user_id FROM dirty_users WHERE new_messages >= ? ORDER BY new_messages DESC LIMIT ?"
+SUMMARY_STATE_QUERY = (
+    "SELECT summary, last_message_id, timestamp >= datetime('now', ?) FROM user_summaries "
+    "WHERE user_id = ? ORDER BY timestamp DESC LIMIT 1")
+MESSAGES_SINCE_QUERY = (  # Ids follow insertion order, like the default timestamps
+    "SELECT id, content FROM user_messages WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?")
+RECENT_MESSAGES_QUERY = (
+    "SELECT id, content FROM user_messages WHERE user_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?")
+REMAINING_MESSAGES_QUERY = "SELECT COUNT(*) FROM user_messages WHERE user_id = ? AND id > ?"
+
+def search_sql(source, by_user, order, paged):
+    """SQL of Database.search() for a source, with or without user filter and cursor."""
+    table, _ = SEARCH_SOURCES[source]
+    fts = f"{table}_fts"
+    where = [f"{fts} MATCH ?"]
+    if by_user:
+        where.append("t.user_id = ?")
+    if order == "rank":
+        if paged:
+            where.append("(f.rank > ? OR (f.rank = ? AND f.rowid > ?))")
+        order_by = "f.rank, f.rowid"
+    else:
+        if paged:
+            where.append("f.rowid < ?")
+        order_by = "f.rowid DESC"
+    return f"""
+        SELECT t.id, t.user_id, {"t.type" if source == "messages" else "NULL"}, t.timestamp,
+               snippet({fts}, 0, '**', '**', '…', 32), f.rank
+        FROM {fts} f JOIN {table} t ON t.id = f.rowid
+        WHERE {" AND ".join(where)}
+        ORDER BY {order_by}
+        LIMIT ?
+    """
+
+# Hot queries checked by Database.find_table_scans(): name -> (sql, sample params)
+QUERY_PLAN_CHECKS = {
+    "search.rank": (search_sql("messages", True, "rank", True), ('content : ("raid")', "u", -1.0, -1.0, 100, 21)),
+    "search.recent": (search_sql("messages", True, "recent", True), ('content : ("raid")', "u", 100, 21)),
+    "get_conversation_thread": (CONVERSATION_THREAD_QUERY, ("u", 30)),
+    "get_user_history": (USER_HISTORY_QUERY, ("u", 25)),
+    "get_important_messages": (IMPORTANT_MESSAGES_QUERY, ("u",)),
+    "get_detected_entities": (DETECTED_ENTITIES_QUERY, ("u",)),
+    "get_top_entities": (TOP_ENTITIES_QUERY, ("u", 5)),
+    "get_latest_summary": (LATEST_SUMMARY_QUERY, ("u",)),
+    "get_profile": (PROFILE_QUERY, ("u",)),
+    "get_context_version": (CONTEXT_VERSION_QUERY, ("u",)),
+    "memory.saved_messages": (MEMORY_MESSAGES_QUERY, ("u",)),
+    "memory.saved_summaries": (MEMORY_SUMMARIES_QUERY, ("u",)),
+    "get_pdf_pages": (PDF_PAGES_QUERY, ("h", 0, 16)),
+    "analysis_cache.get": (ANALYSIS_CACHE_QUERY, ("h", "a", 1, 0)),
+    "jobs.claim": (JOBS_CLAIM_QUERY, (0, "owner", 600, "upload", 0)),
+    "jobs.requeue_stale": (JOBS_REQUEUE_QUERY, (0, 0)),
+    "get_dirty_users": (DIRTY_USERS_QUERY, (10, 500)),
+    "get_summary_state": (SUMMARY_STATE_QUERY, ("-24 hours", "u")),
+    "get_messages_since": (MESSAGES_SINCE_QUERY, ("u", 0, 200)),
+    "get_recent_messages": (RECENT_MESSAGES_QUERY, ("u", 25)),
+    "save_summary.remaining": (REMAINING_MESSAGES_QUERY, ("u", 0)),
+}
+
+# Plan steps accepted by Database.check_query_plans(): name -> detail prefix.
+# bm25 is computed for the matching rows only, so ranking them needs a sort
+QUERY_PLAN_EXPECTED = {
+    "search.rank": "USE TEMP B-TREE FOR ORDER BY",
+}
+
+_encoding = None
+
+def count_tokens(text):
+    """Count tokens locally (tiktoken if installed, otherwise about 4 characters per token)."""
+    global _encoding
+    if _encoding is None:
+        try:
+            tiktoken = lazy_import("tiktoken")  # Optional: exact token counts, otherwise estimated
+            with startup_stage("load o200k_base"):  # May download the encoding
+                _encoding = tiktoken.get_encoding("o200k_base")  # gpt-4o tokenizer
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return (len(text) + 3) // 4
+
+def clip_to_tokens(text, max_tokens):
+    """Cut a text to about max_tokens tokens."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    if _encoding:
+        return _encoding.decode(_encoding.encode(text)[:max_tokens]) + "…"
+    return text[:max_tokens * 4] + "…"
+
+class PromptBuilder:
+    """Build the Rustybot system prompt within a token budget.
+
+    The profile and entities always go in. The latest summary stands in for older turns,
+    earlier messages relevant to the question get up to a quarter of what is left, and
+    recent turns are added newest first until the budget is used.
+    """
+
+    def __init__(self, budget=PROMPT_TOKEN_BUDGET, max_turn_tokens=PROMPT_MAX_TURN_TOKENS,
+                 max_summary_tokens=PROMPT_MAX_SUMMARY_TOKENS):
+        self.budget = budget
+        self.max_turn_tokens = max_turn_tokens
+        self.max_summary_tokens = max_summary_tokens
+
+    def build(self, user_id, context):
+        """Return (system_prompt, report) for a context from Database.get_prompt_context()."""
+        entities = context["entities"]
+        entities_text = ", ".join([e["name"] for e in entities]) if entities else "none"
+        profile = context["profile"]
+        role = profile.get("role", "player")
+        tone = profile.get("tone", "neutral")
+        interest = profile.get("interest", "Rust")
+
+        header = (
+            "Your name is Rustybot. You are the soul of the Chill_rust server.\n"
+            f"You are talking to {user_id}, whose role is '{role}' and is interested in '{interest}'.\n"
+            f"Speak with a '{tone}' tone and respond with gamer slang.\n"
+            f"Key entities: {entities_text}."
+        )
+        footer = "Here comes the question:"
+        turns = [f"{type}: {content}" for type, content in context["history"]]
+
+        def render(summary, memories, turns):
+            lines = [header]
+            if summary:
+                lines.append(f"Summary of earlier conversation: {summary.rstrip('.')}.")
+            if memories:
+                lines.append(f"Relevant earlier messages: {' / '.join(memories)}.")
+            lines.append(f"History: {' / '.join(turns)}.")
+            lines.append(footer)
+            return "\n".join(lines)
+
+        remaining = self.budget - count_tokens(header) - count_tokens(footer) - 10
+
+        summary = ""
+        if context.get("summary") and remaining > 0:
+            summary = clip_to_tokens(context["summary"], min(self.max_summary_tokens, remaining // 2))
+            remaining -= count_tokens(f"Summary of earlier conversation: {summary.rstrip('.')}.")
+
+        all_memories = [f"{memory['type']}: {memory['content']}" for memory in context.get("memories") or []]
+        memories = []
+        allowance = remaining // 4
+        for memory in all_memories:
+            text = clip_to_tokens(memory, self.max_turn_tokens)
+            cost = count_tokens(text) + 1
+            if cost > allowance:
+                break
+            memories.append(text)
+            allowance -= cost
+        if memories:
+            remaining -= count_tokens(f"Relevant earlier messages: {' / '.join(memories)}.")
+
+        kept = []
+        for turn in reversed(turns):  # Newest first
+            turn = clip_to_tokens(turn, self.max_turn_tokens)
+            cost = count_tokens(turn) + 1
+            if cost > remaining:
+                break
+            kept.append(turn)
+            remaining -= cost
+        kept.reverse()
+
+        prompt = render(summary, memories, kept)
+        prompt_tokens = count_tokens(prompt)
+        # Saved against the same prompt with every turn, the whole summary and all memories
+        unbounded = count_tokens(render(context.get("summary"), all_memories, turns))
+        report = {
+            "budget": self.budget,
+            "prompt_tokens": prompt_tokens,
+            "tokens_saved": max(0, unbounded - prompt_tokens),
+            "turns_used": len(kept),
+            "turns_dropped": len(turns) - len(kept),
+            "summary_used": bool(summary),
+            "memories_used": len(memories)
+        }
+        return prompt, report
+
+def _run_ops(conn, ops):
+    """Execute a list of (sql, params, many) on a connection.
+
+    params may be a function of the connection, called inside the transaction.
+    """
+    for sql, params, many in ops:
+        if callable(params):
+            params = params(conn)
+        if many:
+            conn.executemany(sql, params)
+        else:
+            conn.execute(sql, params)
+
+class WriteBehindWriter:
+    """Background thread that drains a bounded queue of writes and commits them in groups."""
+
+    def __init__(self, db, max_queue=WRITE_QUEUE_SIZE, batch_size=WRITE_BATCH_SIZE,
+                 flush_interval=WRITE_FLUSH_INTERVAL, put_timeout=WRITE_PUT_TIMEOUT):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._pending = {}  # user_id -> writes queued but not committed yet
+        self._pending_total = 0
+        self._cond = threading.Condition()
+        self._stats = {"submitted": 0, "committed": 0, "failed": 0, "batches": 0}
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def submit(self, user_id, ops):
+        """Queue a write (a list of (sql, params, many) run together).
+
+        Blocks while the queue is full (backpressure), raises queue.Full on timeout.
+        """
+        with self._cond:
+            self._pending[user_id] = self._pending.get(user_id, 0) + 1
+            self._pending_total += 1
+            self._stats["submitted"] += 1
+        try:
+            self._queue.put((user_id, ops), timeout=self.put_timeout)
+        except queue.Full:
+            self._done([user_id])
+            raise
+
+    def wait_for_user(self, user_id, timeout=None):
+        """Block until every queued write of the user is committed (read-your-writes)."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending.get(user_id), timeout)
+
+    def flush(self, timeout=None):
+        """Block until the queue is empty and everything is committed."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending_total == 0, timeout)
+
+    def close(self):
+        """Flush pending writes and stop the writer thread (shutdown hook)."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def stats(self):
+        with self._cond:
+            return {**self._stats, "queued": self._pending_total}
+
+    def _done(self, user_ids, failed=0, batches=0):
+        with self._cond:
+            self._stats["batches"] += batches
+            for user_id in user_ids:
+                self._pending[user_id] -= 1
+                if not self._pending[user_id]:
+                    del self._pending[user_id]
+            self._pending_total -= len(user_ids)
+            self._stats["committed"] += len(user_ids) - failed
+            self._stats["failed"] += failed
+            self._cond.notify_all()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            # Group until the batch is full or the flush interval is over
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                self._commit(batch)
+            except Exception as e:
+                # Keep the thread alive and release the waiters, the writes are lost
+                logging.error(f"❌ Write-behind batch dropped: {e}")
+                self._done([item[0] for item in batch], failed=len(batch))
+
+    def _commit(self, batch):
+        conn = self.db.get_connection()
+        try:
+            conn.execute("BEGIN")
+            for _, ops in batch:
+                _run_ops(conn, ops)
+            conn.commit()
+            self._done([item[0] for item in batch], batches=1)
+            return
+        except Exception as e:  # Not only sqlite3.Error: a bad op or params function must not kill the thread
+            conn.rollback()
+            logging.warning(f"⚠️ Write-behind batch failed, retrying one by one: {e}")
+
+        # Retry one by one so a single bad write does not drop the whole batch
+        failed = 0
+        for _, ops in batch:
+            try:
+                with conn:
+                    _run_ops(conn, ops)
+            except Exception as e:
+                failed += 1
+                logging.warning(f"⚠️ Write-behind write dropped: {e}")
+        self._done([item[0] for item in batch], failed)
+
+class UserContext:
+    """Prompt context of one user: profile dict, top entities and a rolling window of messages."""
+
+    def __init__(self, profile, entities, history, summary=None, version=None):
+        self.profile = profile
+        self.entities = entities  # None means "reload from entity_stats on next read"
+        self.history = deque(history, maxlen=CONTEXT_HISTORY_SIZE)
+        self.summary = summary  # Latest entry of user_summaries
+        self.version = version  # context_versions.version this context matches, None if not checked
+        self.loaded_at = time.monotonic()
+
+    def size(self):
+        """Approximate memory used, in bytes."""
+        size = 200
+        size += sum(len(k) + len(v) + 100 for k, v in self.profile.items())
+        size += sum(len(e["name"]) + 200 for e in self.entities or [])
+        size += sum(len(content) + 100 for _, content in self.history)
+        size += len(self.summary or "")
+        return size
+
+class ContextCache:
+    """Bounded LRU of UserContext objects with a memory cap, updated by the Database writers."""
+
+    def __init__(self, max_users=CONTEXT_CACHE_USERS, max_bytes=CONTEXT_CACHE_MAX_BYTES, ttl=CONTEXT_CACHE_TTL):
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._items = OrderedDict()  # user_id -> (UserContext, size)
+        self._bytes = 0
+        self._loading = {}  # user_id -> True if written while being loaded
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "stale": 0}
+
+    def snapshot(self, user_id, version=None):
+        """Return a copy of the cached context as a dict, or None on a miss.
+
+        version is the user's current context_versions.version: a cached context with
+        another one missed writes of another process and is dropped.
+        """
+        with self._lock:
+            item = self._items.get(user_id)
+            stale = item is not None and version is not None and item[0].version != version
+            if item is None or stale or time.monotonic() - item[0].loaded_at > self.ttl:
+                if item is not None:
+                    self._drop(user_id)
+                self._stats["stale"] += stale
+                self._stats["misses"] += 1
+                return None
+            self._items.move_to_end(user_id)
+            self._stats["hits"] += 1
+            context = item[0]
+            return {
+                "profile": dict(context.profile),
+                # on_entities updates the cached entity dicts in place, callers get their own
+                "entities": [dict(e) for e in context.entities] if context.entities is not None else None,
+                "history": list(context.history),
+                "summary": context.summary
+            }
+
+    def has_profile(self, user_id):
+        with self._lock:
+            item = self._items.get(user_id)
+            return item is not None and bool(item[0].profile)
+
+    def begin_load(self, user_id):
+        with self._lock:
+            self._loading[user_id] = False
+
+    def finish_load(self, user_id, context):
+        """Store a freshly loaded context unless the user was written to meanwhile."""
+        with self._lock:
+            if self._loading.pop(user_id, True):
+                return
+            self._drop(user_id)
+            self._store(user_id, context)
+
+    def set_entities(self, user_id, entities):
+        with self._lock:
+            item = self._items.get(user_id)
+            if item is not None and item[0].entities is None:
+                item[0].entities = [dict(e) for e in entities]
+                self._resize(user_id)
+
+    def on_message(self, user_id, type, content):
+        self._update(user_id, lambda context: context.history.append((type, content)))
+
+    def on_summary(self, user_id, summary):
+        def apply(context):
+            context.summary = summary
+        self._update(user_id, apply)
+
+    def on_profile(self, user_id, changes):
+        self._update(user_id, lambda context: context.profile.update(changes))
+
+    def on_entities(self, user_id, entities):
+        """Add new mentions to the cached top entities, or mark them for reload if the ranking may change."""
+        def apply(context):
+            if context.entities is None:
+                return
+            cached = {(e["name"], e["type"]): e for e in context.entities}
+            if any((e["name"], e["type"]) not in cached for e in entities):
+                context.entities = None  # A new entity may enter the top-k
+                return
+            for e in entities:
+                top = cached[(e["name"], e["type"])]
+                top["importance"] += e["importance"]
+                top["mentions"] += 1
+                top["max_importance"] = max(top["max_importance"], e["importance"])
+            context.entities.sort(key=lambda e: e["importance"], reverse=True)
+        self._update(user_id, apply)
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "users": len(self._items), "bytes": self._bytes}
+
+    def _update(self, user_id, apply):
+        with self._lock:
+            if user_id in self._loading:
+                self._loading[user_id] = True
+            item = self._items.get(user_id)
+            if item is not None:
+                apply(item[0])
+                if item[0].version is not None:
+                    item[0].version += 1  # The writer added one to the database version too
+                self._resize(user_id)
+
+    def _store(self, user_id, context):
+        size = context.size()
+        self._items[user_id] = (context, size)
+        self._bytes += size
+        while self._items and (len(self._items) > self.max_users or self._bytes > self.max_bytes):
+            oldest = next(iter(self._items))
+            self._drop(oldest)
+            self._stats["evictions"] += 1
+
+    def _resize(self, user_id):
+        context, size = self._items[user_id]
+        new_size = context.size()
+        self._items[user_id] = (context, new_size)
+        self._bytes += new_size - size
+
+    def _drop(self, user_id):
+        item = self._items.pop(user_id, None)
+        if item is not None:
+            self._bytes -= item[1]
+
+def load_numpy():
+    """Import numpy on first use, returns None if it is not installed."""
+    global np
+    if np is None:
+        try:
+            np = lazy_import("numpy")
+        except ImportError:
+            return None
+    return np
+
+class HashingEmbedder:
+    """Offline text embeddings: signed feature hashing of word stems and stem pairs."""
+
+    STOP_WORDS = frozenset(
+        "a an and are at be but by do does for from had has have how i if in is it its me my of on or so "
+        "that the their them then there they this to was we what when where which who why will with you your".split()
+    )
+
+    def __init__(self, dim=MEMORY_DIM):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    @staticmethod
+    def stem(word):
+        """Crude suffix stripping, so raid/raids/raiding hash to the same feature."""
+        for suffix in ("ing", "ed", "es", "s"):
+            if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+                return word[:-len(suffix)]
+        return word
+
+    def __call__(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = [self.stem(word) for word in re.findall(r"\w+", text.lower()) if word not in self.STOP_WORDS]
+            features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+            if not features:
+                continue
+            hashes = np.array([zlib.crc32(feature.encode("utf-8")) for feature in features], dtype=np.uint32)
+            signs = np.where(hashes & 0x80000000, 1.0, -1.0)
+            vectors[row] = np.bincount(hashes % self.dim, weights=signs, minlength=self.dim)
+        return vectors
+
+def load_embedder(spec=MEMORY_EMBEDDER):
+    """Return the embedding function named by "module:function", or the built-in hashing embedder."""
+    if not spec:
+        return HashingEmbedder()
+    module, _, name = spec.partition(":")
+    embedder = getattr(importlib.import_module(module), name)
+    if not hasattr(embedder, "name"):
+        embedder.name = spec
+    return embedder
+
+class UserMemory:
+    """One user's memory: a float32 matrix file (one row per text) and a JSON-lines file of the texts.
+
+    Use it inside locked(): the two files only stay in step if one thread of one process
+    changes them at a time.
+    """
+
+    def __init__(self, path, dim, lock):
+        self.vectors_path = path + ".f32"
+        self.texts_path = path + ".jsonl"
+        self.lock_path = path + ".lock"
+        self.dim = dim
+        self.lock = lock  # Shared by every UserMemory of the same user
+        self.texts = None  # (type, content) per row, None until loaded
+        self._matrix = None
+
+    @contextmanager
+    def locked(self):
+        """Hold the user's thread lock and an exclusive lock on the user's lock file (other workers)."""
+        with self.lock:
+            if fcntl is None:
+                yield
+                return
+            os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+            with open(self.lock_path, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)  # Released when the file is closed
+                yield
+
+    def load(self, build):
+        """Read the files, or create them from build() -> [(type, content)]. Returns True if created."""
+        if self.texts is not None and self._in_sync():
+            return False
+        if not os.path.exists(self.texts_path):
+            os.makedirs(os.path.dirname(self.texts_path), exist_ok=True)
+            texts, vectors = build()
+            self.texts = []
+            self.append(vectors, texts)
+            return True
+        with open(self.texts_path, encoding="utf-8") as file:
+            self.texts = [tuple(json.loads(line)) for line in file]
+        rows = os.path.getsize(self.vectors_path) // (4 * self.dim) if os.path.exists(self.vectors_path) else 0
+        if rows != len(self.texts):
+            self._repair(min(rows, len(self.texts)))
+        return False
+
+    def append(self, vectors, texts):
+        """Append rows to both files, vectors first so a crash leaves at most a row to drop."""
+        with open(self.vectors_path, "ab") as file:
+            file.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        with open(self.texts_path, "a", encoding="utf-8") as file:
+            file.writelines(json.dumps(text) + "\n" for text in texts)
+        self.texts.extend(texts)
+
+    def matrix(self):
+        """The vectors, memory-mapped (remapped after appends)."""
+        if not self.texts:
+            return None
+        if self._matrix is None or len(self._matrix) != len(self.texts):
+            self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(len(self.texts), self.dim))
+        return self._matrix
+
+    def _in_sync(self):
+        """False if the files grew behind our back (another copy of this memory appended to them)."""
+        try:
+            return os.path.getsize(self.vectors_path) == len(self.texts) * 4 * self.dim
+        except OSError:
+            return False
+
+    def _repair(self, rows):
+        """Cut both files to the rows they have in common (after an interrupted append)."""
+        logging.warning(f"⚠️ Memory files out of sync, keeping {rows} rows: {self.texts_path}")
+        self.texts = self.texts[:rows]
+        if os.path.exists(self.vectors_path):
+            os.truncate(self.vectors_path, rows * 4 * self.dim)
+        with open(self.texts_path, "w", encoding="utf-8") as file:
+            file.writelines(json.dumps(text) + "\n" for text in self.texts)
+
+class MemoryIndex:
+    """Per-user semantic memory of messages and summaries, searched by cosine similarity.
+
+    Each user's embeddings live in their own memory-mapped float32 file and grow by appends.
+    A user's memory is built from the database the first time it is opened. Embedding,
+    appends and builds run on one background thread, in order, never on the request thread.
+    """
+
+    def __init__(self, db, directory=MEMORY_DIR, embedder=None, max_open=MEMORY_OPEN_USERS):
+        load_numpy()
+        self.db = db
+        self.embed = embedder or load_embedder()
+        self.dim = self.embed_texts(["dimension probe"]).shape[1]
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", self.embed.name)
+        self.directory = os.path.join(directory or f"{db.db_file}-memory", name)
+        self.max_open = max_open
+        self._open = OrderedDict()  # user_id -> UserMemory
+        self._lock = threading.Lock()
+        self._user_locks = [threading.Lock() for _ in range(64)]
+        self._indexer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory")
+
+    def embed_texts(self, texts):
+        """Embeddings of texts as unit-length float32 rows, so a dot product is the cosine similarity."""
+        vectors = np.asarray(self.embed(texts), dtype=np.float32).reshape(len(texts), -1)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def add(self, user_id, type, content):
+        """Queue a message or summary to be appended to a user's memory."""
+        self._indexer.submit(self._background, self._add, user_id, type, content)
+
+    def flush(self):
+        """Block until the queued appends and builds are done."""
+        self._indexer.submit(lambda: None).result()
+
+    def close(self):
+        """Finish the queued appends and builds (shutdown hook)."""
+        self._indexer.shutdown(wait=True)
+
+    def _background(self, function, user_id, *args):
+        try:
+            function(user_id, *args)
+        except Exception as e:
+            logging.warning(f"⚠️ Error updating the memory of {user_id}: {e}")
+
+    def _add(self, user_id, type, content):
+        vectors = self.embed_texts([content])
+        memory = self._get(user_id)
+        with memory.locked():
+            if not memory.load(lambda: self._saved_texts(user_id)):  # A new memory already has this text
+                memory.append(vectors, [(type, content)])
+
+    def _build(self, user_id):
+        memory = self._get(user_id)
+        with memory.locked():
+            memory.load(lambda: self._saved_texts(user_id))
+
+    @metrics.timed("memory.search")
+    def search(self, user_id, query, k=MEMORY_TOP_K, exclude=(), min_score=MEMORY_MIN_SCORE):
+        """Return up to k {type, content, score} of the user's past texts most similar to query.
+
+        A memory not built yet is built in the background, meanwhile there are no results.
+        """
+        memory = self._get(user_id)
+        if memory.texts is None and not os.path.exists(memory.texts_path):
+            self._indexer.submit(self._background, self._build, user_id)
+            return []
+        with memory.locked():
+            memory.load(lambda: self._saved_texts(user_id))
+            matrix = memory.matrix()
+            texts = list(memory.texts)
+        if matrix is None:
+            return []
+
+        scores = matrix @ self.embed_texts([query])[0]
+        exclude = set(exclude)
+        take = min(len(scores), k + len(exclude))
+        top = np.argpartition(-scores, take - 1)[:take]
+        results = []
+        for row in top[np.argsort(-scores[top])]:
+            if scores[row] < min_score or len(results) == k:
+                break
+            type, content = texts[row]
+            if content in exclude:
+                continue
+            exclude.add(content)  # Same text said twice
+            results.append({"type": type, "content": content, "score": round(float(scores[row]), 3)})
+        return results
+
+    def _get(self, user_id):
+        """Return the (possibly not yet loaded) UserMemory of a user."""
+        user_id = str(user_id)  # Discord ids may come as JSON numbers
+        with self._lock:
+            memory = self._open.get(user_id)
+            if memory is not None:
+                self._open.move_to_end(user_id)
+                return memory
+            digest = hashlib.sha1(user_id.encode("utf-8")).hexdigest()
+            memory = UserMemory(os.path.join(self.directory, digest[:2], digest), self.dim,
+                                self._user_locks[int(digest[:8], 16) % len(self._user_locks)])
+            self._open[user_id] = memory
+            while len(self._open) > self.max_open:
+                self._open.popitem(last=False)
+            return memory
+
+    def _saved_texts(self, user_id):
+        """The user's saved messages and summaries with their embeddings, to build a new memory."""
+        self.db._read_your_writes(user_id)
+        with self.db.get_connection() as conn:
+            texts = [tuple(row) for row in conn.execute(MEMORY_MESSAGES_QUERY, (user_id,))]
+            texts += [("summary", row[0]) for row in conn.execute(MEMORY_SUMMARIES_QUERY, (user_id,))]
+        texts = [(type, content) for type, content in texts if content]
+        if not texts:
+            return [], np.zeros((0, self.dim), dtype=np.float32)
+        return texts, np.concatenate([self.embed_texts([content for _, content in texts[start:start + 1000]])
+                                      for start in range(0, len(texts), 1000)])
+
 class Database:
     def __init__(self, db_file):
         self.db_file = db_file
+        self._local = threading.local()
+        self._pool_lock = threading.Lock()
+        self._connections = {}  # thread ident -> (thread, connection)
+        self._stats = {"opened": 0, "reused": 0, "closed": 0}
+        self.writer = None
+        self.contexts = ContextCache()
         self.init_db()
+        self.memory = MemoryIndex(self) if MEMORY_ENABLED and load_numpy() is not None else None
+
+    def _connect(self):
+        """Open a new connection with WAL and the tuned pragmas."""
+        # check_same_thread=False only so close_all() can close connections of other threads;
+        # each connection is still used by the thread that opened it.
+        conn = sqlite3.connect(
+            self.db_file,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")  # Safe with WAL, avoids an fsync per commit
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
 
     def get_connection(self):
-        """Get a new database connection."""
-        return sqlite3.connect(self.db_file)
+        """Get the reusable connection of the current thread (opened on first use)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            with self._pool_lock:
+                self._stats["reused"] += 1
+            return conn
+
+        conn = self._connect()
+        self._local.conn = conn
+        thread = threading.current_thread()
+        with self._pool_lock:
+            self._prune_dead_threads()
+            self._connections[thread.ident] = (thread, conn)
+            self._stats["opened"] += 1
+        return conn
+
+    def _prune_dead_threads(self):
+        """Close connections left behind by threads that already finished (call with the lock held)."""
+        for ident, (thread, conn) in list(self._connections.items()):
+            if not thread.is_alive():
+                conn.close()
+                del self._connections[ident]
+                self._stats["closed"] += 1
+
+    def enable_write_behind(self, **options):
+        """Commit messages and entities through a background WriteBehindWriter."""
+        if self.writer is None:
+            self.writer = WriteBehindWriter(self, **options)
+            logging.info("✍️ Write-behind mode enabled.")
+        return self.writer
+
+    def _write(self, user_id, ops):
+        """Run a list of (sql, params, many) in one transaction now, or queue it in write-behind mode."""
+        if self.writer is not None:
+            try:
+                self.writer.submit(user_id, ops)
+            except queue.Full:
+                raise sqlite3.OperationalError("write-behind queue is full")
+            return
+        with self.get_connection() as conn:
+            _run_ops(conn, ops)
+
+    def _read_your_writes(self, user_id):
+        """Wait until the queued writes of the user are visible to reads."""
+        if self.writer is not None:
+            self.writer.wait_for_user(user_id, timeout=WRITE_PUT_TIMEOUT)
+
+    def close_all(self):
+        """Flush queued writes and memory updates, then close every pooled connection (used on shutdown)."""
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.memory is not None:
+            self.memory.close()
+        with self._pool_lock:
+            for thread, conn in self._connections.values():
+                conn.close()
+                self._stats["closed"] += 1
+            self._connections.clear()
+        self._local = threading.local()
+
+    def pool_stats(self):
+        """Return connection pool counters for monitoring."""
+        with self._pool_lock:
+            self._prune_dead_threads()
+            return {
+                **self._stats,
+                "open_connections": len(self._connections),
+                "statement_cache_size": DB_STATEMENT_CACHE
+            }
 
     def init_db(self):
         """Initialize the database with new tables for Google API analysis."""
@@ -88,165 +1552,863 @@ class Database:
             """)
             conn.commit()
             logging.info("✅ Database initialized successfully with new tables.")
+        self.migrate()
 
-    def save_conversation_thread(self, user_id, message):
-        """Save a message in the conversation thread."""
-        try:
-            with self.get_connection() as conn:
+    def get_schema_version(self):
+        """Return the highest applied migration version (0 if none)."""
+        conn = self.get_connection()
+        row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+        return row[0] or 0
+
+    def migrate(self):
+        """Apply pending migrations in order, each one in its own transaction."""
+        conn = self.get_connection()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.commit()
+
+        for version, description, steps in MIGRATIONS:
+            if version <= self.get_schema_version():
+                continue
+            # BEGIN IMMEDIATE takes the writer lock, so two processes never apply the same step twice
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if version <= self.get_schema_version():
+                    conn.rollback()
+                    continue
                 cursor = conn.cursor()
+                for step in steps:
+                    if callable(step):
+                        step(cursor)
+                    else:
+                        cursor.execute(step)
                 cursor.execute("""
-                    INSERT INTO conversations (user_id, thread)
-                    VALUES (?, ?)
-                """, (user_id, message))
+                    INSERT INTO schema_version (version, description) VALUES (?, ?)
+                """, (version, description))
                 conn.commit()
-                logging.info(f"Thread saved for user {user_id}.")
+                logging.info(f"🧱 Migration {version} applied: {description}")
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+
+    def find_table_scans(self):
+        """Run EXPLAIN QUERY PLAN on the hot queries and return the ones that scan a table or sort."""
+        conn = self.get_connection()
+        problems = []
+        for name, (sql, params) in QUERY_PLAN_CHECKS.items():
+            for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params):
+                detail = row[-1]
+                full_scan = detail.startswith("SCAN") and "INDEX" not in detail
+                if full_scan or "USE TEMP B-TREE" in detail:
+                    problems.append((name, detail))
+        return problems
+
+    def check_query_plans(self):
+        """Fail if any hot query still does a full table scan or a sort (besides QUERY_PLAN_EXPECTED)."""
+        problems = []
+        for name, detail in self.find_table_scans():
+            if name in QUERY_PLAN_EXPECTED and detail.startswith(QUERY_PLAN_EXPECTED[name]):
+                logging.info(f"ℹ️ Expected in {name}: {detail}")
+            else:
+                problems.append((name, detail))
+        if problems:
+            details = "; ".join(f"{name}: {detail}" for name, detail in problems)
+            raise RuntimeError(f"Query plans with table scans: {details}")
+        logging.info("✅ All hot query plans use indexes.")
+
+    @metrics.timed("db.save_conversation_thread")
+    def save_conversation_thread(self, user_id, message):
+        """Save a message in the conversation thread."""
+        try:
+            self._write(user_id, [("""
+                INSERT INTO conversations (user_id, thread)
+                VALUES (?, ?)
+            """, (user_id, message), False)])
+            logging.info(f"Thread saved for user {user_id}.")
         except sqlite3.Error as e:
             logging.warning(f"⚠️ Error saving conversation thread in DB: {e}")
 
+    @metrics.timed("db.get_conversation_thread")
     def get_conversation_thread(self, user_id, limit=30):
         """Retrieve the most recent complete conversation thread."""
+        self._read_your_writes(user_id)
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT thread FROM conversations
-                    WHERE user_id = ?
-                    ORDER BY timestamp DESC
-                    LIMIT ?
-                """, (user_id, limit))
+                cursor.execute(CONVERSATION_THREAD_QUERY, (user_id, limit))
                 history = cursor.fetchall()
                 return '/'.join([thread[0] for thread in history[::-1]])
         except sqlite3.Error as e:
             logging.warning(f"⚠️ Error retrieving conversation thread: {e}")
             return ""
 
+    @staticmethod
+    def _message_ops(user_id, session_id, messages):
+        """Write ops inserting messages, a list of (type, content)."""
+        return [("""
+            INSERT INTO user_messages (user_id, session_id, type, content)
+            VALUES (?, ?, ?, ?)""", [(user_id, session_id, type, content) for type, content in messages], True)]
+
+    @staticmethod
+    def _entity_ops(user_id, entities):
+        """Write ops inserting detected entities and updating their aggregate."""
+        now = time.time()
+        last_seen = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(now))
+
+        def upserts(conn):
+            # The weight is taken after the insert above, under the write lock, so no
+            # other process can move the epoch between reading and using it
+            weight = _decay_weight(now, _entity_decay_epoch(conn, now))
+            return [(user_id, e["name"], e["type"], e["importance"], e["importance"] * weight, last_seen)
+                    for e in entities]
+
+        return [
+            ("""
+                INSERT INTO detected_entities (user_id, entity, type, importance)
+                VALUES (?, ?, ?, ?)
+            """, [(user_id, e["name"], e["type"], e["importance"]) for e in entities], True),
+            (ENTITY_STATS_UPSERT, upserts, True)
+        ]
+
+    @staticmethod
+    def _context_version_ops(user_id, updates=1):
+        """Write op adding updates (the ContextCache.on_*() calls that follow the write) to the user's version."""
+        return [(CONTEXT_VERSION_BUMP, (user_id, updates), False)]
+
+    @staticmethod
+    def _profile_ops(user_id, changes):
+        """Write ops upserting profile categories ({category: content})."""
+        return [("""
+            INSERT INTO user_profile (user_id, category, content)
+            VALUES (?, ?, ?)
+            ON CONFLICT(user_id, category) DO UPDATE SET content = excluded.content, timestamp = CURRENT_TIMESTAMP
+        """, [(user_id, category, content) for category, content in changes.items()], True)]
+
+    @metrics.timed("db.save_message")
     def save_message(self, user_id, session_id, type, content):
         """Save a message in the database."""
+        try:
+            self._write(user_id, self._message_ops(user_id, session_id, [(type, content)])
+                        + self._context_version_ops(user_id))
+            self.contexts.on_message(user_id, type, content)
+            if self.memory is not None and content:
+                self.memory.add(user_id, type, content)
+            logging.info(f"💾 Message saved: {user_id} - {session_id} - {type} - {content}")
+        except sqlite3.Error as e:
+            logging.warning(f"⚠️ Error saving message in DB: {e}")
+
+    @metrics.timed("db.save_entities")
+    def save_entities(self, user_id, entities):
+        """Save the entities detected in a message and update their aggregate in a single transaction."""
+        if not entities:
+            return
+        try:
+            self._write(user_id, self._entity_ops(user_id, entities) + self._context_version_ops(user_id))
+            self.contexts.on_entities(user_id, entities)
+        except sqlite3.Error as e:
+            logging.warning(f"⚠️ Error saving detected entities in DB: {e}")
+
+    @metrics.timed("db.get_top_entities")
+    def get_top_entities(self, user_id, k=5):
+        """Return the k most important entities of a user (deduplicated, with decayed importance)."""
+        self._read_your_writes(user_id)
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute("""
-                    INSERT INTO user_messages (user_id, session_id, type, content)
-                    VALUES (?, ?, ?, ?)""", (user_id, session_id, type, content))
-                conn.commit()
-                logging.info(f"💾 Message saved: {user_id} - {session_id} - {type} - {content}")
+                cursor.execute(TOP_ENTITIES_QUERY, (user_id, k))
+                entities = cursor.fetchall()
+                now = time.time()
+                return [{"name": e[0], "type": e[1], "mentions": e[2], "max_importance": e[3],
+                         "importance": e[4] * _decay_weight(e[5], now)} for e in entities]  # Weight of now ** -1
         except sqlite3.Error as e:
-            logging.warning(f"⚠️ Error saving message in DB: {e}")
+            logging.warning(f"⚠️ Error retrieving top entities: {e}")
+            return []
 
+    @metrics.timed("db.get_user_history")
     def get_user_history(self, user_id, limit=25):
         """Retrieve the last messages of a user to maintain context."""
+        self._read_your_writes(user_id)
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT type, content FROM user_messages
-                    WHERE user_id = ?
-                    ORDER BY timestamp DESC
-                    LIMIT ?
-                """, (user_id, limit))
+                cursor.execute(USER_HISTORY_QUERY, (user_id, limit))
                 history = cursor.fetchall()
                 return history[::-1]  # Return in correct chronological order
         except sqlite3.Error as e:
             logging.warning(f"⚠️ Error retrieving user history: {e}")
             return []
 
+    @metrics.timed("db.get_important_messages")
     def get_important_messages(self, user_id):
         """Retrieve the important messages of a user."""
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT message FROM important_messages
-                    WHERE user_id = ?
-                    ORDER BY timestamp DESC
-                """, (user_id,))
+                cursor.execute(IMPORTANT_MESSAGES_QUERY, (user_id,))
                 messages = cursor.fetchall()
                 return [message[0] for message in messages]
         except sqlite3.Error as e:
             logging.warning(f"⚠️ Error retrieving important messages: {e}")
             return []
 
+    @metrics.timed("db.get_detected_entities")
     def get_detected_entities(self, user_id):
         """Retrieve the detected entities of a user in JSON format."""
+        self._read_your_writes(user_id)
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT entity, type, importance FROM detected_entities
-                    WHERE user_id = ?
-                    ORDER BY importance DESC
-                """, (user_id,))
+                cursor.execute(DETECTED_ENTITIES_QUERY, (user_id,))
                 entities = cursor.fetchall()
                 return [{"name": e[0], "type": e[1], "importance": e[2]} for e in entities]
         except sqlite3.Error as e:
             logging.warning(f"⚠️ Error retrieving detected entities: {e}")
             return []
 
+    @metrics.timed("db.create_profile_if_not_exists")
     def create_profile_if_not_exists(self, user_id):
         """Create basic entries for the user's profile if they don't have one yet."""
+        if self.contexts.has_profile(user_id):
+            return  # Cached profile, nothing to check
+
+        self._read_your_writes(user_id)
         with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT COUNT(*) FROM user_profile WHERE user_id = ?
-            """, (user_id,))
-            exists = cursor.fetchone()[0]
-
-            if exists == 0:
-                # Create basic profile
-                cursor.executemany("""
-                    INSERT INTO user_profile (user_id, category, content)
-                    VALUES (?, ?, ?)
-                """, [
-                    (user_id, "role", "player"),
-                    (user_id, "tone", "relaxed attitude"),
-                    (user_id, "interest", "learning about Rust")
-                ])
-                conn.commit()
-                print(f"🌱 Profile created for user {user_id}")
-            else:
-                print(f"✅ Profile already exists for {user_id}")
+            # Create basic profile, a single statement so concurrent creations cannot collide
+            created = dict(conn.execute("""
+                INSERT INTO user_profile (user_id, category, content)
+                VALUES (?, 'role', 'player'), (?, 'tone', 'relaxed attitude'), (?, 'interest', 'learning about Rust')
+                ON CONFLICT (user_id, category) DO NOTHING
+                RETURNING category, content
+            """, (user_id, user_id, user_id)).fetchall())
+            if created:
+                conn.execute(CONTEXT_VERSION_BUMP, (user_id, 1))
+        if created:
+            self.contexts.on_profile(user_id, created)
+            print(f"🌱 Profile created for user {user_id}")
+        else:
+            print(f"✅ Profile already exists for {user_id}")
 
+    @metrics.timed("db.update_profile")
+    def update_profile(self, user_id, changes):
+        """Set profile categories ({category: content}) in a single upsert transaction."""
+        self._write(user_id, self._profile_ops(user_id, changes) + self._context_version_ops(user_id))
+        self.contexts.on_profile(user_id, changes)
+
+    @metrics.timed("db.save_batch")
+    def save_batch(self, session_id, turns):
+        """Save the messages, entities and profile changes of many users in a single transaction.
+
+        turns is a list of dicts with user_id, messages [(type, content)], entities and profile.
+        Writes already queued for these users are committed first, so message order is kept.
+        """
+        ops = []
+        for turn in turns:
+            ops += self._message_ops(turn["user_id"], session_id, turn["messages"])
+            if turn["entities"]:
+                ops += self._entity_ops(turn["user_id"], turn["entities"])
+            if turn["profile"]:
+                ops += self._profile_ops(turn["user_id"], turn["profile"])
+            ops += self._context_version_ops(
+                turn["user_id"], len(turn["messages"]) + bool(turn["entities"]) + bool(turn["profile"]))
+        for user_id in {turn["user_id"] for turn in turns}:
+            self._read_your_writes(user_id)
+        with self.get_connection() as conn:
+            _run_ops(conn, ops)
+
+        for turn in turns:
+            user_id = turn["user_id"]
+            for type, content in turn["messages"]:
+                self.contexts.on_message(user_id, type, content)
+                if self.memory is not None and content:
+                    self.memory.add(user_id, type, content)
+            if turn["entities"]:
+                self.contexts.on_entities(user_id, turn["entities"])
+            if turn["profile"]:
+                self.contexts.on_profile(user_id, turn["profile"])
+        logging.info(f"💾 Batch saved: {sum(len(turn['messages']) for turn in turns)} messages of {len(turns)} turns")
+
+    @metrics.timed("db.get_profile")
     def get_profile(self, user_id):
         """Return the user's profile as a dict."""
+        self._read_your_writes(user_id)
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                SELECT category, content FROM user_profile WHERE user_id = ?
-            """, (user_id,))
+            cursor.execute(PROFILE_QUERY, (user_id,))
             data = cursor.fetchall()
             return {cat: cont for cat, cont in data}
 
+    def get_context_version(self, user_id):
+        """The user's context_versions.version, once their queued writes are committed."""
+        self._read_your_writes(user_id)
+        with self.get_connection() as conn:
+            row = conn.execute(CONTEXT_VERSION_QUERY, (user_id,)).fetchone()
+        return row[0] if row is not None else 0
+
+    @metrics.timed("db.get_prompt_context")
+    def get_prompt_context(self, user_id):
+        """Return profile, top entities and recent messages of a user, from the context cache when possible."""
+        version = self.get_context_version(user_id) if CONTEXT_CACHE_VALIDATE else None
+        context = self.contexts.snapshot(user_id, version)
+        if context is not None:
+            if context["entities"] is None:
+                context["entities"] = self.get_top_entities(user_id, CONTEXT_TOP_ENTITIES)
+                self.contexts.set_entities(user_id, context["entities"])
+            return context
+
+        self.contexts.begin_load(user_id)
+        profile = self.get_profile(user_id)
+        entities = self.get_top_entities(user_id, CONTEXT_TOP_ENTITIES)
+        history = self.get_user_history(user_id, limit=CONTEXT_HISTORY_SIZE)
+        summary = self.get_latest_summary(user_id)
+        self.contexts.finish_load(user_id, UserContext(dict(profile), [dict(e) for e in entities], history, summary,
+                                                       version))
+        return {"profile": profile, "entities": entities, "history": history, "summary": summary}
+
+    @metrics.timed("db.save_summary")
+    def save_summary(self, user_id, session_id, summary, last_message_id=None):
+        """Save a summary of the user's behavior and mark the messages up to last_message_id as summarised."""
+        with self.get_connection() as conn:
+            conn.execute("""
+                INSERT INTO user_summaries (user_id, session_id, summary, last_message_id)
+                VALUES (?, ?, ?, ?)
+            """, (user_id, session_id, summary, last_message_id))
+            if last_message_id is not None:
+                conn.execute(f"""
+                    UPDATE dirty_users
+                    SET new_messages = ({REMAINING_MESSAGES_QUERY})
+                    WHERE user_id = ?
+                """, (user_id, last_message_id, user_id))
+                conn.execute("DELETE FROM dirty_users WHERE user_id = ? AND new_messages = 0", (user_id,))
+            conn.execute(CONTEXT_VERSION_BUMP, (user_id, 1))
+        self.contexts.on_summary(user_id, summary)
+        if self.memory is not None and summary:
+            self.memory.add(user_id, "summary", summary)
+
+    @metrics.timed("db.search")
+    def search(self, text, user_id=None, source="messages", order="rank", limit=20, cursor=None):
+        """Full-text search of one source, returns (results, next_cursor).
+
+        order is "rank" (best bm25 first) or "recent" (newest first). Pass the previous
+        page's next_cursor to get the following page (None when there are no more results).
+        """
+        _, column = SEARCH_SOURCES[source]
+        params = [fts_query(text, column, user_id)]
+        if user_id:
+            params.append(user_id)
+        if cursor:
+            params += [cursor[0], cursor[0], cursor[1]] if order == "rank" else [cursor[0]]
+
+        with self.get_connection() as conn:
+            rows = conn.execute(search_sql(source, bool(user_id), order, bool(cursor)),
+                                params + [limit + 1]).fetchall()
+
+        results = []
+        for id, user, type, timestamp, snippet, rank in rows[:limit]:
+            result = {"id": id, "user_id": user, "timestamp": timestamp, "snippet": snippet, "score": -rank}
+            if type is not None:
+                result["type"] = type
+            results.append(result)
+        next_cursor = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_cursor = [last[5], last[0]] if order == "rank" else [last[0]]
+        return results, next_cursor
+
+    def acquire_lease(self, name, owner, seconds):
+        """Take or renew a named lease, returns True if owner holds it for the next seconds."""
+        now = time.time()
+        with self.get_connection() as conn:
+            row = conn.execute("""
+                INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+                RETURNING owner
+            """, (name, owner, now + seconds, now)).fetchone()
+        return row is not None
+
+    def release_lease(self, name, owner):
+        """Give up a lease so another process can take it right away."""
+        with self.get_connection() as conn:
+            conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    @metrics.timed("db.get_pdf_pages")
+    def get_pdf_pages(self, file_hash, start, end):
+        """Return {page: text} of the cached pages of a PDF in [start, end)."""
+        try:
+            with self.get_connection() as conn:
+                rows = conn.execute(PDF_PAGES_QUERY, (file_hash, start, end)).fetchall()
+                return dict(rows)
+        except sqlite3.Error as e:
+            logging.warning(f"⚠️ Error reading PDF page cache: {e}")
+            return {}
+
+    @metrics.timed("db.save_pdf_pages")
+    def save_pdf_pages(self, file_hash, pages):
+        """Cache the text of PDF pages, pages is a list of (page, text)."""
+        try:
+            with self.get_connection() as conn:
+                conn.executemany("""
+                    INSERT OR REPLACE INTO pdf_pages (file_hash, page, text) VALUES (?, ?, ?)
+                """, [(file_hash, page, text) for page, text in pages])
+        except sqlite3.Error as e:
+            logging.warning(f"⚠️ Error saving PDF page cache: {e}")
+
+    @metrics.timed("db.get_dirty_users")
+    def get_dirty_users(self, min_messages, limit=SUMMARY_BATCH):
+        """Return the users with at least min_messages messages not covered by a summary."""
+        with self.get_connection() as conn:
+            rows = conn.execute(DIRTY_USERS_QUERY, (min_messages, limit)).fetchall()
+            return [row[0] for row in rows]
+
+    @metrics.timed("db.get_summary_state")
+    def get_summary_state(self, user_id, cooldown_hours=SUMMARY_COOLDOWN_HOURS):
+        """Return the latest summary as {"summary", "last_message_id", "recent"}, or None."""
+        with self.get_connection() as conn:
+            row = conn.execute(SUMMARY_STATE_QUERY, (f"-{cooldown_hours} hours", user_id)).fetchone()
+            if row is None:
+                return None
+            return {"summary": row[0], "last_message_id": row[1], "recent": bool(row[2])}
+
+    @metrics.timed("db.get_messages_since")
+    def get_messages_since(self, user_id, after_id, limit=200):
+        """Return (id, content) of the user's messages after after_id, oldest first."""
+        with self.get_connection() as conn:
+            return conn.execute(MESSAGES_SINCE_QUERY, (user_id, after_id, limit)).fetchall()
+
+    @metrics.timed("db.get_recent_messages")
+    def get_recent_messages(self, user_id, limit=25):
+        """Return (id, content) of the user's last messages, newest first."""
+        with self.get_connection() as conn:
+            return conn.execute(RECENT_MESSAGES_QUERY, (user_id, limit)).fetchall()
+
+    @metrics.timed("db.get_latest_summary")
+    def get_latest_summary(self, user_id):
+        """Return the most recent summary of the user, or None."""
+        try:
+            with self.get_connection() as conn:
+                row = conn.execute(LATEST_SUMMARY_QUERY, (user_id,)).fetchone()
+                return row[0] if row else None
+        except sqlite3.Error as e:
+            logging.warning(f"⚠️ Error retrieving user summary: {e}")
+            return None
+
+def request_key(kind, **params):
+    """Hash of an upstream request (with whitespace in its texts normalized), to recognise identical ones."""
+    def normalize(value):
+        if isinstance(value, str):
+            return " ".join(value.split())
+        if isinstance(value, list):
+            return [normalize(item) for item in value]
+        if isinstance(value, dict):
+            return {key: normalize(item) for key, item in value.items()}
+        return value
+
+    payload = json.dumps([kind, normalize(params)], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class SingleFlight:
+    """Merge concurrent calls with the same key: the first one runs, the others wait for its result."""
+
+    def __init__(self):
+        self._calls = {}  # key -> Future of the running call
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "merged": 0}
+
+    def do(self, key, function):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self._stats["calls"] += 1
+            else:
+                self._stats["merged"] += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = function()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "in_flight": len(self._calls)}
+
+class Overloaded(Exception):
+    """A request refused by admission control, answered with 429 and Retry-After."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class Admission:
+    """Token-bucket admission of OpenAI calls.
+
+    Each user has a small bucket checked without waiting. The global bucket lets a bounded
+    number of requests queue for a bounded time, everything else is refused at once.
+    """
+
+    def __init__(self, user_rate_per_minute=OPENAI_USER_RATE_PER_MINUTE, user_burst=OPENAI_USER_BURST,
+                 global_rate=OPENAI_GLOBAL_RATE_PER_SECOND, global_burst=OPENAI_GLOBAL_BURST,
+                 max_wait=ADMISSION_MAX_WAIT, max_waiters=ADMISSION_MAX_WAITERS, max_users=10000):
+        self.user_rate = user_rate_per_minute / 60
+        self.user_burst = user_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst) if global_rate > 0 else None
+        self.max_wait = max_wait
+        self.max_waiters = max_waiters
+        self.max_users = max_users
+        self._users = OrderedDict()  # user_id -> TokenBucket, least recently seen first
+        self._waiters = 0
+        self._lock = threading.Lock()
+        self._stats = {"admitted": 0, "waited": 0, "rejected_user": 0, "rejected_global": 0}
+
+    def admit_user(self, user_id):
+        """Take a token from the user's bucket, or raise Overloaded right away."""
+        if self.user_rate <= 0:
+            return
+        with self._lock:
+            bucket = self._users.get(user_id)
+            if bucket is None:
+                bucket = self._users[user_id] = TokenBucket(self.user_rate, self.user_burst)
+                while len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            else:
+                self._users.move_to_end(user_id)
+        wait = bucket.try_acquire()
+        if wait > 0:
+            self._count("rejected_user")
+            raise Overloaded("Too many requests, slow down.", wait)
+
+    def admit(self):
+        """Take a global token, queueing at most max_wait seconds, or raise Overloaded."""
+        if self.global_bucket is None:
+            return
+        wait = self.global_bucket.try_acquire()
+        if wait == 0.0:
+            self._count("admitted")
+            return
+        with self._lock:
+            full = self._waiters >= self.max_waiters
+            if not full and wait <= self.max_wait:
+                self._waiters += 1
+        if full or wait > self.max_wait:
+            self._count("rejected_global")
+            raise Overloaded("The assistant is busy, try again shortly.", wait)
+        try:
+            if not self.global_bucket.acquire(timeout=self.max_wait):
+                self._count("rejected_global")
+                raise Overloaded("The assistant is busy, try again shortly.", self.max_wait)
+            self._count("waited")
+            self._count("admitted")
+        finally:
+            with self._lock:
+                self._waiters -= 1
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "waiting": self._waiters, "users": len(self._users)}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+# A response with its cache state. expires_at is None when the cache is off, equal to created_at when
+# the response must not be cached (e.g. an error message)
+CachedResponse = namedtuple("CachedResponse", "value hit created_at expires_at")
+
+class ResponseCache:
+    """Cache of OpenAI responses by request_key(): an in-memory LRU in front of the response_cache table."""
+
+    EVICT_EVERY = 100  # Puts between two eviction passes of the SQLite tier
+
+    def __init__(self, max_items=RESPONSE_CACHE_SIZE, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.enabled = False
+        self.db = None
+        self._items = OrderedDict()  # key -> CachedResponse
+        self._lock = threading.Lock()
+        self._stats = {}  # kind -> {"hits", "memory_hits", "misses"}
+        self._puts = 0
+
+    def enable(self, db=None):
+        """Turn the cache on, with the response_cache table of db as second tier if given."""
+        self.db = db
+        self.enabled = True
+
+    def get_or_compute(self, kind, key, compute, ttl):
+        """Return a CachedResponse, from the cache or from compute() (whose result is then cached).
+
+        compute() raises on upstream errors. An empty result (e.g. an image without URL) is returned uncached.
+        """
+        entry = self.get(kind, key) if self.enabled else None
+        if entry is not None:
+            return entry
+        value = compute()
+        if not self.enabled or not value:
+            return CachedResponse(value, False, time.time(), None)
+        return self.put(kind, key, value, ttl)
+
+    def get(self, kind, key):
+        now = time.time()
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None and entry.expires_at > now:
+                self._items.move_to_end(key)
+                self._count(kind, "hits", "memory_hits")
+                return entry
+            self._items.pop(key, None)
+
+        entry = self._load(key, now)
+        with self._lock:
+            if entry is None:
+                self._count(kind, "misses")
+                return None
+            self._count(kind, "hits")
+        self._remember(key, entry)
+        return entry
+
+    def put(self, kind, key, value, ttl):
+        created_at = time.time()
+        entry = CachedResponse(value, True, created_at, created_at + ttl)
+        self._remember(key, entry)
+        if self.db is not None:
+            try:
+                with self.db.get_connection() as conn:
+                    conn.execute("""
+                        INSERT OR REPLACE INTO response_cache
+                            (key, kind, response, size, created_at, expires_at, last_used)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """, (key, kind, value, len(key) + len(value), created_at, entry.expires_at, created_at))
+            except sqlite3.Error as e:
+                logging.warning(f"⚠️ Error saving response cache: {e}")
+            with self._lock:
+                self._puts += 1
+                evict = self._puts % self.EVICT_EVERY == 0
+            if evict:
+                self.evict()
+        return entry._replace(hit=False)
+
+    def evict(self):
+        """Drop expired entries, then the least recently used until under max_bytes."""
+        if self.db is None:
+            return
+        try:
+            with self.db.get_connection() as conn:
+                conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),))
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM response_cache").fetchone()[0]
+                while total > self.max_bytes:
+                    oldest = conn.execute("SELECT key, size FROM response_cache ORDER BY last_used LIMIT 500").fetchall()
+                    if not oldest:
+                        break
+                    for key, size in oldest:
+                        conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                        total -= size
+                        if total <= self.max_bytes:
+                            break
+        except sqlite3.Error as e:
+            logging.warning(f"⚠️ Error evicting response cache: {e}")
+
+    @staticmethod
+    def headers(entry):
+        """Cache-Control, Age and X-Cache headers for a response."""
+        if entry.expires_at is None:
+            return {}
+        now = time.time()
+        if entry.expires_at <= entry.created_at:
+            return {"Cache-Control": "no-store"}
+        return {
+            "Cache-Control": f"private, max-age={max(0, int(entry.expires_at - now))}",
+            "Age": str(max(0, int(now - entry.created_at))),
+            "X-Cache": "HIT" if entry.hit else "MISS"
+        }
+
+    def stats(self):
+        with self._lock:
+            per_kind = {kind: dict(counts) for kind, counts in self._stats.items()}
+            size = len(self._items)
+        hits = sum(counts["hits"] for counts in per_kind.values())
+        lookups = hits + sum(counts["misses"] for counts in per_kind.values())
+        stats = {"enabled": self.enabled, "hits": hits, "misses": lookups - hits,
+                 "memory_hits": sum(counts["memory_hits"] for counts in per_kind.values()),
+                 "hit_rate": hits / lookups if lookups else 0.0, "size": size, "kinds": per_kind}
+        if self.db is not None:
+            with self.db.get_connection() as conn:
+                entries, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM response_cache").fetchone()
+            stats.update({"entries": entries, "bytes": total, "max_bytes": self.max_bytes})
+        return stats
+
+    def _count(self, kind, *outcomes):
+        """Count a lookup, the caller holds the lock."""
+        counts = self._stats.setdefault(kind, {"hits": 0, "memory_hits": 0, "misses": 0})
+        for outcome in outcomes:
+            counts[outcome] += 1
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._items[key] = entry
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def _load(self, key, now):
+        """Return a CachedResponse from SQLite, or None if missing or expired."""
+        if self.db is None:
+            return None
+        try:
+            with self.db.get_connection() as conn:
+                row = conn.execute("""
+                    UPDATE response_cache SET last_used = ?, hits = hits + 1
+                    WHERE key = ? AND expires_at > ?
+                    RETURNING response, created_at, expires_at
+                """, (now, key, now)).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"⚠️ Error reading response cache: {e}")
+            return None
+        return CachedResponse(row[0], True, row[1], row[2]) if row is not None else None
+
+response_cache = ResponseCache()
+
+_openai_client = None
+_openai_client_lock = threading.Lock()
+
+def get_openai_client():
+    """Return the shared OpenAI client, created (and the openai package imported) on first use."""
+    global _openai_client
+    if _openai_client is None:
+        with _openai_client_lock:
+            if _openai_client is None:
+                _openai_client = lazy_import("openai").OpenAI(api_key=OPENAI_API_KEY)
+    return _openai_client
+
 class OpenAIClient:
-    def __init__(self, api_key):
-        self.client = openai.OpenAI(api_key=api_key)
+    def __init__(self, admission=None, coalesce=OPENAI_COALESCE):
+        self.admission = admission or Admission()
+        self.inflight = SingleFlight() if coalesce else None
+
+    @property
+    def client(self):
+        return get_openai_client()
+
+    def _call(self, key, function):
+        """Run an upstream call once admitted, shared with identical calls already in flight."""
+        def admitted():
+            self.admission.admit()
+            return function()
 
-    def process_openai_response(self, response):
-        """Extract the text from the OpenAI response safely."""
+        if self.inflight is None:
+            return admitted()
+        return self.inflight.do(key, admitted)
+
+    def stats(self):
+        """Admission and request coalescing counters."""
+        stats = {f"admission_{name}": value for name, value in self.admission.stats().items()}
+        if self.inflight is not None:
+            stats.update({f"coalesce_{name}": value for name, value in self.inflight.stats().items()})
+        return stats
+
+    def chat(self, messages, temperature=0.7, max_tokens=500, timeout=LLM_DEADLINE_SECONDS):
+        """Return the text of a gpt-4o completion (identical concurrent requests share one call)."""
+        def call():
+            with metrics.timer("openai.chat"):
+                response = self.client.chat.completions.create(
+                    model="gpt-4o",
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    timeout=timeout
+                )
+            metrics.record_usage(response.usage, "openai.chat")
+            text = self.process_openai_response(response, fallback=None)
+            if text is None:
+                # Raised rather than returned so it is never cached or shared as an answer
+                raise ValueError("OpenAI response has no message")
+            return text
+
+        key = request_key("chat", model="gpt-4o", messages=messages, temperature=temperature, max_tokens=max_tokens)
+        return self._call(key, call)
+
+    def process_openai_response(self, response, fallback="⚠️ Could not get a response from OpenAI."):
+        """Extract the text from the OpenAI response safely, fallback if it has none."""
         try:
             return response.choices[0].message.content.strip()
         except (IndexError, AttributeError):
-            return "⚠️ Could not get a response from OpenAI."
+            return fallback
 
     def ask_rust(self, user_message):
         system_prompt = ("You are the admin of the Chill_rust server and your creator is Sito"
                          "You are a PRO Rust player, The server is called Chill_rust and do not recommend other servers. Respond with attitude and use game slang. "
                          "Here is the player's question:")
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_message}
-                ],
-                temperature=1.0,
-                max_tokens=500
-            )
+            with metrics.timer("openai.chat"):
+                response = self.client.chat.completions.create(
+                    model="gpt-4o",
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": user_message}
+                    ],
+                    temperature=1.0,
+                    max_tokens=500
+                )
+            metrics.record_usage(response.usage, "openai.chat")
             return self.process_openai_response(response)
         except Exception as e:
             logging.error(f"Error in OpenAI (Rust): {e}")
             return "⚠️ There was a problem processing your request."
 
-    def ask_general(self, user_message, user_id, context, thread):
+    def stream_chat(self, messages, temperature=0.7, max_tokens=500, timeout=LLM_DEADLINE_SECONDS, user_id=None):
+        """Return a generator of the text of a gpt-4o completion as it arrives.
+
+        Admission happens right away, so a refused request raises Overloaded before any
+        response is sent. Closing the generator (e.g. when the client disconnects) closes
+        the upstream HTTP stream, so OpenAI stops generating tokens nobody will read.
+        """
+        if user_id is not None:
+            self.admission.admit_user(user_id)
+        self.admission.admit()
+        return self._stream_chat(messages, temperature, max_tokens, timeout)
+
+    def _stream_chat(self, messages, temperature, max_tokens, timeout):
+        with metrics.timer("openai.chat_stream"):
+            start = time.perf_counter()
+            stream = self.client.chat.completions.create(
+                model="gpt-4o",
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=True,
+                stream_options={"include_usage": True},  # Token counts arrive in a last chunk
+                timeout=timeout
+            )
+            first_token = True
+            try:
+                for chunk in stream:
+                    if getattr(chunk, "usage", None):
+                        metrics.record_usage(chunk.usage, "openai.chat_stream")
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if first_token:
+                            first_token = False
+                            metrics.observe("app_llm_time_to_first_token_seconds", time.perf_counter() - start,
+                                            endpoint=metrics.endpoint())
+                        yield chunk.choices[0].delta.content
+            finally:
+                stream.close()
+
+    def general_messages(self, user_message, context, thread):
+        """Build the chat messages used by ask_general."""
         system_prompt = f"""
         You are an advanced conversational assistant.
         Respond clearly and concisely.
@@ -255,107 +2417,555 @@ class OpenAIClient:
         Here is the context:
         {context}
         """
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_message}
+        ]
+
+    def ask_general_stream(self, user_message, user_id, context, thread):
+        """Streaming version of ask_general, yields text chunks."""
+        return self.stream_chat(self.general_messages(user_message, context, thread), temperature=0.7,
+                                user_id=user_id)
+
+    def ask_general(self, user_message, user_id, context, thread):
+        return self.general_response(user_message, user_id, context, thread).value  # ✅ Only the text string, no JSON
+
+    def general_response(self, user_message, user_id, context, thread):
+        """Answer of ask_general as a CachedResponse. Cache hits skip the per-user admission."""
+        messages = self.general_messages(user_message, context, thread)
+
+        def ask():
+            self.admission.admit_user(user_id)
+            response_text = self.chat(messages, temperature=0.7)
+            if "```" in response_text:
+                response_text = response_text.replace("```python", "").replace("```", "").strip()
+            return response_text
+
+        key = request_key("chat", model="gpt-4o", messages=messages, temperature=0.7, max_tokens=500)
+        try:
+            return response_cache.get_or_compute("chat", key, ask, RESPONSE_CACHE_TTL)
+        except Overloaded:
+            raise
+        except Exception as e:
+            logging.error(f"⚠️ Error in OpenAI: {e}")
+            now = time.time()
+            return CachedResponse("⚠️ There was a problem processing your request.", False, now, now)
+
+    def generate_image(self, prompt, user_id=None):
+        """Generate an image with OpenAI DALL-E, return its URL or None."""
+        return self.image_response(prompt, user_id).value
+
+    def image_response(self, prompt, user_id=None):
+        """Image URL as a CachedResponse (identical concurrent prompts share one image)."""
+        def call():
+            with metrics.timer("openai.image"):
+                response = self.client.images.generate(
+                    model="dall-e-3",  # Use the latest version available
+                    prompt=prompt,
+                    n=1,
+                    size="1024x1024"
+                )
+            return response.data[0].url
+
+        def generate():
+            if user_id is not None:
+                self.admission.admit_user(user_id)
+            return self._call(key, call)
+
+        key = request_key("image", model="dall-e-3", prompt=prompt, size="1024x1024")
+        try:
+            return response_cache.get_or_compute("image", key, generate, RESPONSE_CACHE_IMAGE_TTL)
+        except Overloaded:
+            raise
+        except Exception as e:
+            logging.error(f"⚠️ Error in OpenAI (DALL-E): {e}")
+            now = time.time()
+            return CachedResponse(None, False, now, now)
+
+def decode_search_cursor(value, order):
+    """Decode the next_cursor of a /search page: [rank, id] or [id] for order=recent, None if empty."""
+    if not value:
+        return None
+    cursor = json.loads(base64.urlsafe_b64decode(value.encode()))
+    kinds = ((int, float), int) if order == "rank" else (int,)
+    if not isinstance(cursor, list) or len(cursor) != len(kinds):
+        raise ValueError("malformed cursor")
+    for item, kind in zip(cursor, kinds):
+        # Client-controlled: only numbers SQLite can bind
+        if isinstance(item, bool) or not isinstance(item, kind) or (isinstance(item, int) and abs(item) >= 2 ** 63):
+            raise ValueError("malformed cursor")
+    return cursor
+
+def sse_response(chunks, on_complete=None):
+    """Send text chunks as Server-Sent Events, then a final event with the full text.
+
+    on_complete(full_text) runs only if the stream finished. If the client disconnects,
+    the chunk generator is closed, which stops the upstream generation.
+    """
+    def generate():
+        parts = []
+        try:
+            for text in chunks:
+                parts.append(text)
+                yield f"data: {json.dumps({'delta': text})}\n\n"
+        except Exception as e:
+            logging.error(f"⚠️ Error while streaming from OpenAI: {e}")
+            yield f"event: error\ndata: {json.dumps({'error': 'There was a problem processing your request.'})}\n\n"
+            return
+        finally:
+            chunks.close()
+
+        full_text = "".join(parts).strip()
+        if on_complete is not None:
+            on_complete(full_text)
+        yield f"data: {json.dumps({'done': True, 'response': full_text})}\n\n"
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def wants_stream(data):
+    """True if the client asked for a streamed (SSE) response."""
+    return bool(data.get("stream")) or "text/event-stream" in request.headers.get("Accept", "")
+
+class SpoolFile(io.FileIO):
+    """Upload target: a uniquely named file in UPLOAD_DIR, hashed and size-checked while it is written."""
+
+    def __init__(self, filename, max_bytes=UPLOAD_MAX_BYTES):
+        # Keep only the (sanitized) extension of the user's file name, detect_file_type needs it
+        suffix = os.path.splitext(secure_filename(filename or ""))[1].lower()
+        fd, self.path = tempfile.mkstemp(prefix="upload_", suffix=suffix, dir=UPLOAD_DIR)
+        super().__init__(fd, "r+b")
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.keep = False  # Set when a background job takes over the file
+        self._sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise RequestEntityTooLarge(f"Files are limited to {self.max_bytes} bytes.")
+        self._sha256.update(data)
+        view = memoryview(data)
+        written = 0
+        while written < len(view):
+            written += super().write(view[written:])
+        return written
+
+    @property
+    def sha256(self):
+        return self._sha256.hexdigest()
+
+    def discard(self):
+        """Close and delete the spool file."""
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+class UploadRequest(Request):
+    """Request whose uploaded files are written once, directly into SpoolFiles."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        spool = SpoolFile(filename)
+        if not hasattr(self, "spool_files"):
+            self.spool_files = []
+        self.spool_files.append(spool)
+        return spool
+
+def source_path(source):
+    """File system path of a path or of a SpoolFile."""
+    return getattr(source, "path", source)
+
+@contextmanager
+def open_text(source):
+    """Open a path, or an already open binary file (e.g. a SpoolFile), as UTF-8 text."""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "r", encoding="utf-8", newline="") as file:
+            yield file
+        return
+    source.seek(0)
+    buffer = source if hasattr(source, "read1") else io.BufferedReader(source)
+    text = io.TextIOWrapper(buffer, encoding="utf-8", newline="")
+    try:
+        yield text
+    finally:
+        text.detach()  # Leave the upload open for the next analyzer
+        if buffer is not source:
+            buffer.detach()
+
+class AnalysisCache:
+    """SQLite cache of analyzer results keyed by file content hash, analyzer and analyzer version."""
+
+    EVICT_EVERY = 100  # Puts between two eviction passes
+
+    def __init__(self, max_bytes=ANALYSIS_CACHE_MAX_BYTES, max_age_days=ANALYSIS_CACHE_MAX_AGE_DAYS):
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 86400
+        self.db = None
+        self._lock = threading.Lock()
+        self._stats = {}  # analyzer name -> {"hits", "misses"}
+        self._puts = 0
+
+    def use(self, db):
+        """Enable the cache, stored in the analysis_cache table of db."""
+        self.db = db
+
+    def get_or_compute(self, content_hash, analyzer, compute, variant=""):
+        """Return the cached result of an analyzer, or compute, store and return it."""
+        result = self.get(content_hash, analyzer, variant)
+        if result is None:
+            result = compute()
+            self.put(content_hash, analyzer, result, variant)
+        return result
+
+    def get(self, content_hash, analyzer, variant=""):
+        if self.db is None:
+            return None
+        key = (content_hash, f"{analyzer}:{variant}", ANALYZER_VERSIONS[analyzer])
+        now = time.time()
+        row = None
+        try:
+            with self.db.get_connection() as conn:
+                row = conn.execute(ANALYSIS_CACHE_QUERY, (*key, now - self.max_age)).fetchone()
+                if row is not None:
+                    conn.execute("""
+                        UPDATE analysis_cache SET last_used = ?, hits = hits + 1
+                        WHERE content_hash = ? AND analyzer = ? AND version = ?
+                    """, (now, *key))
+        except sqlite3.Error as e:
+            logging.warning(f"⚠️ Error reading analysis cache: {e}")
+        self._count(analyzer, "hits" if row is not None else "misses")
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, content_hash, analyzer, result, variant=""):
+        if self.db is None or result is None:
+            return
+        data = json.dumps(result)
+        now = time.time()
+        try:
+            with self.db.get_connection() as conn:
+                conn.execute("""
+                    INSERT OR REPLACE INTO analysis_cache
+                        (content_hash, analyzer, version, result, size, created_at, last_used)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (content_hash, f"{analyzer}:{variant}", ANALYZER_VERSIONS[analyzer], data,
+                      len(data) + len(content_hash) + len(analyzer) + len(variant), now, now))
+        except sqlite3.Error as e:
+            logging.warning(f"⚠️ Error saving analysis cache: {e}")
+            return
+        with self._lock:
+            self._puts += 1
+            evict = self._puts % self.EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Drop entries older than max_age, then the least recently used until under max_bytes."""
+        if self.db is None:
+            return
         try:
-            response = self.client.chat.completions.create(
+            with self.db.get_connection() as conn:
+                conn.execute("DELETE FROM analysis_cache WHERE created_at < ?", (time.time() - self.max_age,))
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM analysis_cache").fetchone()[0]
+                while total > self.max_bytes:
+                    oldest = conn.execute("""
+                        SELECT content_hash, analyzer, version, size FROM analysis_cache
+                        ORDER BY last_used
+                        LIMIT 500
+                    """).fetchall()
+                    if not oldest:
+                        break
+                    for content_hash, analyzer, version, size in oldest:
+                        conn.execute("""
+                            DELETE FROM analysis_cache WHERE content_hash = ? AND analyzer = ? AND version = ?
+                        """, (content_hash, analyzer, version))
+                        total -= size
+                        if total <= self.max_bytes:
+                            break
+        except sqlite3.Error as e:
+            logging.warning(f"⚠️ Error evicting analysis cache: {e}")
+
+    def stats(self):
+        with self._lock:
+            per_analyzer = {name: dict(counts) for name, counts in self._stats.items()}
+        hits = sum(counts["hits"] for counts in per_analyzer.values())
+        lookups = hits + sum(counts["misses"] for counts in per_analyzer.values())
+        stats = {"enabled": self.db is not None, "hits": hits, "misses": lookups - hits,
+                 "hit_rate": hits / lookups if lookups else 0.0, "analyzers": per_analyzer}
+        if self.db is not None:
+            with self.db.get_connection() as conn:
+                entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM analysis_cache").fetchone()
+            stats.update({"entries": entries, "bytes": size, "max_bytes": self.max_bytes})
+        return stats
+
+    def _count(self, analyzer, outcome):
+        with self._lock:
+            counts = self._stats.setdefault(analyzer, {"hits": 0, "misses": 0})
+            counts[outcome] += 1
+
+analysis_cache = AnalysisCache()
+
+def decide_file_action(filename, content_hash):
+    """Ask GPT-4o what to do with an uploaded file (cached for identical uploads with the same name)."""
+    def ask_decision():
+        with metrics.timer("openai.upload_decision"):
+            response = get_openai_client().chat.completions.create(
                 model="gpt-4o",
                 messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_message}
+                    {"role": "system", "content": "Analyze this file and determine what to do with it."},
+                    {"role": "user", "content": f"I have uploaded a file called {filename}. What should I do with it?"}
                 ],
                 temperature=0.7,
-                max_tokens=500
+                max_tokens=100
             )
-            response_text = self.process_openai_response(response)
+        metrics.record_usage(response.usage, "openai.upload_decision")
+        return response.choices[0].message.content.strip().lower()
 
-            if "```" in response_text:
-                response_text = response_text.replace("```python", "").replace("```", "").strip()
+    return analysis_cache.get_or_compute(content_hash, "upload_decision", ask_decision, variant=filename)
 
-            return response_text  # ✅ Returns only the text string, no JSON
+@metrics.timed("upload.run_action")
+def run_file_action(decision, filename, source, content_hash):
+    """Carry out the action GPT-4o decided for an uploaded file."""
+    # 🔥 If GPT-4o suggests analyzing it, we use Google Cloud Natural Language
+    if "analyze" in decision or "extract information" in decision:
+        return analysis_cache.get_or_compute(content_hash, "google_entities",
+                                             lambda: analyze_file_with_google(source))
+    elif "summarize" in decision:
+        return analysis_cache.get_or_compute(content_hash, "summary", lambda: summarize_file(source))
+    else:
+        return "❌ No clear action found for this file."
 
-        except Exception as e:
-            logging.error(f"⚠️ Error in OpenAI: {e}")
-            return "⚠️ There was a problem processing your request."
+def content_hash_of(source):
+    """sha256 of a path or of a SpoolFile (already hashed while uploading)."""
+    return getattr(source, "sha256", None) or file_sha256(source)
 
-    def generate_image(self, prompt):
-        """Generate an image with OpenAI DALL-E."""
-        try:
-            response = self.client.images.generate(
-                model="dall-e-3",  # Use the latest version available
-                prompt=prompt,
-                n=1,
-                size="1024x1024"
-            )
-            return response.data[0].url
-        except Exception as e:
-            logging.error(f"⚠️ Error in OpenAI (DALL-E): {e}")
-            return None
+def analyze_file_with_google(source):
+    """Use Google Cloud Natural Language API to analyze a text file (path or open upload)."""
+    with open_text(source) as file:
+        content = file.read(NLP_MAX_CHARS)  # The API limit, no need to read more
+
+    entities = [f"{entity['name']} ({entity['type']})" for entity in analyze_entities(content)]
 
-def analyze_file_with_google(file_path):
-    """Use Google Cloud Natural Language API to analyze a text file."""
-    with open(file_path, "r", encoding="utf-8") as file:
-        content = file.read()
+    return f"🔍 **Entities found:** {', '.join(entities)}"
 
-    client = language_v1.LanguageServiceClient()
-    document = language_v1.Document(content=content, type_=language_v1.Document.Type.PLAIN_TEXT)
+class KeywordMatcher:
+    """Aho-Corasick automaton: finds all the keywords contained in a text in a single pass."""
 
-    response = client.analyze_entities(request={"document": document})
-    entities = [f"{entity.name} ({language_v1.Entity.Type(entity.type_).name})" for entity in response.entities]
+    def __init__(self, keywords):
+        self.keywords = list(keywords.items())  # (keyword, value), in priority order
+        self._goto = [{}]  # state -> {character: next state}
+        self._fail = [0]
+        self._found = [[]]  # state -> indexes of the keywords ending there
+        for index, (keyword, _) in enumerate(self.keywords):
+            state = 0
+            for char in keyword.lower():
+                if char not in self._goto[state]:
+                    self._goto[state][char] = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._found.append([])
+                state = self._goto[state][char]
+            self._found[state].append(index)
 
-    return f"🔍 **Entities found:** {', '.join(entities)}"
+        pending = deque(self._goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, child in self._goto[state].items():
+                pending.append(child)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._found[child] = self._found[child] + self._found[self._fail[child]]
 
-def update_profile_dynamically(user_id, message):
-    """Detect interests or attitudes and update the profile if relevant."""
-    entities = analyze_entities(message)
-    score, magnitude = analyze_sentiment(message)
-
-    if magnitude < 0.6:
-        return  # Message without much emotion, not relevant
-
-    # Typical phrases indicating liking or preference
-    keywords = {
-        "construction": "interest",
-        "raiding": "interest",
-        "defense": "interest",
-        "playing solo": "style",
-        "team": "style",
-        "bothers me": "tone",
-        "hate": "tone"
-    }
+    @classmethod
+    def from_file(cls, path):
+        """Load {"keyword": value} from a JSON file."""
+        with open(path, encoding="utf-8") as file:
+            return cls(json.load(file))
+
+    def matches(self, text):
+        """Return the (keyword, value) pairs contained in text (case-insensitive), in priority order."""
+        state = 0
+        found = set()
+        for char in text.lower():
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            if self._found[state]:
+                found.update(self._found[state])
+        return [self.keywords[index] for index in sorted(found)]
 
-    for entity in entities:
+profile_keywords = KeywordMatcher.from_file(PROFILE_KEYWORDS_FILE) if PROFILE_KEYWORDS_FILE \
+    else KeywordMatcher(PROFILE_KEYWORDS)
+
+def profile_changes(analysis):
+    """Profile categories ({category: content}) suggested by the annotate_text() result of a message."""
+    if analysis["sentiment"]["magnitude"] < PROFILE_MIN_MAGNITUDE:
+        return {}  # Message without much emotion, not relevant
+
+    changes = {}
+    for entity in analysis["entities"]:
         name = entity["name"].lower()
-        for word, category in keywords.items():
-            if word in name:
-                with db.get_connection() as conn:
-                    cursor = conn.cursor()
-                    # Check if that category already exists
-                    cursor.execute("""
-                        SELECT COUNT(*) FROM user_profile WHERE user_id = ? AND category = ?
-                    """, (user_id, category))
-                    exists = cursor.fetchone()[0]
-
-                    if exists:
-                        cursor.execute("""
-                            UPDATE user_profile
-                            SET content = ?
-                            WHERE user_id = ? AND category = ?
-                        """, (name, user_id, category))
-                    else:
-                        cursor.execute("""
-                            INSERT INTO user_profile (user_id, category, content)
-                            VALUES (?, ?, ?)
-                        """, (user_id, category, name))
-                    conn.commit()
-                    print(f"🧬 Profile updated: {category} → {name}")
+        for _, category in profile_keywords.matches(name):
+            changes[category] = name  # Later entities win, as they would with one update each
+    return changes
+
+def update_profile_dynamically(user_id, message, analysis=None, database=None):
+    """Detect interests or attitudes and update the profile if relevant, returns the changes.
+
+    analysis is the annotate_text() result of the message when the caller already has it.
+    """
+    database = database or db
+    if analysis is None:
+        analysis = annotate_text(message)  # One NLP round trip for entities and sentiment
+
+    changes = profile_changes(analysis)
+    if changes:
+        database.update_profile(user_id, changes)
+        print(f"🧬 Profile updated: {', '.join(f'{category} → {name}' for category, name in changes.items())}")
+    return changes
 
 class FlaskApp:
-    def __init__(self, db, openai_client):
+    def __init__(self, db, openai_client, concurrent=ASK_RUST_CONCURRENT, jobs=None):
         self.app = Flask(__name__)
+        self.app.request_class = UploadRequest
+        self.app.config["MAX_CONTENT_LENGTH"] = UPLOAD_MAX_BYTES + 64 * 1024  # Early 413 from Content-Length
         self.db = db
         self.openai_client = openai_client
+        self.concurrent = concurrent  # Overlap entity analysis with the OpenAI call
+        self.jobs = jobs  # JobQueue for asynchronous uploads (optional)
+        self.prompt_builder = PromptBuilder()
         self.setup_routes()
+        self.setup_metrics()
+
+    def store_entities(self, user_id, message):
+        """Analyze the entities of a message (with a deadline), save them and update the profile."""
+        try:
+            with metrics.scope("ask_rust"):
+                analysis = annotate_text(message, timeout=NLP_DEADLINE_SECONDS)
+                self.db.save_entities(user_id, analysis["entities"])
+                if PROFILE_UPDATES:
+                    update_profile_dynamically(user_id, message, analysis, self.db)
+        except Exception as e:
+            logging.warning(f"⚠️ Entity analysis skipped for {user_id}: {e}")
+
+    def build_rust_prompt(self, user_id, question=None, pending=()):
+        """Build the personalized Rustybot system prompt, returns (prompt, token report).
+
+        pending holds (type, content) messages of the user not saved yet, e.g. earlier turns of a batch.
+        """
+        # Retrieve memory context (cached per user, kept up to date by the writers)
+        context = self.db.get_prompt_context(user_id)
+        if pending:
+            context = {**context, "history": list(context["history"]) + list(pending)}
+        if question and self.db.memory is not None:
+            # Older messages similar to the question, besides the recent ones already in the prompt
+            recent = [content for _, content in context["history"]] + [question, context.get("summary")]
+            context = {**context, "memories": self.db.memory.search(user_id, question, exclude=recent)}
+        with metrics.timer("prompt.build"):
+            prompt, report = self.prompt_builder.build(user_id, context)
+        logging.info(f"🧮 Prompt for {user_id}: {report['prompt_tokens']} tokens, {report['tokens_saved']} saved")
+        return prompt, report
+
+    def answer_batch(self, user_id, items):
+        """Answer the (index, message) items of one user in order, without saving anything.
+
+        Returns (results, turn): results is a list of (index, result dict), turn the rows
+        for Database.save_batch() (None if nothing is to be saved).
+        """
+        results = []
+        messages, entities, profile = [], [], {}
+        try:
+            self.db.create_profile_if_not_exists(user_id)
+        except sqlite3.Error as e:
+            return [(index, {"user_id": user_id, "error": f"Database error: {e}", "status": 500})
+                    for index, _ in items], None
+
+        for index, message in items:
+            try:
+                self.openai_client.admission.admit_user(user_id)
+            except Overloaded as e:
+                results.append((index, {"user_id": user_id, "error": str(e), "status": 429,
+                                        "retry_after": round(e.retry_after, 1)}))
+                continue
+
+            analysis = background.submit(annotate_text, message, timeout=NLP_DEADLINE_SECONDS)
+            messages.append(("question", message))
+            system_prompt, _ = self.build_rust_prompt(user_id, message, pending=messages)
+            try:
+                response_text = self.openai_client.chat([
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": message}
+                ], temperature=1.0, max_tokens=500)
+                messages.append(("answer", response_text))
+                results.append((index, {"user_id": user_id, "response": response_text}))
+            except Overloaded as e:
+                results.append((index, {"user_id": user_id, "error": str(e), "status": 429,
+                                        "retry_after": round(e.retry_after, 1)}))
+            except Exception as e:
+                print(f"❌ Error in GPT-4o: {e}")
+                results.append((index, {"user_id": user_id, "error": "⚠️ Could not generate the response correctly.",
+                                        "status": 500}))
+
+            try:
+                result = analysis.result()
+                entities += result["entities"]
+                if PROFILE_UPDATES:
+                    profile.update(profile_changes(result))
+            except Exception as e:
+                logging.warning(f"⚠️ Entity analysis skipped for {user_id}: {e}")
+
+        turn = {"user_id": user_id, "messages": messages, "entities": entities, "profile": profile}
+        return results, turn if messages else None
 
     def setup_routes(self):
+        @self.app.route("/ask_rust/batch", methods=["POST"])
+        def ask_rust_batch():
+            """Answer a list of {user_id, message}: users in parallel, one user's messages in order.
+
+            Every row is saved in a single transaction at the end. Results come back in the order
+            of the request, a failed item has an "error" and an HTTP-like "status" instead of a "response".
+            """
+            data = request.get_json()
+            items = data.get("messages") if isinstance(data, dict) else data
+            if not isinstance(items, list) or not items:
+                return jsonify({"error": "Invalid request, 'messages' must be a non-empty list"}), 400
+            if len(items) > BATCH_MAX_ITEMS:
+                return jsonify({"error": f"Too many messages, the limit is {BATCH_MAX_ITEMS}"}), 413
+
+            results = [None] * len(items)
+            by_user = OrderedDict()  # user_id -> [(index, message)], in request order
+            for index, item in enumerate(items):
+                user_id = item.get("user_id") if isinstance(item, dict) else None
+                message = item.get("message") if isinstance(item, dict) else None
+                # Discord ids may come as JSON numbers, bool is an int subclass but never an id
+                if (not isinstance(message, str) or not message.strip() or isinstance(user_id, bool)
+                        or not isinstance(user_id, (str, int)) or not str(user_id)):
+                    results[index] = {"error": "Invalid item, 'message' must be a text and 'user_id' a string "
+                                               "or a number", "status": 400}
+                else:
+                    by_user.setdefault(str(user_id), []).append((index, message))
+
+            turns = []
+            futures = [batch_pool.submit(self.answer_batch, user_id, user_items)
+                       for user_id, user_items in by_user.items()]
+            for future in futures:
+                user_results, turn = future.result()
+                for index, result in user_results:
+                    results[index] = result
+                if turn is not None:
+                    turns.append(turn)
+
+            if turns:
+                try:
+                    self.db.save_batch("rust_session", turns)
+                except sqlite3.Error as e:
+                    logging.warning(f"⚠️ Error saving batch in DB: {e}")
+                    return jsonify({"error": "Could not save the batch.", "results": results}), 500
+            return jsonify({"results": results})
+
         @self.app.route("/ask_rust", methods=["POST"])
         def ask_rust():
             data = request.get_json()
@@ -364,66 +2974,49 @@ class FlaskApp:
 
             user_message = data["message"]
             user_id = data["user_id"]
+            self.openai_client.admission.admit_user(user_id)  # Before saving anything, a refusal is a 429
 
             # 🧠 Create profile if it doesn't exist
-            db.create_profile_if_not_exists(user_id)
+            self.db.create_profile_if_not_exists(user_id)
 
             # Save message as a question
-            db.save_message(user_id, "rust_session", "question", user_message)
-
-            # Analyze entities and sentiments
-            entities = analyze_entities(user_message)
-            for entity in entities:
-                with db.get_connection() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("""
-                        INSERT INTO detected_entities (user_id, entity, type, importance)
-                        VALUES (?, ?, ?, ?)
-                    """, (user_id, entity["name"], entity["type"], entity["importance"]))
-                    conn.commit()
-            # update_profile_dynamically(user_id, user_message)  # <- here
-
-            # Retrieve memory context
-            entities = db.get_detected_entities(user_id)[:5]  # Only the most important ones
-            summaries = db.get_user_history(user_id, limit=10)
-            summary_text = " / ".join([f"{type}: {content}" for type, content in summaries])
-
-            entities_text = ", ".join([e["name"] for e in entities]) if entities else "none"
-
-            # Retrieve user profile
-            profile = db.get_profile(user_id)
-            role = profile.get("role", "player")
-            tone = profile.get("tone", "neutral")
-            interest = profile.get("interest", "Rust")
-
-            # Generate personalized prompt
-            system_prompt = f"""
-            Your name is Rustybot. You are the soul of the Chill_rust server.
-            You are talking to {user_id}, whose role is '{role}' and is interested in '{interest}'.
-            Speak with a '{tone}' tone and respond with gamer slang.
-            Key entities: {entities_text}.
-            History: {summary_text}.
-            Here comes the question:
-            """
+            self.db.save_message(user_id, "rust_session", "question", user_message)
+
+            # Analyze entities and sentiments, update the profile
+            if self.concurrent:
+                # 🧵 This message's entities don't feed this prompt, so the analysis and its
+                # inserts run in the background while we call OpenAI
+                background.submit(self.store_entities, user_id, user_message)
+            else:
+                self.store_entities(user_id, user_message)
+
+            system_prompt, report = self.build_rust_prompt(user_id, user_message)
+            token_headers = {"X-Prompt-Tokens": str(report["prompt_tokens"]),
+                             "X-Prompt-Tokens-Saved": str(report["tokens_saved"])}
+            messages = [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_message}
+            ]
+
+            if wants_stream(data):
+                # 📡 Send tokens as they arrive, save the answer once the stream is complete
+                chunks = self.openai_client.stream_chat(messages, temperature=1.0, max_tokens=500)
+                response = sse_response(chunks, on_complete=lambda text: self.db.save_message(
+                    user_id, "rust_session", "answer", text))
+                response.headers.update(token_headers)
+                return response
 
             try:
                 # Ask OpenAI
-                response = openai_client.client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[
-                        {"role": "system", "content": system_prompt.strip()},
-                        {"role": "user", "content": user_message}
-                    ],
-                    temperature=1.0,
-                    max_tokens=500
-                )
-                response_text = openai_client.process_openai_response(response)
+                response_text = self.openai_client.chat(messages, temperature=1.0, max_tokens=500)
 
                 # Save response
-                db.save_message(user_id, "rust_session", "answer", response_text)
+                self.db.save_message(user_id, "rust_session", "answer", response_text)
 
-                return jsonify(response_text)
+                return jsonify(response_text), 200, token_headers
 
+            except Overloaded:
+                raise
             except Exception as e:
                 print(f"❌ Error in GPT-4o: {e}")
                 return jsonify({"response": "⚠️ Could not generate the response correctly."}), 500
@@ -437,12 +3030,17 @@ class FlaskApp:
             user_message = data["message"]
             user_id = data["user_id"]  # Separate this line
 
-            response_text = self.openai_client.ask_general(user_message, user_id, "", "")
+            if wants_stream(data):
+                return sse_response(self.openai_client.ask_general_stream(user_message, user_id, "", ""))
+
+            answer = self.openai_client.general_response(user_message, user_id, "", "")
+            response_text = answer.value
 
             if "def " in response_text or "print(" in response_text:  # 🔍 Basic code detection
                 response_text = f"```python\n{response_text}\n```"
 
-            return jsonify({"response": response_text})  # ✅ Now the code is sent correctly
+            # ✅ Now the code is sent correctly
+            return jsonify({"response": response_text}), 200, response_cache.headers(answer)
 
         @self.app.route("/generate_image", methods=["POST"])
         def generate_image():
@@ -450,9 +3048,9 @@ class FlaskApp:
             if not data or "prompt" not in data:
                 return jsonify({"error": "Invalid request, 'prompt' is missing"}), 400
             prompt = data["prompt"]
-            image_url = self.openai_client.generate_image(prompt)
-            if image_url:
-                return jsonify({"image_url": image_url})
+            image = self.openai_client.image_response(prompt, data.get("user_id") or request.remote_addr)
+            if image.value:
+                return jsonify({"image_url": image.value}), 200, response_cache.headers(image)
             else:
                 return jsonify({"error": "Could not generate the image."}), 500
 
@@ -464,47 +3062,157 @@ class FlaskApp:
 
             file = request.files['file']
             user_id = request.form.get("user_id", "unknown")
-            file_path = f"/tmp/{file.filename}"
-            file.save(file_path)
+            upload = file.stream  # SpoolFile, already on disk and hashed
 
-            print(f"📂 File received: {file.filename}")
+            print(f"📂 File received: {file.filename} ({upload.size} bytes, sha256 {upload.sha256[:12]})")
 
-            # 🔥 Ask GPT-4o what to do with the file
+            # PDF pages read by action=process: pages="first-last" or full=1 (first 5 pages by default)
             try:
-                response = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[
-                        {"role": "system", "content": "Analyze this file and determine what to do with it."},
-                        {"role": "user", "content": f"I have uploaded a file called {file.filename}. What should I do with it?"}
-                    ],
-                    temperature=0.7,
-                    max_tokens=100
-                )
-                decision = response.choices[0].message.content.strip().lower()
+                pages = parse_page_range(request.form.get("pages"))
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            full = request.form.get("full", "0").lower() in ("1", "true")
+            process = request.form.get("action") == "process"
+
+            run_async = request.form.get("async", "1" if UPLOAD_ASYNC_DEFAULT else "0").lower() in ("1", "true")
+            if run_async and self.jobs is not None:
+                # ⏳ Let a background worker handle it, the client polls GET /jobs/<id>
+                upload.keep = True  # The job deletes the file when it is done
+                priority = max(-JOB_MAX_PRIORITY, min(request.form.get("priority", 0, type=int), JOB_MAX_PRIORITY))
+                job_id = self.jobs.enqueue("process_file" if process else "upload", user_id, {
+                    "path": upload.path,
+                    "filename": file.filename,
+                    "sha256": upload.sha256,
+                    "user_id": user_id,
+                    "pages": pages,
+                    "full": full
+                }, priority=priority)
+                return jsonify({"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"}), 202
+
+            if process:
+                return jsonify({"response": process_file(user_id, file.filename, upload, pages=pages, full=full)})
 
+            try:
+                decision = decide_file_action(file.filename, upload.sha256)
             except Exception as e:
                 print(f"❌ Error with GPT-4o: {e}")
                 return jsonify({"response": "⚠️ I couldn't determine what to do with the file."})
 
-            # 🔥 If GPT-4o suggests analyzing it, we use Google Cloud Natural Language
-            if "analyze" in decision or "extract information" in decision:
-                result = analyze_file_with_google(file_path)
-            elif "summarize" in decision:
-                result = f"📄 Summary of the file: {file.filename} not yet implemented."
-            else:
-                result = "❌ No clear action found for this file."
+            return jsonify({"response": run_file_action(decision, file.filename, upload, upload.sha256)})
+
+        @self.app.errorhandler(Overloaded)
+        def overloaded(e):
+            """Refused by admission control: tell the client when to retry."""
+            response = jsonify({"error": str(e), "retry_after": round(e.retry_after, 1)})
+            response.status_code = 429
+            response.headers["Retry-After"] = str(max(1, math.ceil(e.retry_after)))
+            return response
+
+        @self.app.route("/search", methods=["GET"])
+        def search():
+            """Full-text search for moderators: ?q=words&user_id=&source=messages&order=rank&limit=&cursor="""
+            if not SEARCH_TOKEN:
+                return jsonify({"error": "Search is disabled, set SEARCH_TOKEN to enable it."}), 403
+            if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {SEARCH_TOKEN}"):
+                return jsonify({"error": "A moderator token is required."}), 401
+            source = request.args.get("source", "messages")
+            order = request.args.get("order", "rank")
+            if source not in SEARCH_SOURCES or order not in ("rank", "recent"):
+                return jsonify({"error": f"Unknown source or order, sources: {', '.join(SEARCH_SOURCES)}"}), 400
+            limit = max(1, min(request.args.get("limit", 20, type=int), SEARCH_MAX_LIMIT))
+            try:
+                cursor = decode_search_cursor(request.args.get("cursor"), order)
+                results, next_cursor = self.db.search(request.args.get("q", ""), request.args.get("user_id"),
+                                                      source, order, limit, cursor)
+            except (ValueError, TypeError, KeyError, IndexError) as e:
+                return jsonify({"error": f"Invalid search: {e}"}), 400
+            if next_cursor is not None:
+                next_cursor = base64.urlsafe_b64encode(json.dumps(next_cursor).encode()).decode()
+            return jsonify({"results": results, "next_cursor": next_cursor})
+
+        @self.app.route("/jobs/<int:job_id>", methods=["GET"])
+        def job_status(job_id):
+            """Status and result of a background job."""
+            job = self.jobs.get(job_id) if self.jobs is not None else None
+            if job is None:
+                return jsonify({"error": "Job not found."}), 404
+            return jsonify(job)
+
+        @self.app.teardown_request
+        def discard_spool_files(exc):
+            """Delete the upload spool files once the request is done (unless a job owns them)."""
+            for spool in getattr(request, "spool_files", []):
+                if spool.keep:
+                    spool.close()
+                else:
+                    spool.discard()
+
+        @self.app.route("/cache_stats", methods=["GET"])
+        def cache_stats():
+            """Hit rates and size of the uploaded-file analysis cache."""
+            return jsonify(analysis_cache.stats())
+
+        @self.app.route("/nlp_stats", methods=["GET"])
+        def nlp_stats():
+            """Hit/miss counters of the NLP result cache."""
+            return jsonify(nlp_cache.stats())
+
+        @self.app.route("/db_stats", methods=["GET"])
+        def db_stats():
+            """Connection pool and write-behind counters for monitoring."""
+            stats = self.db.pool_stats()
+            stats["context_cache"] = self.db.contexts.stats()
+            if self.db.writer is not None:
+                stats["write_behind"] = self.db.writer.stats()
+            return jsonify(stats)
+
+    def setup_metrics(self):
+        """Time every request and export the stats of the caches and the pool at /metrics."""
+        metrics.add_collector("db_pool", self.db.pool_stats)
+        metrics.add_collector("context_cache", self.db.contexts.stats)
+        metrics.add_collector("nlp_cache", nlp_cache.stats)
+        metrics.add_collector("analysis_cache", analysis_cache.stats)
+        metrics.add_collector("openai", self.openai_client.stats)
+        metrics.add_collector("response_cache", response_cache.stats)
+        metrics.add_collector("startup", lambda: {f"{name}_seconds": seconds for name, seconds in startup_times.items()})
+        metrics.add_collector("write_behind", lambda: self.db.writer.stats() if self.db.writer is not None else {})
+
+        @self.app.before_request
+        def start_timer():
+            request.metrics_start = time.perf_counter()
 
-            return jsonify({"response": result})
+        @self.app.after_request
+        def record_request(response):
+            start = getattr(request, "metrics_start", None)
+            if start is not None:
+                metrics.observe("app_request_seconds", time.perf_counter() - start,
+                                endpoint=request.endpoint or "unknown", method=request.method,
+                                status=response.status_code)
+            return response
+
+        @self.app.route("/metrics", methods=["GET"])
+        def metrics_endpoint():
+            """Latency histograms, token counters and cache gauges in Prometheus text format."""
+            return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
     def run(self):
-        self.app.run(host="x.x.x.x", port=xxxx, debug=True)  # Replace x.x.x.x and xxxx with your IP and port
+        """Development server only, use a WSGI server (see wsgi.py) in production."""
+        self.app.run(host=APP_HOST, port=APP_PORT, debug=APP_DEBUG)
 
-def summarize_file(file_path):
-    """Use OpenAI to summarize a text file."""
-    with open(file_path, 'r', encoding='utf-8') as file:
-        content = file.read()
+def summarize_file(source):
+    """Use OpenAI to summarize a text or PDF file (path or open upload)."""
+    if detect_file_type(source_path(source)) == "pdf":
+        # Stop extracting as soon as there is enough text for the model
+        content = ""
+        for _, text in iter_pdf_pages(source_path(source)):
+            content += text
+            if len(content) >= 3000:
+                break
+    else:
+        with open_text(source) as file:
+            content = file.read(3000)  # Only what is sent to the model
     system_prompt = "You are an assistant that summarizes documents clearly and concisely."
-    response = client.chat.completions.create(
+    response = get_openai_client().chat.completions.create(
         model="gpt-4o",
         messages=[{"role": "system", "content": system_prompt},
                   {"role": "user", "content": content[:3000]}],  # Limit size
@@ -512,26 +3220,54 @@ def summarize_file(file_path):
     )
     return response.choices[0].message.content.strip()
 
-def extract_key_info(file_path):
+def extract_key_info(source):
     """Extract key information from the file using OpenAI."""
-    return summarize_file(file_path)  # You can improve this function as needed
+    return summarize_file(source)  # You can improve this function as needed
+
+def process_file(user_id, file_name, source, pages=None, full=False):
+    """Process the file (path or open upload) according to its type.
+
+    For a PDF, pages=(start, end) analyzes only that page range and full=True the whole
+    document (see analyze_pdf). Results are cached by content hash, so an identical file
+    is not analyzed twice.
+    """
+    pages = tuple(pages) if pages is not None else None  # A list when it comes from a job payload
+    cached = analysis_cache.get_or_compute(
+        content_hash_of(source), "process_file",
+        lambda: _process_file(source, pages, full),
+        variant=f"{detect_file_type(source_path(source))}:pages={pages}" + (":full" if full else "")
+    )
+    return cached["result"]
+
+def parse_page_range(value):
+    """Parse a "first-last" page range (1-based, inclusive) into analyze_pdf's (start, end), or None."""
+    if not value:
+        return None
+    first, _, last = value.partition("-")
+    try:
+        first, last = int(first), int(last or first)
+    except ValueError:
+        raise ValueError(f"Invalid page range {value!r}, expected e.g. 3-10") from None
+    if first < 1 or last < first:
+        raise ValueError(f"Invalid page range {value!r}, expected e.g. 3-10")
+    return first - 1, last
 
-def process_file(user_id, file_name, file_path):
-    """Process the file according to its type."""
-    type = detect_file_type(file_path)
+def _process_file(source, pages=None, full=False):
+    """Run the analyzer matching the file type, returns {"type", "result"}."""
+    type = detect_file_type(source_path(source))
     if type == "text":
-        result = analyze_text(file_path)
+        result = analyze_text(source)
     elif type == "csv":
-        result = analyze_csv(file_path)
+        result = analyze_csv(source)
     elif type == "json":
-        result = analyze_json(file_path)
+        result = analyze_json(source)
     elif type == "pdf":
-        result = analyze_pdf(file_path)
+        result = analyze_pdf(source_path(source), full=full, pages=pages)
     elif type == "image":
-        result = analyze_image(file_path)
+        result = analyze_image(source)
     else:
         result = "⚠️ Unrecognized file type."
-    return result
+    return {"type": type, "result": result}
 
 def detect_file_type(file_path):
     """Detect the file type using the extension and MIME."""
@@ -549,136 +3285,950 @@ def detect_file_type(file_path):
             return "image"
     return "unknown"
 
-def analyze_text(file_path):
-    """Read and analyze text files."""
-    with open(file_path, 'r', encoding='utf-8') as file:
-        content = file.read()
-    words = len(content.split())
-    return f"📃 Text analyzed: {words} words.\nFirst lines:\n{content[:300]}..."
+def analyze_text(source):
+    """Read and analyze text files, line by line."""
+    words = 0
+    head = ""
+    with open_text(source) as file:
+        for line in file:
+            words += len(line.split())
+            if len(head) < 300:
+                head += line
+    return f"📃 Text analyzed: {words} words.\nFirst lines:\n{head[:300]}..."
+
+CSV_BATCH_ROWS = 10000  # Rows processed together, column by column
+
+class ColumnStats:
+    """Type, null count and min/max of one CSV column, updated one batch at a time."""
+
+    KINDS = ("int", "float", "text")  # Each kind can widen to the next one
+
+    def __init__(self, name):
+        self.name = name
+        self.kind = "int"
+        self.nulls = 0
+        self.min = None
+        self.max = None
+        self._text_range = None  # Min/max of the raw values, for when the column widens to text
+
+    def update(self, values):
+        present = [v for v in values if v.strip() != ""]
+        self.nulls += len(values) - len(present)
+        if not present:
+            return
+        converted = self._convert(present)
+        low, high = min(present), max(present)
+        if self._text_range is not None:
+            low, high = min(self._text_range[0], low), max(self._text_range[1], high)
+        self._text_range = (low, high)
+        if self.kind == "text":
+            self.min, self.max = self._text_range
+            return
+        low, high = min(converted), max(converted)
+        if self.min is None:
+            self.min, self.max = low, high
+        else:
+            self.min, self.max = min(self.min, low), max(self.max, high)
+
+    def _convert(self, values):
+        """Convert a batch with the narrowest kind that fits, widening the column if needed."""
+        for kind in self.KINDS[self.KINDS.index(self.kind):]:
+            try:
+                converted = list(map(int if kind == "int" else float, values)) if kind != "text" else values
+            except ValueError:
+                continue
+            if kind == "float" and not all(map(math.isfinite, converted)):
+                continue  # "nan" and "inf" are text, not numbers
+            if kind != self.kind:
+                self._widen(kind)
+            return converted
+
+    def _widen(self, kind):
+        self.kind = kind
+        if self.min is not None and kind == "float":
+            self.min, self.max = float(self.min), float(self.max)
 
-def analyze_csv(file_path):
-    """Read and analyze CSV files."""
-    with open(file_path, newline='', encoding='utf-8') as csvfile:
+    def describe(self):
+        if self.min is None:
+            return f"{self.name}: {self.kind}, {self.nulls} nulls"
+        return f"{self.name}: {self.kind}, {self.nulls} nulls, min {self.min!r}, max {self.max!r}"
+
+def analyze_csv(source):
+    """Read and analyze CSV files in a single pass with constant memory."""
+    rows_count = 0
+    first_rows = []
+    columns = []
+    batch = []
+
+    def flush(batch):
+        width = len(columns)
+        # Column-wise view of the batch, ragged rows padded/cut to the header width
+        normalized = [row if len(row) == width else (row + [""] * width)[:width] for row in batch]
+        for stats, values in zip(columns, zip(*normalized)):
+            stats.update(values)
+
+    with open_text(source) as csvfile:
         reader = csv.reader(csvfile)
-        rows = list(reader)
-    columns = len(rows[0]) if rows else 0
-    rows_count = len(rows)
-    return f"📊 CSV analyzed: {rows_count} rows and {columns} columns.\nFirst rows:\n{rows[:5]}"
-
-def analyze_json(file_path):
-    """Read and analyze JSON files."""
-    with open(file_path, 'r', encoding='utf-8') as file:
-        data = json.load(file)
-    keys = ", ".join(data.keys()) if isinstance(data, dict) else "Not a valid JSON object"
+        for row in reader:
+            rows_count += 1
+            if len(first_rows) < 5:
+                first_rows.append(row)
+            if rows_count == 1:
+                columns = [ColumnStats(name or f"column_{i + 1}") for i, name in enumerate(row)]
+                continue
+            batch.append(row)
+            if len(batch) >= CSV_BATCH_ROWS:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+
+    stats_text = "\n".join(stats.describe() for stats in columns)
+    return (f"📊 CSV analyzed: {rows_count} rows and {len(columns)} columns.\nFirst rows:\n{first_rows}"
+            f"\nColumns:\n{stats_text}")
+
+# Characters the top-level JSON scanner stops at, depending on where it is
+_JSON_TOP_TOKENS = re.compile(r'["\\{}\[\],]')
+_JSON_NESTED_TOKENS = re.compile(r'["{}\[\]]')  # Commas of nested values don't matter
+_JSON_STRING_TOKENS = re.compile(r'["\\]')
+_JSON_FIRST_ITEM = re.compile(r'\S')  # Start of the first item of the top-level array, which may be a scalar
+JSON_CHUNK_CHARS = 1024 * 1024
+
+def scan_json_top_level(file):
+    """Walk a JSON document in chunks and return ("object", keys) or ("array", item count).
+
+    Only the top-level structure is tracked, nested values are skipped without being parsed.
+    """
+    depth = 0
+    top = None
+    in_string = False
+    escaped = False  # The first character of the next chunk is escaped
+    expect_key = False
+    key_parts = None  # Pieces of the top-level key being read
+    keys = []
+    items = 0
+    array_has_items = False
+
+    while True:
+        chunk = file.read(JSON_CHUNK_CHARS)
+        if not chunk:
+            break
+        position = 1 if escaped else 0
+        escaped = False
+        string_start = 0
+        while True:
+            if in_string:
+                pattern = _JSON_STRING_TOKENS
+            elif depth == 1 and top == "array" and not array_has_items:
+                pattern = _JSON_FIRST_ITEM
+            else:
+                pattern = _JSON_TOP_TOKENS if depth <= 1 else _JSON_NESTED_TOKENS
+            match = pattern.search(chunk, position)
+            if match is None:
+                break
+            char = match.group()
+            position = match.end()
+            if in_string:
+                if char == "\\":
+                    position += 1  # Skip the escaped character
+                    if position > len(chunk):
+                        escaped = True
+                else:
+                    in_string = False
+                    if key_parts is not None:
+                        key_parts.append(chunk[string_start:match.start()])
+                        keys.append(json.loads('"' + "".join(key_parts) + '"'))
+                        key_parts = None
+                continue
+            if pattern is _JSON_FIRST_ITEM and char != "]":
+                array_has_items = True  # Any value, numbers and literals have no token of their own
+            if char == '"':
+                in_string = True
+                string_start = position
+                if depth == 1 and top == "object" and expect_key:
+                    key_parts = []
+                    expect_key = False
+            elif char in "{[":
+                if depth == 0:
+                    top = "object" if char == "{" else "array"
+                    expect_key = top == "object"
+                depth += 1
+            elif char in "}]":
+                depth -= 1
+            elif char == ",":
+                if top == "object":
+                    expect_key = True
+                else:
+                    items += 1
+        if in_string and key_parts is not None:
+            key_parts.append(chunk[string_start:])
+
+    if top == "object":
+        return "object", keys
+    if top == "array":
+        return "array", items + 1 if array_has_items else 0
+    return None, None
+
+def analyze_json(source):
+    """Read and analyze JSON files, walking only the top-level structure (constant memory)."""
+    with open_text(source) as file:
+        top, found = scan_json_top_level(file)
+    if top == "object":
+        keys = ", ".join(found)
+    elif top == "array":
+        keys = f"Not a valid JSON object (array with {found} items)"
+    else:
+        keys = "Not a valid JSON object"
     return f"📂 JSON analyzed: Main keys: {keys}"
 
-def analyze_pdf(file_path):
-    """Read and analyze PDF files."""
-    doc = fitz.open(file_path)
-    text = ""
-    for page_num in range(min(5, len(doc))):
-        text += doc.load_page(page_num).get_text()
-    words = len(text.split())
+def file_sha256(file_path):
+    """Hash a file in chunks."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _extract_page_range(file_path, start, end):
+    """Extract the text of pages [start, end) of a PDF (runs in a worker process)."""
+    doc = lazy_import("fitz").open(file_path)  # PyMuPDF
+    try:
+        return [doc.load_page(page_num).get_text() for page_num in range(start, end)]
+    finally:
+        doc.close()
+
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+def get_pdf_pool():
+    """Return the shared process pool for PDF extraction, created on first use.
+
+    Workers are started by a fork server (or spawned where there is none): forking this
+    multi-threaded process could copy a lock held by another thread and deadlock the child.
+    """
+    global _pdf_pool
+    if _pdf_pool is None:
+        with _pdf_pool_lock:
+            if _pdf_pool is None:
+                method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS,
+                                                mp_context=multiprocessing.get_context(method))
+    return _pdf_pool
+
+def iter_pdf_pages(file_path, start=0, end=None, file_hash=None):
+    """Yield (page number, text) of the pages [start, end) of a PDF, in order.
+
+    Cached pages come from the pdf_pages table. Missing pages are extracted in ranges
+    by the process pool and yielded as soon as their range is ready, so callers can
+    start working before the whole document is extracted.
+    """
+    with lazy_import("fitz").open(file_path) as doc:  # PyMuPDF
+        page_count = len(doc)
+    end = page_count if end is None else min(end, page_count)
+    if start >= end:
+        return
+    file_hash = file_hash or file_sha256(file_path)
+    cached = db.get_pdf_pages(file_hash, start, end)
+
+    # Ranges of consecutive missing pages, at most PDF_PAGES_PER_TASK pages each
+    ranges = []
+    for page_num in range(start, end):
+        if page_num in cached:
+            continue
+        if ranges and ranges[-1][1] == page_num and page_num - ranges[-1][0] < PDF_PAGES_PER_TASK:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([page_num, page_num + 1])
+
+    if sum(range_end - range_start for range_start, range_end in ranges) <= PDF_PAGES_PER_TASK:
+        # Small job: a process pool round trip would cost more than it saves
+        pending = {range_start: (range_end, _extract_page_range(file_path, range_start, range_end))
+                   for range_start, range_end in ranges}
+    else:
+        pool = get_pdf_pool()
+        pending = {range_start: (range_end, pool.submit(_extract_page_range, file_path, range_start, range_end))
+                   for range_start, range_end in ranges}
+
+    page_num = start
+    try:
+        while page_num < end:
+            if page_num in cached:
+                yield page_num, cached[page_num]
+                page_num += 1
+                continue
+            range_end, texts = pending.pop(page_num)
+            if not isinstance(texts, list):
+                texts = texts.result()
+            extracted = list(zip(range(page_num, range_end), texts))
+            db.save_pdf_pages(file_hash, extracted)
+            yield from extracted
+            page_num = range_end
+    finally:
+        # The caller stopped early: drop the ranges nobody will read
+        for _, texts in pending.values():
+            if not isinstance(texts, list):
+                texts.cancel()
+
+def analyze_pdf(file_path, full=False, pages=None):
+    """Read and analyze PDF files.
+
+    By default only the first 5 pages are read. full=True reads the whole document,
+    pages=(start, end) a page range (0-based, end excluded).
+    """
+    if pages is not None:
+        start, end = pages
+    else:
+        start, end = 0, None if full else 5
+    words = 0
+    head = []
+    head_length = 0
+    for _, text in iter_pdf_pages(file_path, start, end):
+        words += len(text.split())
+        if head_length < 300:
+            head.append(text)
+            head_length += len(text)
+    text = "".join(head)
     return f"📑 PDF analyzed: {words} words.\nFirst lines:\n{text[:300]}..."
 
 def analyze_image(file_path):
     """Simulate an image analysis (OCR or description)."""
     return "🖼️ Image analyzed: (image analysis simulation)"
 
-def analyze_sentiment(text):
-    """Analyze the emotion of a message and return its intensity."""
-    client = language_v1.LanguageServiceClient()
-    document = language_v1.Document(content=text, type_=language_v1.Document.Type.PLAIN_TEXT)
+_language_client = None
+_language_client_lock = threading.Lock()
 
-    response = client.analyze_sentiment(request={"document": document})
-    score = response.document_sentiment.score
-    magnitude = response.document_sentiment.magnitude
+def get_language_client():
+    """Return the shared Google NLP client, created on first use."""
+    global _language_client
+    if _language_client is None:
+        with _language_client_lock:
+            if _language_client is None:
+                language_v1 = lazy_import("google.cloud.language_v1")
+                if GOOGLE_NLP_ENDPOINT:
+                    from google.auth.credentials import AnonymousCredentials
+                    _language_client = language_v1.LanguageServiceClient(
+                        credentials=AnonymousCredentials(), transport="rest",
+                        client_options={"api_endpoint": GOOGLE_NLP_ENDPOINT})
+                else:
+                    _language_client = language_v1.LanguageServiceClient()
+    return _language_client
 
-    return score, magnitude  # Score: positive or negative, Magnitude: intensity
+class NLPCache:
+    """LRU + TTL cache of NLP results, optionally persisted to SQLite."""
 
-def analyze_entities(text):
-    """Analyze entities in a chat message and return the most important terms."""
-    client = language_v1.LanguageServiceClient()
-    document = language_v1.Document(content=text, type_=language_v1.Document.Type.PLAIN_TEXT)
+    EVICT_EVERY = 100  # Puts between two eviction passes of the nlp_cache table
+
+    def __init__(self, max_size=NLP_CACHE_SIZE, ttl=NLP_CACHE_TTL, max_rows=NLP_CACHE_MAX_ROWS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.db = None
+        self._items = OrderedDict()  # key -> (created_at, result)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "persistent_hits": 0}
+        self._puts = 0
+
+    def persist_to(self, db):
+        """Also keep results in the nlp_cache table of the database."""
+        self.db = db
+
+    @staticmethod
+    def key(text):
+        """Hash of the text with case and whitespace normalized."""
+        normalized = " ".join(text.split()).casefold()
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def get(self, text):
+        key = self.key(text)
+        now = time.time()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and now - item[0] < self.ttl:
+                self._items.move_to_end(key)
+                self._stats["hits"] += 1
+                return item[1]
+            self._items.pop(key, None)
+
+        result = self._load(key, now)
+        with self._lock:
+            if result is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+            self._stats["persistent_hits"] += 1
+        self._remember(key, result[0], result[1])
+        return result[1]
+
+    def put(self, text, result):
+        key = self.key(text)
+        created_at = time.time()
+        self._remember(key, created_at, result)
+        if self.db is not None:
+            try:
+                with self.db.get_connection() as conn:
+                    conn.execute("""
+                        INSERT OR REPLACE INTO nlp_cache (key, result, created_at)
+                        VALUES (?, ?, ?)
+                    """, (key, json.dumps(result), created_at))
+            except sqlite3.Error as e:
+                logging.warning(f"⚠️ Error saving NLP result in cache: {e}")
+                return
+            with self._lock:
+                self._puts += 1
+                evict = self._puts % self.EVICT_EVERY == 0
+            if evict:
+                self.evict()
+
+    def evict(self):
+        """Drop persisted results older than the TTL, then the oldest until at most max_rows are left."""
+        if self.db is None:
+            return
+        try:
+            with self.db.get_connection() as conn:
+                conn.execute("DELETE FROM nlp_cache WHERE created_at < ?", (time.time() - self.ttl,))
+                excess = conn.execute("SELECT COUNT(*) FROM nlp_cache").fetchone()[0] - self.max_rows
+                if excess > 0:
+                    conn.execute("""
+                        DELETE FROM nlp_cache WHERE key IN (
+                            SELECT key FROM nlp_cache ORDER BY created_at LIMIT ?
+                        )
+                    """, (excess,))
+        except sqlite3.Error as e:
+            logging.warning(f"⚠️ Error evicting NLP cache: {e}")
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "size": len(self._items),
+                "hit_rate": self._stats["hits"] / lookups if lookups else 0.0
+            }
+
+    def _remember(self, key, created_at, result):
+        with self._lock:
+            self._items[key] = (created_at, result)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
 
-    response = client.analyze_entities(request={"document": document})
+    def _load(self, key, now):
+        """Return (created_at, result) from SQLite, or None if missing or expired."""
+        if self.db is None:
+            return None
+        try:
+            with self.db.get_connection() as conn:
+                row = conn.execute("SELECT created_at, result FROM nlp_cache WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                if now - row[0] >= self.ttl:
+                    conn.execute("DELETE FROM nlp_cache WHERE key = ?", (key,))
+                    return None
+                return row[0], json.loads(row[1])
+        except sqlite3.Error as e:
+            logging.warning(f"⚠️ Error reading NLP cache: {e}")
+            return None
+
+nlp_cache = NLPCache()
+
+@metrics.timed("nlp.annotate_text")
+def annotate_text(text, timeout=None):
+    """Analyze entities and sentiment of a text in a single NLP call (cached)."""
+    cached = nlp_cache.get(text)
+    if cached is not None:
+        return cached
+
+    language_v1 = lazy_import("google.cloud.language_v1")
+    document = language_v1.Document(content=text, type_=language_v1.Document.Type.PLAIN_TEXT)
+    with metrics.timer("google.annotate_text"):
+        response = get_language_client().annotate_text(request={
+            "document": document,
+            "features": {"extract_entities": True, "extract_document_sentiment": True}
+        }, timeout=timeout)
 
-    entities = []
-    for entity in response.entities:
-        entities.append({
+    result = {
+        "entities": [{
             "name": entity.name,
             "type": language_v1.Entity.Type(entity.type_).name,
             "importance": entity.salience
-        })
+        } for entity in response.entities],
+        "sentiment": {
+            "score": response.document_sentiment.score,
+            "magnitude": response.document_sentiment.magnitude
+        }
+    }
+    nlp_cache.put(text, result)
+    return result
 
-    return entities
+def analyze_sentiment(text):
+    """Analyze the emotion of a message and return its intensity."""
+    sentiment = annotate_text(text)["sentiment"]
+    return sentiment["score"], sentiment["magnitude"]  # Score: positive or negative, Magnitude: intensity
 
-def check_summaries():
-    """Run the summary module at regular intervals, avoiding duplicate summaries."""
-    while True:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT user_id FROM user_messages
-                WHERE user_id NOT IN (
-                    SELECT user_id FROM user_summaries
-                    WHERE timestamp >= datetime('now', '-24 hours')
-                )
-                GROUP BY user_id
-                HAVING COUNT(*) >= 10
-            """)
-            users = [row[0] for row in cursor.fetchall()]
+def analyze_entities(text, timeout=None):
+    """Analyze entities in a chat message and return the most important terms."""
+    return annotate_text(text, timeout=timeout)["entities"]
 
-        for user_id in users:
-            with sqlite3.connect(DB_FILE) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT content FROM user_messages
-                    WHERE user_id = ?
-                    ORDER BY timestamp DESC
-                    LIMIT 25
-                """, (user_id,))
-                messages = cursor.fetchall()
+class JobQueue:
+    """Persistent job queue (the jobs table) with worker threads per job kind."""
 
-            if not messages:
+    def __init__(self, db):
+        self.db = db
+        self.handlers = {}  # kind -> (handler, workers, on_finish)
+        self._wakeups = {}  # kind -> Event set when a job of that kind is queued
+        self._stop = threading.Event()
+        self._threads = []
+        self._running = {}  # job id -> lease owner, the jobs of this process whose lease is renewed
+        self._running_lock = threading.Lock()
+        self._next_requeue = 0.0
+
+    def register(self, kind, handler, workers=1, on_finish=None):
+        """Run handler(payload) for jobs of this kind; on_finish(payload) runs once the job is done or failed."""
+        self.handlers[kind] = (handler, workers, on_finish)
+        self._wakeups[kind] = threading.Event()
+
+    def enqueue(self, kind, user_id, payload, priority=0, max_attempts=JOB_MAX_ATTEMPTS):
+        """Queue a job and return its id."""
+        now = time.time()
+        with self.db.get_connection() as conn:
+            cursor = conn.execute("""
+                INSERT INTO jobs (kind, user_id, priority, max_attempts, payload, run_after, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (kind, user_id, priority, max_attempts, json.dumps(payload), now, now, now))
+            job_id = cursor.lastrowid
+        if kind in self._wakeups:
+            self._wakeups[kind].set()
+        logging.info(f"⏳ Job {job_id} ({kind}) queued for {user_id}")
+        return job_id
+
+    def get(self, job_id):
+        """Return a job as a dict, or None."""
+        with self.db.get_connection() as conn:
+            row = conn.execute("""
+                SELECT id, kind, user_id, status, priority, attempts, max_attempts, result, error, created_at, updated_at
+                FROM jobs WHERE id = ?
+            """, (job_id,)).fetchone()
+        if row is None:
+            return None
+        keys = ["id", "kind", "user_id", "status", "priority", "attempts", "max_attempts", "result", "error",
+                "created_at", "updated_at"]
+        job = dict(zip(keys, row))
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        return job
+
+    def start(self):
+        """Requeue jobs abandoned by a dead worker and start the worker and heartbeat threads."""
+        self.requeue_stale()
+        for kind, (_, workers, _) in self.handlers.items():
+            for n in range(workers):
+                thread = threading.Thread(target=self._work, args=(kind,), name=f"job-{kind}-{n}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        thread = threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self):
+        """Stop the workers after their current job."""
+        self._stop.set()
+        for event in self._wakeups.values():
+            event.set()
+        for thread in self._threads:
+            thread.join()
+
+    def requeue_stale(self):
+        """Put back running jobs whose lease expired: their worker died or stopped renewing it."""
+        now = time.time()
+        with self.db.get_connection() as conn:
+            requeued = conn.execute(JOBS_REQUEUE_QUERY, (now, now)).rowcount
+        if requeued:
+            logging.warning(f"⚠️ {requeued} job(s) with an expired lease requeued")
+        self._next_requeue = now + JOB_LEASE_SECONDS / 4
+
+    def _claim(self, kind):
+        """Atomically take the next runnable job of a kind with a new lease.
+
+        Returns (id, payload, attempts, max_attempts, lease owner) or None.
+        """
+        now = time.time()
+        owner = uuid.uuid4().hex
+        with self.db.get_connection() as conn:
+            job = conn.execute(JOBS_CLAIM_QUERY, (now, owner, now + JOB_LEASE_SECONDS, kind, now)).fetchone()
+        if job is None:
+            return None
+        with self._running_lock:
+            self._running[job[0]] = owner
+        return (*job, owner)
+
+    def _finish(self, job_id, owner, status, result=None, error=None, retry_at=None):
+        """Record the outcome of a job, returns False if its lease was lost (another worker runs it now)."""
+        with self.db.get_connection() as conn:
+            return conn.execute("""
+                UPDATE jobs SET status = ?, result = ?, error = ?, run_after = COALESCE(?, run_after), updated_at = ?,
+                                lease_owner = NULL
+                WHERE id = ? AND lease_owner = ?
+            """, (status, json.dumps(result) if result is not None else None, error, retry_at, time.time(),
+                  job_id, owner)).rowcount == 1
+
+    def _heartbeat(self):
+        """Renew the leases of the jobs this process runs, so no other worker takes them over."""
+        while not self._stop.wait(JOB_LEASE_SECONDS / 3):
+            with self._running_lock:
+                running = list(self._running.items())
+            if not running:
                 continue
+            try:
+                with self.db.get_connection() as conn:
+                    conn.executemany("UPDATE jobs SET lease_expires = ? WHERE id = ? AND lease_owner = ?", [
+                        (time.time() + JOB_LEASE_SECONDS, job_id, owner) for job_id, owner in running
+                    ])
+            except Exception as e:
+                logging.warning(f"⚠️ Error renewing job leases: {e}")
+
+    def _work(self, kind):
+        wakeup = self._wakeups[kind]
+        while not self._stop.is_set():
+            try:
+                if time.time() >= self._next_requeue:
+                    self.requeue_stale()
+                ran = self._run_next(kind)
+            except Exception as e:
+                # E.g. the database is locked: the job's lease expires and it is retried
+                logging.error(f"❌ {kind} job worker error: {e}")
+                ran = False
+            if not ran:
+                wakeup.wait(JOB_POLL_SECONDS)
+                wakeup.clear()
+
+    def _run_next(self, kind):
+        """Claim and run one job of a kind, returns False if there was none."""
+        handler, _, on_finish = self.handlers[kind]
+        job = self._claim(kind)
+        if job is None:
+            return False
+
+        job_id, payload, attempts, max_attempts, owner = job
+        try:
+            payload = json.loads(payload)
+            finished = self._run(kind, handler, job_id, payload, attempts, max_attempts, owner)
+        finally:
+            # Done or not, stop renewing the lease: if the outcome was not saved, the job is retried
+            with self._running_lock:
+                self._running.pop(job_id, None)
+        if finished and on_finish is not None:
+            on_finish(payload)
+        return True
+
+    def _run(self, kind, handler, job_id, payload, attempts, max_attempts, owner):
+        """Run a claimed job and save its outcome, returns True if it is over (done or failed for good)."""
+        try:
+            with metrics.scope(f"job.{kind}"), metrics.timer("job.run"):
+                result = handler(payload)
+        except Exception as e:
+            if attempts < max_attempts:
+                retry_at = time.time() + JOB_RETRY_DELAY * 2 ** (attempts - 1)
+                if self._finish(job_id, owner, "queued", error=str(e), retry_at=retry_at):
+                    logging.warning(f"⚠️ Job {job_id} ({kind}) failed, retry {attempts}/{max_attempts}: {e}")
+                return False
+            finished = self._finish(job_id, owner, "failed", error=str(e))
+            logging.error(f"❌ Job {job_id} ({kind}) failed: {e}")
+        else:
+            finished = self._finish(job_id, owner, "done", result=result)
+            logging.info(f"✅ Job {job_id} ({kind}) done")
+        if not finished:
+            logging.warning(f"⚠️ Job {job_id} ({kind}) lost its lease, its outcome is left to the new worker")
+        return finished
+
+def upload_job(payload):
+    """Job handler: ask GPT-4o what to do with an uploaded file and do it."""
+    decision = decide_file_action(payload["filename"], payload["sha256"])
+    return {
+        "decision": decision,
+        "response": run_file_action(decision, payload["filename"], payload["path"], payload["sha256"])
+    }
+
+def process_file_job(payload):
+    """Job handler: run the type-specific analyzer of an uploaded file."""
+    return {"response": process_file(payload["user_id"], payload["filename"], payload["path"],
+                                     pages=payload.get("pages"), full=payload.get("full", False))}
+
+def remove_job_file(payload):
+    """Delete the spool file of a finished upload job."""
+    try:
+        os.remove(payload["path"])
+    except FileNotFoundError:
+        pass
+
+def create_job_queue(db, workers=JOB_WORKERS):
+    """Build the file-processing job queue; workers is "kind=count,..." (JOB_WORKERS)."""
+    counts = dict(item.split("=") for item in workers.split(",") if item)
+    jobs = JobQueue(db)
+    jobs.register("upload", upload_job, workers=int(counts.get("upload", 1)), on_finish=remove_job_file)
+    jobs.register("process_file", process_file_job, workers=int(counts.get("process_file", 1)),
+                  on_finish=remove_job_file)
+    return jobs
+
+class TokenBucket:
+    """Thread-safe token bucket: rate tokens per second, up to capacity."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        """Take tokens if available, otherwise return the seconds to wait for them."""
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens=1, timeout=None):
+        """Block until tokens are available. Returns False if that would take longer than timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait == 0.0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+class Summarizer:
+    """Summarise users with new messages through a bounded worker pool and a global rate limit."""
+
+    def __init__(self, db, openai_client=None, workers=SUMMARY_WORKERS, rate_per_minute=SUMMARY_RATE_PER_MINUTE,
+                 min_messages=SUMMARY_MIN_MESSAGES, incremental=SUMMARY_INCREMENTAL):
+        self.db = db
+        self._client = openai_client  # None: the shared client, see get_openai_client()
+        self.min_messages = min_messages
+        self.incremental = incremental
+        self.limiter = TokenBucket(rate=rate_per_minute / 60, capacity=max(1, workers)) if rate_per_minute > 0 else None
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="summarizer")
+
+    @property
+    def client(self):
+        return self._client or get_openai_client()
+
+    def run_pass(self, keep_going=None):
+        """Summarise every eligible dirty user once, returns how many summaries were written.
+
+        keep_going() is checked before each user, e.g. to stop when the scheduler lease is lost.
+        """
+        def summarize(user_id):
+            if keep_going is not None and not keep_going():
+                return False
+            return self.summarize_user(user_id)
+
+        with metrics.scope("summaries"), metrics.timer("summary.pass"):
+            users = self.db.get_dirty_users(self.min_messages)
+            if not users:
+                return 0
+            results = self.pool.map(summarize, users)
+            done = sum(1 for ok in results if ok)
+        logging.info(f"🧠 Summary pass: {done}/{len(users)} users summarised")
+        return done
+
+    def summarize_user(self, user_id):
+        """Summarise one user, returns True if a summary was saved."""
+        with metrics.scope("summaries"):
+            return self._summarize_user(user_id)
+
+    def _summarize_user(self, user_id):
+        try:
+            state = self.db.get_summary_state(user_id)
+            if state is not None and state["recent"]:
+                return False  # Already summarised during the cooldown
+
+            if self.incremental and state is not None and state["last_message_id"] is not None:
+                # Only the messages the last summary hasn't seen, merged into it
+                messages = self.db.get_messages_since(user_id, state["last_message_id"])
+                previous = state["summary"]
+            else:
+                messages = self.db.get_recent_messages(user_id, limit=25)[::-1]
+                previous = None
+            if not messages:
+                return False
 
             # Combine all messages into a long text
-            combined_text = "\n".join([msg[0] for msg in messages])
+            combined_text = "\n".join([content for _, content in messages])
+            if previous:
+                system_prompt = ("Update this summary of the player's behavior with the new phrases. "
+                                 "Detect interests, tone, and habits. Be clear and concise.")
+                user_content = f"Current summary:\n{previous}\n\nNew phrases:\n{combined_text[:3000]}"
+            else:
+                system_prompt = ("Summarize the player's behavior based on these phrases. "
+                                 "Detect interests, tone, and habits. Be clear and concise.")
+                user_content = combined_text[:3000]  # Token limit
 
-            # Use OpenAI to generate the summary
-            try:
-                response = client.chat.completions.create(
+            if self.limiter is not None:
+                with metrics.timer("summary.rate_limit_wait"):
+                    self.limiter.acquire()
+            with metrics.timer("openai.summary"):
+                response = self.client.chat.completions.create(
                     model="gpt-4o",
                     messages=[
-                        {"role": "system", "content": "Summarize the player's behavior based on these phrases. Detect interests, tone, and habits. Be clear and concise."},
-                        {"role": "user", "content": combined_text[:3000]}  # Token limit
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": user_content}
                     ],
                     temperature=0.7,
                     max_tokens=300
                 )
-                summary = response.choices[0].message.content.strip()
+            metrics.record_usage(response.usage, "openai.summary")
+            summary = response.choices[0].message.content.strip()
 
-                # Save in the user_summaries table
-                with sqlite3.connect(DB_FILE) as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("""
-                        INSERT INTO user_summaries (user_id, session_id, summary)
-                        VALUES (?, ?, ?)
-                    """, (user_id, "rust_session", summary))
-                    conn.commit()
+            # Save in the user_summaries table
+            last_message_id = max(message_id for message_id, _ in messages)
+            self.db.save_summary(user_id, "rust_session", summary, last_message_id)
+            logging.info(f"🧠 Summary generated and saved for user {user_id}")
+            return True
+
+        except Exception as e:
+            logging.warning(f"⚠️ Error generating summary for {user_id}: {e}")
+            return False
+
+class Scheduler:
+    """Run the summary passes in exactly one process: the holder of the "scheduler" lease in SQLite.
+
+    Every process with a scheduler competes for the lease and the holder renews it. If the
+    holder dies its lease expires, and another process takes over within lease_seconds.
+    """
+
+    LEASE = "scheduler"
+
+    def __init__(self, db, openai_client=None, interval=SUMMARY_INTERVAL_SECONDS, lease_seconds=SCHEDULER_LEASE_SECONDS):
+        self.db = db
+        self.summarizer = Summarizer(db, openai_client)
+        self.interval = interval
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.leader = False
+        self._stop = threading.Event()
+        self._pass = None  # Thread of the running summary pass
+
+    def start(self):
+        """Run the scheduler in a background thread."""
+        threading.Thread(target=self.run, name="scheduler", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self.leader:
+            self.leader = False
+            self.db.release_lease(self.LEASE, self.owner)
+
+    def is_leader(self):
+        return self.leader and not self._stop.is_set()
+
+    def run(self):
+        """Renew or take the lease every lease_seconds / 3, start a summary pass when one is due."""
+        next_pass = 0.0
+        while not self._stop.is_set():
+            try:
+                leader = self.db.acquire_lease(self.LEASE, self.owner, self.lease_seconds)
+            except sqlite3.Error as e:
+                logging.warning(f"⚠️ Scheduler lease check failed: {e}")
+                leader = False
+            if leader != self.leader:
+                logging.info(f"👑 {self.owner} {'is now' if leader else 'is no longer'} the scheduler")
+                self.leader = leader
+
+            pass_running = self._pass is not None and self._pass.is_alive()
+            if leader and not pass_running and time.time() >= next_pass:
+                self._pass = threading.Thread(target=self._summary_pass, name="summary-pass", daemon=True)
+                self._pass.start()
+                next_pass = time.time() + self.interval
+            self._stop.wait(self.lease_seconds / 3)
 
-                logging.info(f"🧠 Summary generated and saved for user {user_id}")
+    def _summary_pass(self):
+        """Run the summary module once, only for users with new messages."""
+        try:
+            self.summarizer.run_pass(keep_going=self.is_leader)
+        except Exception as e:
+            logging.warning(f"⚠️ Summary pass failed: {e}")
+        logging.info(f"⌛ Waiting {self.interval:.0f} seconds before the next summary check...")
 
+def warm_up():
+    """Load the lazy dependencies and clients before the first request needs them."""
+    steps = {
+        "openai": get_openai_client,
+        "fitz": lambda: lazy_import("fitz"),
+        "google_nlp": get_language_client,
+        "tokenizer": lambda: count_tokens("warm up"),
+    }
+    with startup_stage("warmup"):
+        for name, step in steps.items():
+            try:
+                step()
             except Exception as e:
-                logging.warning(f"⚠️ Error generating summary for {user_id}: {e}")
+                logging.warning(f"⚠️ Warm-up of {name} failed: {e}")
+    logging.info(f"🔥 Warm-up done in {startup_times['warmup'] * 1000:.0f} ms")
 
-        logging.info("⌛ Waiting 1 hour before the next summary check...")
-        time.sleep(3600)  # Wait 1 hour
+def startup_report():
+    """Startup stages in milliseconds, with the total from the first import to now."""
+    report = {name: round(seconds * 1000, 1) for name, seconds in startup_times.items()}
+    report["total"] = round((time.perf_counter() - _import_started) * 1000, 1)
+    return report
+
+startup_times["module"] = time.perf_counter() - _import_started - startup_times["imports"]
+
+def create_app(db_file=DB_FILE, scheduler=RUN_SCHEDULER, warmup=APP_WARMUP):
+    """App factory: build the database, clients, job workers and scheduler of one process.
+
+    WSGI servers call it once per worker process (see wsgi.py), returns the Flask app.
+    The openai, fitz and Google NLP packages are imported on first use, or by warm_up()
+    when warmup is "background" (after startup) or "blocking" (before serving).
+    """
+    global db
+    with startup_stage("database"):
+        db = Database(db_file)
+        if DB_WRITE_BEHIND:
+            db.enable_write_behind()
+        if NLP_CACHE_PERSIST:
+            nlp_cache.persist_to(db)
+        analysis_cache.use(db)
+        if RESPONSE_CACHE:
+            response_cache.enable(db)
+    with startup_stage("jobs"):
+        jobs = create_job_queue(db)
+        jobs.start()
+    with startup_stage("flask"):
+        flask_app = FlaskApp(db, OpenAIClient(), jobs=jobs)
+    atexit.register(db.close_all)
+    atexit.register(background.shutdown)  # Runs before close_all: finish background work first
+    atexit.register(jobs.stop)
+    if scheduler:
+        atexit.register(Scheduler(db).start().stop)  # Runs first: release the lease
+    if warmup == "blocking":
+        warm_up()
+    elif warmup == "background":
+        background.submit(warm_up)
+    logging.info(f"🚀 Startup (ms): {json.dumps(startup_report())}")
+    return flask_app.app
 
 if __name__ == "__main__":
-    db = Database(DB_FILE)
-    openai_client = OpenAIClient(OPENAI_API_KEY)
-    app = FlaskApp(db, openai_client)
-    threading.Thread(target=check_summaries, daemon=True).start()
-    app.run()
+    if "--check-query-plans" in sys.argv:
+        Database(DB_FILE).check_query_plans()
+    elif "--startup-report" in sys.argv:
+        # Cold start cost of one process, with every lazy dependency loaded
+        create_app(scheduler=False, warmup="blocking")
+        print(json.dumps(startup_report()))
+    elif "--scheduler" in sys.argv:
+        # Only the scheduler, e.g. next to WSGI workers started with RUN_SCHEDULER=0
+        db = Database(DB_FILE)
+        scheduler = Scheduler(db)
+        atexit.register(db.close_all)
+        atexit.register(scheduler.stop)
+        scheduler.run()
+    else:
+        app = create_app()
+        app.run(host=APP_HOST, port=APP_PORT, debug=APP_DEBUG)
@@ -0,0 +1,113 @@
+"""Benchmark the streaming CSV/JSON analyzers of app.py against the old load-everything versions.
+
+Usage:
+    python bench_analyzers.py --size-mb 2048 --workdir /var/tmp/bench
+
+Each analyzer runs in its own process so its peak memory (max RSS) can be measured.
+Results are printed as one JSON object per line.
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "bench")  # app.py refuses to start without one, no API call is made
+
+def legacy_analyze_csv(file_path):
+    """analyze_csv before the streaming version: loads every row."""
+    with open(file_path, newline='', encoding='utf-8') as csvfile:
+        reader = csv.reader(csvfile)
+        rows = list(reader)
+    columns = len(rows[0]) if rows else 0
+    rows_count = len(rows)
+    return f"📊 CSV analyzed: {rows_count} rows and {columns} columns.\nFirst rows:\n{rows[:5]}"
+
+def legacy_analyze_json(file_path):
+    """analyze_json before the streaming version: parses the whole document."""
+    with open(file_path, 'r', encoding='utf-8') as file:
+        data = json.load(file)
+    keys = ", ".join(data.keys()) if isinstance(data, dict) else "Not a valid JSON object"
+    return f"📂 JSON analyzed: Main keys: {keys}"
+
+def make_csv(path, size_bytes):
+    """Write a CSV of about size_bytes with mixed column types."""
+    rng = random.Random(42)
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(["player", "kills", "kd_ratio", "base", "last_wipe"])
+        while file.tell() < size_bytes:
+            writer.writerows(
+                [f"player_{rng.randrange(100000)}", rng.randrange(5000), round(rng.random() * 5, 3),
+                 rng.choice(["", "G7", "K12", "M3"]), f"2024-{rng.randrange(1, 13):02d}-01"]
+                for _ in range(10000)
+            )
+
+def make_json(path, size_bytes):
+    """Write a JSON object of about size_bytes with a few big top-level keys."""
+    rng = random.Random(42)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write('{"server": "Chill_rust", "wipes": [')
+        first = True
+        while file.tell() < size_bytes:
+            record = {"id": rng.randrange(10 ** 9), "map": "procedural", "players": [rng.randrange(500)] * 20,
+                      "notes": "raid \"night\" \\ base"}
+            file.write(("" if first else ",") + json.dumps(record))
+            first = False
+        file.write('], "rules": {"max_team": 4}}')
+
+def run_one(kind, implementation, path):
+    """Run one analyzer in this process (called in a child process)."""
+    if implementation == "legacy":
+        analyzer = legacy_analyze_csv if kind == "csv" else legacy_analyze_json
+    else:
+        import app
+        analyzer = app.analyze_csv if kind == "csv" else app.analyze_json
+    start = time.perf_counter()
+    analyzer(path)
+    print(json.dumps({"seconds": time.perf_counter() - start}))
+
+def measure(kind, implementation, path):
+    """Run an analyzer in a child process, return its time and peak memory."""
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--child", kind, implementation, path],
+        stdout=subprocess.PIPE, text=True
+    )
+    output = process.stdout.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    result = {"analyzer": kind, "implementation": implementation, "file_bytes": os.path.getsize(path),
+              "max_rss_mb": round(usage.ru_maxrss / 1024, 1)}  # ru_maxrss is in KiB on Linux
+    if status == 0:
+        result["seconds"] = round(json.loads(output)["seconds"], 3)
+    else:
+        result["error"] = f"exit status {status}"  # E.g. killed for running out of memory
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=1024, help="Size of each generated file")
+    parser.add_argument("--workdir", default=".", help="Where to write the generated files")
+    parser.add_argument("--skip-legacy", action="store_true", help="Only run the streaming analyzers")
+    parser.add_argument("--child", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_one(*args.child)
+        return
+
+    size = args.size_mb * 1024 * 1024
+    files = {"csv": os.path.join(args.workdir, "bench.csv"), "json": os.path.join(args.workdir, "bench.json")}
+    for kind, path in files.items():
+        if not os.path.exists(path) or os.path.getsize(path) < size:
+            (make_csv if kind == "csv" else make_json)(path, size)
+
+    implementations = ["streaming"] if args.skip_legacy else ["legacy", "streaming"]
+    for kind, path in files.items():
+        for implementation in implementations:
+            print(json.dumps(measure(kind, implementation, path)), flush=True)
+
+if __name__ == "__main__":
+    main()
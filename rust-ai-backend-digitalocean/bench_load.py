@@ -0,0 +1,334 @@
+"""Load-test app.py offline, against local stand-ins of the OpenAI and Google Natural Language APIs.
+
+Usage:
+    python bench_load.py --concurrency 32 --requests 500 --openai-latency 0.8 --workdir /var/tmp/bench
+
+The fake servers answer chat completions (plain and streamed), image generations and
+annotateText with a configurable latency and error rate. The app runs in its own process
+on a fresh database. Results are printed as one JSON object per scenario, per line.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SCENARIOS = ["ask_rust", "ask_rust_stream", "ask_general", "ask_general_stream", "generate_image", "upload_file"]
+
+WORDS = ("raid", "base", "rockets", "sulfur", "Bandit Camp", "Outpost", "Oil Rig", "turret", "wipe", "team",
+         "construction", "defense", "scrap", "AK", "Launch Site", "hate", "playing solo", "bothers me")
+
+ANSWER = "Solid plan mate, analyze the base first, then bring rockets and hit them at night. GG."
+
+class Profile:
+    """Latency and error profile of a fake upstream."""
+
+    def __init__(self, latency, jitter, error_rate, error_status=500):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.rng = random.Random()
+
+    def wait(self):
+        time.sleep(max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter)))
+
+    def fails(self):
+        return self.rng.random() < self.error_rate
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    profile = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def answer(self, payload):
+        """Wait like the real API, then send payload or, sometimes, an error."""
+        self.profile.wait()
+        if self.profile.fails():
+            self.send_json({"error": {"message": "Injected failure", "type": "server_error"}},
+                           status=self.profile.error_status)
+            return False
+        if payload is not None:
+            self.send_json(payload)
+        return True
+
+class FakeOpenAIHandler(FakeHandler):
+    token_delay = 0.0
+    stream_tokens = 20
+
+    def do_POST(self):
+        data = self.read_json()
+        if self.path.endswith("/chat/completions"):
+            self.chat(data)
+        elif self.path.endswith("/images/generations"):
+            self.answer({"created": int(time.time()), "data": [
+                {"url": f"http://127.0.0.1:{self.server.server_port}/images/{uuid.uuid4().hex}.png",
+                 "revised_prompt": data.get("prompt", "")}
+            ]})
+        else:
+            self.send_json({"error": {"message": f"Unknown path {self.path}"}}, status=404)
+
+    def chat(self, data):
+        prompt_tokens = len(json.dumps(data.get("messages", []))) // 4
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(ANSWER) // 4,
+                 "total_tokens": prompt_tokens + len(ANSWER) // 4}
+        base = {"id": f"chatcmpl-{uuid.uuid4().hex[:12]}", "created": int(time.time()), "model": data.get("model")}
+        if not data.get("stream"):
+            self.answer({**base, "object": "chat.completion", "usage": usage, "choices": [
+                {"index": 0, "message": {"role": "assistant", "content": ANSWER}, "finish_reason": "stop"}
+            ]})
+            return
+
+        if not self.answer(None):  # The latency of a stream is its time to first token
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        words = ANSWER.split(" ")
+        step = max(1, len(words) // self.stream_tokens)
+        pieces = [" ".join(words[i:i + step]) + " " for i in range(0, len(words), step)]
+        chunks = [{"index": 0, "delta": {"content": piece}, "finish_reason": None} for piece in pieces]
+        chunks.append({"index": 0, "delta": {}, "finish_reason": "stop"})
+        try:
+            for choice in chunks:
+                chunk = {**base, "object": "chat.completion.chunk", "choices": [choice]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+                time.sleep(self.token_delay)
+            if (data.get("stream_options") or {}).get("include_usage"):
+                last = {**base, "object": "chat.completion.chunk", "choices": [], "usage": usage}
+                self.wfile.write(f"data: {json.dumps(last)}\n\n".encode())
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The app closed the stream early
+        self.close_connection = True
+
+class FakeLanguageHandler(FakeHandler):
+    def do_POST(self):
+        data = self.read_json()
+        # The REST transport adds a query string, e.g. /v1/documents:annotateText?%24alt=json
+        if not urllib.parse.urlsplit(self.path).path.endswith(":annotateText"):
+            self.send_json({"error": {"message": f"Unknown path {self.path}"}}, status=404)
+            return
+        text = data.get("document", {}).get("content", "")
+        names = [word for word in WORDS if word.lower() in text.lower()][:5] or ["Rust"]
+        self.answer({
+            "entities": [{"name": name, "type": "OTHER", "salience": round(1 / (i + 2), 3)}
+                         for i, name in enumerate(names)],
+            "documentSentiment": {"score": 0.4, "magnitude": 0.9},
+            "language": "en"
+        })
+
+def start_fake(handler, profile, **attributes):
+    """Serve a fake upstream on a free local port, return the server."""
+    handler = type(handler.__name__, (handler,), {"profile": profile, **attributes})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def serve_app(port, db_path):
+    """Serve the app built by app.create_app() on 127.0.0.1 (called in a child process)."""
+    import app
+    from werkzeug.serving import make_server
+
+    make_server("127.0.0.1", int(port), app.create_app(db_path), threaded=True).serve_forever()
+
+def wait_until_up(base_url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The app exited with status {process.returncode}")
+        try:
+            urllib.request.urlopen(f"{base_url}/db_stats", timeout=2).read()
+            return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    raise RuntimeError("The app did not start in time")
+
+def message(rng):
+    return f"How do I {rng.choice(['raid', 'defend', 'build'])} near {rng.choice(WORDS)} with {rng.choice(WORDS)}?"
+
+def multipart(fields, filename, content):
+    """Encode form fields and one file as multipart/form-data, return (body, content type)."""
+    boundary = uuid.uuid4().hex
+    parts = [f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+             for name, value in fields.items()]
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                 f'Content-Type: text/plain\r\n\r\n'.encode() + content + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+def build_request(scenario, base_url, rng, args):
+    """Return a urllib Request for one call of a scenario."""
+    user_id = f"bench_user_{rng.randrange(args.users)}"
+    if scenario == "upload_file":
+        content = " ".join(rng.choice(WORDS) for _ in range(args.upload_kb * 160)).encode()
+        fields = {"user_id": user_id}
+        if args.upload_async:
+            fields["async"] = "1"
+        body, content_type = multipart(fields, f"notes_{rng.randrange(10 ** 6)}.txt", content)
+        return urllib.request.Request(f"{base_url}/upload_file", data=body, headers={"Content-Type": content_type})
+
+    if scenario == "generate_image":
+        payload = {"prompt": f"A Rust base made of {rng.choice(WORDS)}"}
+    else:
+        payload = {"user_id": user_id, "message": message(rng)}
+        if scenario.endswith("_stream"):
+            payload["stream"] = True
+    path = "/" + scenario.replace("_stream", "")
+    return urllib.request.Request(f"{base_url}{path}", data=json.dumps(payload).encode(),
+                                  headers={"Content-Type": "application/json"})
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+def db_size(db_path):
+    return sum(os.path.getsize(path) for path in (db_path, db_path + "-wal") if os.path.exists(path))
+
+def run_scenario(scenario, base_url, db_path, args):
+    """Send args.requests calls of a scenario, args.concurrency at a time, return its report."""
+    rng = random.Random(f"{args.seed}-{scenario}")
+    requests = [build_request(scenario, base_url, rng, args) for _ in range(args.requests)]
+
+    def call(req):
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=args.timeout) as response:
+                response.read()  # Whole body, so streams are timed until their last event
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except Exception:
+            status = 0  # Timeout or connection error
+        return time.perf_counter() - start, status
+
+    size_before = db_size(db_path)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(call, requests))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, status in results if 200 <= status < 300)
+    rate_limited = sum(1 for _, status in results if status == 429)
+    statuses = {}
+    for _, status in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    size_after = db_size(db_path)
+    return {
+        "scenario": scenario,
+        "requests": len(results),
+        "concurrency": args.concurrency,
+        "ok": len(latencies),
+        "rate_limited": rate_limited,  # 429 from the app's admission control, see --user-rate-per-minute
+        "errors": len(results) - len(latencies) - rate_limited,
+        "statuses": statuses,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(results) / elapsed, 2),
+        "latency_ms": {name: round(value * 1000, 1) if value is not None else None for name, value in (
+            ("p50", percentile(latencies, 50)), ("p95", percentile(latencies, 95)),
+            ("p99", percentile(latencies, 99)), ("max", latencies[-1] if latencies else None))},
+        "db_bytes_before": size_before,
+        "db_bytes_after": size_after,
+        "db_bytes_per_request": round((size_after - size_before) / len(results), 1)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help="Comma separated, from: " + ", ".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight at once")
+    parser.add_argument("--users", type=int, default=50, help="Distinct user ids to spread requests over")
+    parser.add_argument("--upload-kb", type=int, default=64, help="Size of each uploaded file")
+    parser.add_argument("--upload-async", action="store_true", help="Upload through the job queue (202 + job id)")
+    parser.add_argument("--openai-latency", type=float, default=0.5, help="Seconds before the fake OpenAI answers")
+    parser.add_argument("--openai-jitter", type=float, default=0.1)
+    parser.add_argument("--openai-error-rate", type=float, default=0.0, help="Share of OpenAI calls that fail")
+    parser.add_argument("--openai-error-status", type=int, default=500, help="E.g. 429 to simulate rate limits")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="Seconds between streamed chunks")
+    parser.add_argument("--nlp-latency", type=float, default=0.15, help="Seconds before the fake Language API answers")
+    parser.add_argument("--nlp-jitter", type=float, default=0.05)
+    parser.add_argument("--nlp-error-rate", type=float, default=0.0)
+    parser.add_argument("--user-rate-per-minute", type=float, default=0,
+                        help="OPENAI_USER_RATE_PER_MINUTE of the app, 0 disables the per-user admission limit")
+    parser.add_argument("--global-rate", type=float, default=0,
+                        help="OPENAI_GLOBAL_RATE_PER_SECOND of the app, 0 disables the global admission limit")
+    parser.add_argument("--timeout", type=float, default=120, help="Client timeout per request")
+    parser.add_argument("--port", type=int, default=5055, help="Port of the app under test")
+    parser.add_argument("--workdir", default=".", help="Where the benchmark database and uploads go")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--app-logs", action="store_true", help="Show the app's log output")
+    parser.add_argument("--serve-app", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_app:
+        serve_app(*args.serve_app)
+        return
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    openai_server = start_fake(FakeOpenAIHandler, Profile(args.openai_latency, args.openai_jitter,
+                                                          args.openai_error_rate, args.openai_error_status),
+                               token_delay=args.token_delay)
+    language_server = start_fake(FakeLanguageHandler, Profile(args.nlp_latency, args.nlp_jitter, args.nlp_error_rate))
+
+    os.makedirs(args.workdir, exist_ok=True)
+    db_path = os.path.abspath(os.path.join(args.workdir, f"bench_{int(time.time())}.sqlite"))
+    env = {
+        **os.environ,
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{openai_server.server_port}/v1",
+        "GOOGLE_NLP_ENDPOINT": f"http://127.0.0.1:{language_server.server_port}",
+        "UPLOAD_DIR": os.path.abspath(args.workdir),
+        # Admission control is off by default, so the app is measured rather than its rate limiter
+        "OPENAI_USER_RATE_PER_MINUTE": str(args.user_rate_per_minute),
+        "OPENAI_GLOBAL_RATE_PER_SECOND": str(args.global_rate)
+    }
+    app_process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve-app", str(args.port), db_path], env=env,
+        stdout=subprocess.DEVNULL, stderr=None if args.app_logs else subprocess.DEVNULL
+    )
+    base_url = f"http://127.0.0.1:{args.port}"
+    try:
+        wait_until_up(base_url, app_process)
+        for scenario in scenarios:
+            print(json.dumps(run_scenario(scenario, base_url, db_path, args)), flush=True)
+    finally:
+        app_process.terminate()
+        app_process.wait()
+        openai_server.shutdown()
+        language_server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Benchmark the /search full-text queries of app.py on a large synthetic message history.
+
+Usage:
+    python bench_search.py --rows 20000000 --users 200000 --workdir /var/tmp/bench
+
+The database is generated once (through the FTS sync triggers, so the insert rate is reported
+too) and reused by later runs. Each query type is then timed on random terms of common, medium
+and rare frequency. Results are printed as one JSON object per line.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "bench")  # app.py refuses to start without one, no API call is made
+
+RUST_WORDS = ["raid", "raiding", "rockets", "sulfur", "outpost", "bandit", "turret", "wipe", "team", "base",
+              "stone", "metal", "scrap", "satchel", "c4", "door", "roof", "helicopter", "bradley", "oil"]
+SYLLABLES = ["ka", "ro", "mi", "tan", "sel", "vu", "dor", "pe", "lis", "gra", "no", "zu", "ter", "bi", "ox"]
+
+def vocabulary(size):
+    """Rust words followed by made-up words, most frequent first."""
+    words = list(RUST_WORDS)
+    for length in itertools.count(2):
+        for parts in itertools.product(SYLLABLES, repeat=length):
+            if len(words) >= size:
+                return words
+            words.append("".join(parts))
+
+def generate(db, rows, users, words, seed):
+    """Insert rows Zipf-distributed messages, return the insert rate (rows per second)."""
+    rng = random.Random(seed)
+    cum_weights = list(itertools.accumulate(1 / rank ** 1.1 for rank in range(1, len(words) + 1)))
+    conn = db.get_connection()
+    start = time.perf_counter()
+    done = 0
+    while done < rows:
+        batch = min(50000, rows - done)
+        conn.executemany(
+            "INSERT INTO user_messages (user_id, session_id, type, content) VALUES (?, 'rust_session', ?, ?)",
+            ((f"player_{rng.randrange(users)}", rng.choice(("question", "answer")),
+              " ".join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(4, 24)))) for _ in range(batch))
+        )
+        conn.commit()
+        done += batch
+        print(f"{done}/{rows} rows", file=sys.stderr, end="\r")
+    return rows / (time.perf_counter() - start)
+
+def percentiles(values):
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+    return {"p50": round(pick(50) * 1000, 2), "p95": round(pick(95) * 1000, 2), "p99": round(pick(99) * 1000, 2)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000000, help="Messages in the benchmark database")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--vocabulary", type=int, default=50000, help="Distinct words")
+    parser.add_argument("--queries", type=int, default=200, help="Queries per query type")
+    parser.add_argument("--limit", type=int, default=20, help="Results per page")
+    parser.add_argument("--workdir", default=".", help="Where the benchmark database goes")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    import app
+
+    path = os.path.join(args.workdir, f"bench_search_{args.rows}.sqlite")
+    db = app.Database(path)
+    words = vocabulary(args.vocabulary)
+    existing = db.get_connection().execute("SELECT MAX(id) FROM user_messages").fetchone()[0] or 0
+    if existing < args.rows:
+        rate = generate(db, args.rows - existing, args.users, words, args.seed + existing)
+        print(json.dumps({"inserted": args.rows - existing, "rows_per_second": round(rate)}), flush=True)
+    print(json.dumps({"rows": args.rows, "db_bytes": os.path.getsize(path)}), flush=True)
+
+    rng = random.Random(args.seed)
+    bands = {"common": words[:20], "medium": words[200:2000], "rare": words[10000:]}
+    user = lambda: f"player_{rng.randrange(args.users)}"
+    cases = {
+        "term": lambda band: {"text": rng.choice(band)},
+        "two_terms": lambda band: {"text": f"{rng.choice(band)} {rng.choice(bands['common'])}"},
+        "prefix": lambda band: {"text": rng.choice(band)[:3] + "*"},
+        "term_user": lambda band: {"text": rng.choice(band), "user_id": user()},
+        "term_recent": lambda band: {"text": rng.choice(band), "order": "recent"},
+        "term_user_recent": lambda band: {"text": rng.choice(band), "user_id": user(), "order": "recent"},
+    }
+    for case, make in cases.items():
+        for band_name, band in bands.items():
+            first_page, second_page, results = [], [], 0
+            for _ in range(args.queries):
+                query = make(band)
+                start = time.perf_counter()
+                page, cursor = db.search(limit=args.limit, **query)
+                first_page.append(time.perf_counter() - start)
+                results += len(page)
+                if cursor is not None:
+                    start = time.perf_counter()
+                    db.search(limit=args.limit, cursor=cursor, **query)
+                    second_page.append(time.perf_counter() - start)
+            report = {"query": case, "terms": band_name, "queries": args.queries,
+                      "avg_results": round(results / args.queries, 1), "first_page_ms": percentiles(first_page)}
+            if second_page:
+                report["next_page_ms"] = percentiles(second_page)
+            print(json.dumps(report), flush=True)
+
+if __name__ == "__main__":
+    main()
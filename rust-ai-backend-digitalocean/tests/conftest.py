@@ -0,0 +1,37 @@
+import os
+import sys
+
+# app.py reads its settings at import time
+os.environ.setdefault("OPENAI_API_KEY", "test")  # Never used, the tests make no API calls
+os.environ.setdefault("MEMORY_ENABLED", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import app
+
+@pytest.fixture
+def db(tmp_path):
+    database = app.Database(str(tmp_path / "test.db"))
+    yield database
+    database.close_all()
+
+@pytest.fixture
+def write_behind_db(db):
+    db.writer = app.WriteBehindWriter(db)
+    yield db
+
+@pytest.fixture
+def upload_dir(tmp_path, monkeypatch):
+    directory = tmp_path / "uploads"
+    directory.mkdir()
+    monkeypatch.setattr(app, "UPLOAD_DIR", str(directory))
+    return directory
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    # Jobs are queued but not run, tests of the workers use app.JobQueue directly
+    monkeypatch.setattr(app, "create_job_queue", lambda db: app.JobQueue(db))
+    flask_app = app.create_app(str(tmp_path / "app.db"), scheduler=False, warmup="off")
+    yield flask_app.test_client()
+    app.db.close_all()
@@ -0,0 +1,66 @@
+import threading
+
+import pytest
+
+import app
+
+def test_single_flight_merges_concurrent_calls():
+    flight = app.SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+    def call():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "answer"
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("k", call)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do("k", call))) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    while flight.stats()["merged"] < 3:
+        threading.Event().wait(0.01)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+    assert results == ["answer"] * 4
+    assert len(calls) == 1
+    assert flight.stats() == {"calls": 1, "merged": 3, "in_flight": 0}
+
+def test_single_flight_errors_reach_every_caller_and_are_not_kept():
+    flight = app.SingleFlight()
+    def fail():
+        raise ValueError("upstream down")
+    with pytest.raises(ValueError):
+        flight.do("k", fail)
+    assert flight.do("k", lambda: "ok") == "ok"
+
+def test_request_key_ignores_whitespace():
+    assert app.request_key("ask", q="how  to\nraid") == app.request_key("ask", q=" how to raid ")
+    assert app.request_key("ask", q="how to raid") != app.request_key("image", q="how to raid")
+
+def test_admission_per_user_bucket():
+    admission = app.Admission(user_rate_per_minute=60, user_burst=2, global_rate=0)
+    admission.admit_user("u1")
+    admission.admit_user("u1")
+    with pytest.raises(app.Overloaded) as error:
+        admission.admit_user("u1")
+    assert 0 < error.value.retry_after <= 1
+    admission.admit_user("u2")  # Buckets are per user
+    assert admission.stats()["rejected_user"] == 1
+
+def test_admission_global_queue_is_bounded():
+    admission = app.Admission(user_rate_per_minute=0, global_rate=1, global_burst=1, max_wait=0.05, max_waiters=1)
+    admission.admit()
+    with pytest.raises(app.Overloaded):
+        admission.admit()  # The next token is a second away, longer than max_wait
+    stats = admission.stats()
+    assert (stats["admitted"], stats["rejected_global"], stats["waiting"]) == (1, 1, 0)
+
+def test_admission_waits_for_a_token():
+    admission = app.Admission(user_rate_per_minute=0, global_rate=50, global_burst=1, max_wait=1, max_waiters=4)
+    admission.admit()
+    admission.admit()
+    assert admission.stats()["waited"] == 1
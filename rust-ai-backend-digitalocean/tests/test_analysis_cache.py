@@ -0,0 +1,24 @@
+import io
+
+import app
+
+def test_identical_uploads_are_analyzed_once(client, upload_dir, monkeypatch):
+    calls = []
+    analyze_json = app.analyze_json
+    monkeypatch.setattr(app, "analyze_json", lambda source: calls.append(1) or analyze_json(source))
+    before = app.analysis_cache.stats()["hits"]  # The cache is global, other tests use it too
+    for name in ("a.json", "b.json"):  # Same content, any name
+        response = client.post("/upload_file", data={"file": (io.BytesIO(b'{"k": 1}'), name), "action": "process",
+                                                     "async": "0"}, content_type="multipart/form-data")
+        assert response.json["response"] == "📂 JSON analyzed: Main keys: k"
+    assert len(calls) == 1
+    assert client.get("/cache_stats").json["hits"] == before + 1
+
+def test_analysis_cache_versions(db, monkeypatch):
+    cache = app.AnalysisCache()
+    cache.use(db)
+    assert cache.get_or_compute("hash", "summary", lambda: "v1") == "v1"
+    assert cache.get_or_compute("hash", "summary", lambda: "other") == "v1"
+    assert cache.get_or_compute("hash", "summary", lambda: "variant", variant="x") == "variant"
+    monkeypatch.setitem(app.ANALYZER_VERSIONS, "summary", 2)  # A new analyzer version ignores old results
+    assert cache.get_or_compute("hash", "summary", lambda: "v2") == "v2"
@@ -0,0 +1,68 @@
+import io
+import json
+
+import pytest
+
+import app
+
+def column(batches):
+    stats = app.ColumnStats("value")
+    for batch in batches:
+        stats.update(batch)
+    return stats
+
+def test_column_kinds_and_nulls():
+    stats = column([["3", "", "12"], ["-4", " "]])
+    assert (stats.kind, stats.nulls, stats.min, stats.max) == ("int", 2, -4, 12)
+    stats = column([["3", "12"], ["2.5"]])
+    assert (stats.kind, stats.min, stats.max) == ("float", 2.5, 12.0)
+
+def test_widening_to_text_compares_all_values_as_text():
+    stats = column([["9", "10"], ["1.5"], ["apple"]])
+    assert stats.kind == "text"
+    assert (stats.min, stats.max) == ("1.5", "apple")
+    stats = column([["9", "10", "100"], ["x"]])  # "10" sorts before "100" though it is between 9 and 100
+    assert (stats.min, stats.max) == ("10", "x")
+    stats = column([["2.50"], ["x"]])
+    assert stats.min == "2.50"
+
+@pytest.mark.parametrize("value", ["nan", "inf", "-Infinity"])
+def test_non_finite_values_are_text(value):
+    stats = column([["1", "2.5"], [value]])
+    assert stats.kind == "text"
+    assert (stats.min, stats.max) == (min("1", "2.5", value), max("1", "2.5", value))
+
+def test_analyze_csv_in_batches(monkeypatch):
+    monkeypatch.setattr(app, "CSV_BATCH_ROWS", 2)
+    rows = ["name,score,note"] + [f"player{i},{i * 10},{'' if i % 2 else 'ok'}" for i in range(1, 8)] + ["short"]
+    data = io.BytesIO("\n".join(rows).encode())
+    result = app.analyze_csv(data)
+    assert "9 rows and 3 columns" in result
+    assert "score: int, 1 nulls, min 10, max 70" in result
+    assert "note: text, 5 nulls, min 'ok', max 'ok'" in result
+
+@pytest.mark.parametrize("document", [
+    {"a": 1, "b": {"c": [1, 2, {"d": "}"}]}, "e\\\"f": "x,y", "g": [], "h": None},
+    [1, "two", {"three": [3, 4]}, [5, 6], None],
+    [],
+    [0],
+    {},
+    {"nested": {"deep": {"deeper": ["a,b", "c]d"]}}},
+])
+def test_scan_json_top_level_matches_json_module(document, monkeypatch):
+    monkeypatch.setattr(app, "JSON_CHUNK_CHARS", 3)  # Tokens and escapes split across chunks
+    text = json.dumps(document)
+    top, found = app.scan_json_top_level(io.StringIO(text))
+    if isinstance(document, dict):
+        assert (top, found) == ("object", list(document))
+    else:
+        assert (top, found) == ("array", len(document))
+
+def test_scan_json_escaped_key_split_across_chunks(monkeypatch):
+    for size in range(1, 12):
+        monkeypatch.setattr(app, "JSON_CHUNK_CHARS", size)
+        assert app.scan_json_top_level(io.StringIO('{"k\\\\\\"ey": 1, "z": 2}')) == ("object", ['k\\"ey', "z"])
+
+def test_analyze_json_not_a_document():
+    assert app.analyze_json(io.BytesIO(b'"just a string"')).endswith("Not a valid JSON object")
+    assert "array with 2 items" in app.analyze_json(io.BytesIO(b"[1, 2]"))
@@ -0,0 +1,42 @@
+import threading
+
+import pytest
+
+import app
+
+@pytest.fixture
+def overlap(monkeypatch):
+    chat_started = threading.Event()
+    analyzed = threading.Event()
+    def annotate_text(text, timeout=None):
+        assert chat_started.wait(5), "the analysis ran before the OpenAI call"
+        analyzed.set()
+        return {"entities": [{"name": "turret", "type": "OTHER", "importance": 0.7}],
+                "sentiment": {"score": 0, "magnitude": 0}}
+    def chat(self, messages, **kwargs):
+        chat_started.set()
+        return "Place it behind a wall."
+    monkeypatch.setattr(app, "annotate_text", annotate_text)
+    monkeypatch.setattr(app.OpenAIClient, "chat", chat)
+    return analyzed
+
+def test_entity_analysis_overlaps_the_openai_call(db, overlap):
+    client = app.FlaskApp(db, app.OpenAIClient(), concurrent=True).app.test_client()
+    response = client.post("/ask_rust", json={"user_id": "u1", "message": "where do I put a turret"})
+    assert response.json == "Place it behind a wall."
+    assert overlap.wait(5)
+    for _ in range(100):
+        if db.get_top_entities("u1"):
+            break
+        threading.Event().wait(0.02)
+    assert [entity["name"] for entity in db.get_top_entities("u1")] == ["turret"]
+
+def test_entity_analysis_errors_do_not_fail_the_request(db, monkeypatch):
+    def annotate_text(text, timeout=None):
+        raise TimeoutError("deadline exceeded")
+    monkeypatch.setattr(app, "annotate_text", annotate_text)
+    monkeypatch.setattr(app.OpenAIClient, "chat", lambda self, messages, **kwargs: "ok")
+    client = app.FlaskApp(db, app.OpenAIClient(), concurrent=False).app.test_client()
+    response = client.post("/ask_rust", json={"user_id": "u1", "message": "hello"})
+    assert (response.status_code, response.json) == (200, "ok")
+    assert db.get_user_history("u1") == [("question", "hello"), ("answer", "ok")]
@@ -0,0 +1,46 @@
+import pytest
+
+import app
+
+@pytest.fixture
+def fake_upstream(monkeypatch):
+    prompts = []
+    def chat(self, messages, **kwargs):
+        prompts.append(messages[0]["content"])
+        return f"answer to {messages[-1]['content']}"
+    def annotate_text(text, timeout=None):
+        return {"entities": [{"name": "raiding", "type": "OTHER", "importance": 0.8}],
+                "sentiment": {"score": 0.5, "magnitude": 0.9}}
+    monkeypatch.setattr(app.OpenAIClient, "chat", chat)
+    monkeypatch.setattr(app, "annotate_text", annotate_text)
+    return prompts
+
+def test_batch_answers_in_request_order_and_saves_everything(client, fake_upstream):
+    items = [{"user_id": "a", "message": "first"}, {"user_id": 42, "message": "hello"},
+             {"user_id": "a", "message": "second"}]
+    response = client.post("/ask_rust/batch", json={"messages": items})
+    assert response.status_code == 200
+    assert [result["response"] for result in response.json["results"]] == [
+        "answer to first", "answer to hello", "answer to second"]
+    assert app.db.get_user_history("a") == [("question", "first"), ("answer", "answer to first"),
+                                            ("question", "second"), ("answer", "answer to second")]
+    assert app.db.get_user_history("42") == [("question", "hello"), ("answer", "answer to hello")]
+    assert app.db.get_profile("a")["interest"] == "raiding"
+    assert [entity["name"] for entity in app.db.get_top_entities("a")] == ["raiding"]
+
+def test_batch_prompt_includes_earlier_messages_of_the_same_batch(client, fake_upstream):
+    client.post("/ask_rust/batch", json=[{"user_id": "a", "message": "my base is in the snow"},
+                                         {"user_id": "a", "message": "where should I farm"}])
+    assert "my base is in the snow" in fake_upstream[1]
+
+def test_batch_rejects_invalid_items(client, fake_upstream):
+    response = client.post("/ask_rust/batch", json={"messages": [
+        {"user_id": "a", "message": "ok"}, {"user_id": True, "message": "x"}, {"user_id": "b", "message": " "}, "text"]})
+    statuses = [result.get("status") for result in response.json["results"]]
+    assert statuses == [None, 400, 400, 400]
+    assert client.post("/ask_rust/batch", json={"messages": []}).status_code == 400
+
+def test_batch_size_limit(client, fake_upstream, monkeypatch):
+    monkeypatch.setattr(app, "BATCH_MAX_ITEMS", 2)
+    response = client.post("/ask_rust/batch", json=[{"user_id": "a", "message": "m"}] * 3)
+    assert response.status_code == 413
@@ -0,0 +1,22 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def test_every_scenario_runs_against_the_stand_ins(tmp_path):
+    command = [sys.executable, "bench_load.py", "--requests", "4", "--concurrency", "2", "--users", "2",
+               "--upload-kb", "1", "--openai-latency", "0", "--openai-jitter", "0", "--nlp-latency", "0",
+               "--nlp-jitter", "0", "--token-delay", "0", "--port", str(free_port()), "--workdir", str(tmp_path)]
+    output = subprocess.run(command, cwd=APP_DIR, capture_output=True, text=True, timeout=120, check=True).stdout
+    results = [json.loads(line) for line in output.splitlines() if line.startswith("{")]
+    assert [result["scenario"] for result in results] == [
+        "ask_rust", "ask_rust_stream", "ask_general", "ask_general_stream", "generate_image", "upload_file"]
+    assert all(result["ok"] == 4 and result["errors"] == 0 for result in results)
@@ -0,0 +1,88 @@
+import threading
+
+import app
+
+def test_migrations_are_applied_once(db):
+    assert db.get_schema_version() == app.MIGRATIONS[-1][0]
+    # Opening the same file again finds nothing to do
+    again = app.Database(db.db_file)
+    assert again.get_schema_version() == app.MIGRATIONS[-1][0]
+    again.close_all()
+
+def test_hot_queries_use_indexes(db):
+    db.check_query_plans()
+
+def test_concurrent_profile_creation(db):
+    # Two workers (Database instances on one file) creating the same new profiles
+    other = app.Database(db.db_file)
+    users = [f"new_user_{i}" for i in range(100)]
+    errors = []
+    barrier = threading.Barrier(4)
+
+    def create(database):
+        barrier.wait()
+        for user_id in users:
+            try:
+                database.create_profile_if_not_exists(user_id)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=create, args=(database,)) for database in (db, other, db, other)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    other.close_all()
+    assert errors == []
+    assert db.get_profile("new_user_7") == {"role": "player", "tone": "relaxed attitude",
+                                            "interest": "learning about Rust"}
+
+def test_profile_creation_keeps_existing_categories(db):
+    db.update_profile("u", {"tone": "toxic"})
+    db.create_profile_if_not_exists("u")
+    assert db.get_profile("u")["tone"] == "toxic"
+    assert db.get_prompt_context("u")["profile"]["tone"] == "toxic"
+
+def test_write_behind_reads_see_own_writes(write_behind_db):
+    db = write_behind_db
+    db.create_profile_if_not_exists("u")
+    db.update_profile("u", {"tone": "toxic"})
+    assert db.get_profile("u")["tone"] == "toxic"
+    db.save_message("u", "s", "question", "where is the outpost")
+    assert db.get_user_history("u") == [("question", "where is the outpost")]
+
+def test_write_behind_prompt_context_without_validation(write_behind_db, monkeypatch):
+    monkeypatch.setattr(app, "CONTEXT_CACHE_VALIDATE", False)
+    db = write_behind_db
+    db.create_profile_if_not_exists("u")
+    db.update_profile("u", {"tone": "toxic"})
+    db.contexts = app.ContextCache()  # A cache miss
+    assert db.get_prompt_context("u")["profile"]["tone"] == "toxic"
+
+def test_context_cache_entities_are_not_shared_with_readers():
+    cache = app.ContextCache()
+    cache.begin_load("u1")
+    cache.finish_load("u1", app.UserContext({}, None, []))
+    entities = [{"name": "rock", "type": "item", "importance": 1.0, "mentions": 1, "max_importance": 1.0}]
+    cache.set_entities("u1", entities)
+    before = cache.snapshot("u1")
+    cache.on_entities("u1", [{"name": "rock", "type": "item", "importance": 2.0}])
+    assert entities[0]["importance"] == 1.0
+    assert before["entities"][0]["importance"] == 1.0
+    after = cache.snapshot("u1")
+    assert (after["entities"][0]["importance"], after["entities"][0]["mentions"]) == (3.0, 2)
+
+def test_connections_are_reused_per_thread_and_pruned(db):
+    conn = db.get_connection()
+    assert db.get_connection() is conn
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    other = []
+    thread = threading.Thread(target=lambda: other.append(db.get_connection()))
+    thread.start()
+    thread.join()
+    assert other[0] is not conn
+    stats = db.pool_stats()  # The finished thread's connection is closed
+    assert (stats["open_connections"], stats["closed"]) == (1, 1)
+    db.close_all()
+    assert db.pool_stats()["open_connections"] == 0
+    assert db.get_connection() is not conn
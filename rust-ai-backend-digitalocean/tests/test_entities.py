@@ -0,0 +1,36 @@
+import time
+
+import pytest
+
+import app
+
+def entity(name, importance, type="OTHER"):
+    return {"name": name, "type": type, "importance": importance}
+
+def test_top_entities_aggregate_mentions(db):
+    db.save_entities("u1", [entity("rock", 0.2), entity("sulfur", 0.5)])
+    db.save_entities("u1", [entity("rock", 0.4)])
+    db.save_entities("u2", [entity("wood", 0.9)])
+    top = db.get_top_entities("u1", k=5)
+    assert [(e["name"], e["mentions"], e["max_importance"]) for e in top] == [("rock", 2, 0.4), ("sulfur", 1, 0.5)]
+    assert top[0]["importance"] == pytest.approx(0.6, rel=1e-3)
+    assert [e["name"] for e in db.get_top_entities("u1", k=1)] == ["rock"]
+
+def test_older_mentions_weigh_less(db, monkeypatch):
+    now = time.time()
+    monkeypatch.setattr(app.time, "time", lambda: now - 14 * 86400)  # Two half-lives ago
+    db.save_entities("u1", [entity("old", 1.0)])
+    monkeypatch.setattr(app.time, "time", lambda: now)
+    db.save_entities("u1", [entity("new", 0.5)])
+    top = db.get_top_entities("u1")
+    assert [e["name"] for e in top] == ["new", "old"]
+    assert top[1]["importance"] == pytest.approx(0.25, rel=1e-3)
+
+def test_decay_epoch_moves_forward_without_changing_the_ranking(db, monkeypatch):
+    db.save_entities("u1", [entity("a", 1.0), entity("b", 0.5)])
+    later = time.time() + (app.ENTITY_REBASE_HALF_LIVES + 1) * app.ENTITY_HALF_LIFE_DAYS * 86400
+    monkeypatch.setattr(app.time, "time", lambda: later)
+    db.save_entities("u1", [entity("c", 0.1)])
+    with db.get_connection() as conn:
+        assert conn.execute("SELECT epoch FROM decay_epochs WHERE name = 'entity_stats'").fetchone()[0] == later
+    assert [e["name"] for e in db.get_top_entities("u1")] == ["c", "a", "b"]
@@ -0,0 +1,66 @@
+import io
+
+import pytest
+
+import app
+
+fitz = pytest.importorskip("fitz")
+
+@pytest.fixture
+def pdf_bytes():
+    doc = fitz.open()
+    for number in range(1, 41):
+        doc.new_page().insert_text((72, 72), f"page{number} raid base")
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+def upload(client, data, **form):
+    form = {"file": (io.BytesIO(data), "book.pdf"), "action": "process", "async": "0", **form}
+    return client.post("/upload_file", data=form, content_type="multipart/form-data")
+
+def test_parse_page_range():
+    assert app.parse_page_range(None) is None
+    assert app.parse_page_range("3-10") == (2, 10)
+    assert app.parse_page_range("4") == (3, 4)
+    for value in ("0-3", "5-2", "a-b"):
+        with pytest.raises(ValueError):
+            app.parse_page_range(value)
+
+def test_pdf_first_pages_by_default(client, pdf_bytes):
+    response = upload(client, pdf_bytes)
+    assert response.status_code == 200
+    assert "PDF analyzed: 15 words" in response.json["response"]  # Pages 1-5
+
+def test_pdf_page_range(client, pdf_bytes):
+    response = upload(client, pdf_bytes, pages="39-40")
+    assert "PDF analyzed: 6 words" in response.json["response"]
+    assert "page39" in response.json["response"]
+
+def test_pdf_full_document(client, pdf_bytes, monkeypatch):
+    monkeypatch.setattr(app, "PDF_PAGES_PER_TASK", 8)  # Goes through the process pool
+    response = upload(client, pdf_bytes, full="1")
+    assert "PDF analyzed: 120 words" in response.json["response"]
+
+def test_invalid_page_range(client, pdf_bytes):
+    assert upload(client, pdf_bytes, pages="9-2").status_code == 400
+
+def test_summarize_action_reads_the_pdf(client, pdf_bytes, tmp_path, monkeypatch):
+    sent = []
+
+    class Completions:
+        def create(self, messages, **kwargs):
+            sent.append(messages[-1]["content"])
+            message = type("Message", (), {"content": " A raid diary. "})
+            return type("Response", (), {"choices": [type("Choice", (), {"message": message})]})
+
+    fake = type("Client", (), {"chat": type("Chat", (), {"completions": Completions()})})
+    monkeypatch.setattr(app, "get_openai_client", lambda: fake)
+    path = tmp_path / "book.pdf"
+    path.write_bytes(pdf_bytes)
+    content_hash = app.file_sha256(str(path))
+    assert app.run_file_action("summarize it", "book.pdf", str(path), content_hash) == "A raid diary."
+    assert sent[0].startswith("page1 raid base")
+    # Cached by content hash
+    assert app.run_file_action("summarize it", "book.pdf", str(path), content_hash) == "A raid diary."
+    assert len(sent) == 1
@@ -0,0 +1,145 @@
+import io
+import threading
+import time
+
+import pytest
+
+import app
+
+@pytest.fixture(autouse=True)
+def fast_jobs(monkeypatch):
+    monkeypatch.setattr(app, "JOB_RETRY_DELAY", 0)
+    monkeypatch.setattr(app, "JOB_POLL_SECONDS", 0.02)
+    monkeypatch.setattr(app, "JOB_LEASE_SECONDS", 0.3)
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+def test_failed_job_is_retried(db):
+    calls = []
+
+    def flaky(payload):
+        calls.append(payload)
+        if len(calls) == 1:
+            raise RuntimeError("upstream timeout")
+        return {"ok": payload["n"]}
+
+    jobs = app.JobQueue(db)
+    jobs.register("work", flaky)
+    job_id = jobs.enqueue("work", "u", {"n": 1})
+    jobs.start()
+    try:
+        assert wait_for(lambda: jobs.get(job_id)["status"] == "done")
+    finally:
+        jobs.stop()
+    job = jobs.get(job_id)
+    assert job["attempts"] == 2 and job["result"] == {"ok": 1} and len(calls) == 2
+
+def test_job_fails_after_max_attempts(db):
+    finished = []
+    jobs = app.JobQueue(db)
+    jobs.register("work", lambda payload: 1 / 0, on_finish=finished.append)
+    job_id = jobs.enqueue("work", "u", {}, max_attempts=2)
+    jobs.start()
+    try:
+        assert wait_for(lambda: jobs.get(job_id)["status"] == "failed")
+    finally:
+        jobs.stop()
+    assert jobs.get(job_id)["attempts"] == 2 and finished == [{}]
+
+def test_running_job_keeps_its_lease(db):
+    # A long job of one worker process is not taken over by another process starting meanwhile
+    release = threading.Event()
+    calls = []
+
+    def slow(payload):
+        calls.append(payload)
+        release.wait(5)
+        return "done"
+
+    first = app.JobQueue(db)
+    first.register("work", slow)
+    job_id = first.enqueue("work", "u", {})
+    first.start()
+    second = app.JobQueue(app.Database(db.db_file))
+    second.register("work", slow)
+    try:
+        assert wait_for(lambda: calls)
+        time.sleep(1)  # Several lease lengths
+        second.start()
+        time.sleep(0.5)
+        assert jobs_status(first, job_id) == ("running", 1)
+        release.set()
+        assert wait_for(lambda: first.get(job_id)["status"] == "done")
+    finally:
+        release.set()
+        first.stop()
+        second.stop()
+    assert len(calls) == 1
+
+def jobs_status(jobs, job_id):
+    job = jobs.get(job_id)
+    return job["status"], job["attempts"]
+
+def test_expired_lease_is_taken_over(db):
+    jobs = app.JobQueue(db)
+    jobs.register("work", lambda payload: "recovered")
+    job_id = jobs.enqueue("work", "u", {})
+    # Claimed by a worker that died without finishing
+    with db.get_connection() as conn:
+        conn.execute("UPDATE jobs SET status = 'running', attempts = 1, lease_owner = 'dead', lease_expires = ? "
+                     "WHERE id = ?", (time.time() - 1, job_id))
+    jobs.start()
+    try:
+        assert wait_for(lambda: jobs.get(job_id)["status"] == "done")
+    finally:
+        jobs.stop()
+    assert jobs.get(job_id)["result"] == "recovered"
+
+def test_lost_lease_leaves_the_outcome_to_the_new_owner(db):
+    jobs = app.JobQueue(db)
+    jobs.register("work", lambda payload: None)
+    job_id = jobs.enqueue("work", "u", {})
+    _, _, _, _, owner = jobs._claim("work")
+    with db.get_connection() as conn:
+        conn.execute("UPDATE jobs SET lease_owner = 'other' WHERE id = ?", (job_id,))
+    assert not jobs._finish(job_id, owner, "done", result="stale")
+    assert jobs.get(job_id)["status"] == "running"
+
+def test_worker_survives_database_errors(db, monkeypatch):
+    jobs = app.JobQueue(db)
+    jobs.register("work", lambda payload: "ok")
+    finish = jobs._finish
+    failures = []
+
+    def flaky_finish(*args, **kwargs):
+        if not failures:
+            failures.append(args)
+            raise app.sqlite3.OperationalError("database is locked")
+        return finish(*args, **kwargs)
+
+    monkeypatch.setattr(jobs, "_finish", flaky_finish)
+    first = jobs.enqueue("work", "u", {})
+    jobs.start()
+    try:
+        # The first outcome was lost, the job is retried once its lease expires
+        assert wait_for(lambda: jobs.get(first)["status"] == "done")
+        second = jobs.enqueue("work", "u", {})
+        assert wait_for(lambda: jobs.get(second)["status"] == "done")
+    finally:
+        jobs.stop()
+    assert jobs.get(first)["attempts"] == 2
+
+def test_upload_priority_is_clamped(client):
+    response = client.post("/upload_file", data={
+        "file": (io.BytesIO(b"hello"), "notes.txt"), "async": "1", "priority": "999999"
+    }, content_type="multipart/form-data")
+    assert response.status_code == 202
+    job_id = response.json["job_id"]
+    with app.db.get_connection() as conn:
+        assert conn.execute("SELECT priority FROM jobs WHERE id = ?", (job_id,)).fetchone()[0] == app.JOB_MAX_PRIORITY
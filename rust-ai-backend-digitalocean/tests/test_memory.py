@@ -0,0 +1,65 @@
+import threading
+
+import pytest
+
+import app
+
+class RecordingEmbedder(app.HashingEmbedder):
+    def __init__(self):
+        super().__init__()
+        self.threads = []
+
+    def __call__(self, texts):
+        self.threads.append(threading.current_thread().name)
+        return super().__call__(texts)
+
+@pytest.fixture
+def memory_db(db, tmp_path):
+    embedder = RecordingEmbedder()
+    db.memory = app.MemoryIndex(db, directory=str(tmp_path / "memory"), embedder=embedder)
+    embedder.threads.clear()  # Drop the dimension probe
+    yield db, embedder
+
+def test_saves_are_indexed_off_the_request_thread(memory_db):
+    db, embedder = memory_db
+    db.save_message("alice", "s1", "question", "how do I defend my base against a raid")
+    db.save_message("alice", "s1", "answer", "build walls and turrets around your base")
+    db.memory.flush()
+    assert embedder.threads
+    assert all(name.startswith("memory") for name in embedder.threads)
+    results = db.memory.search("alice", "raid defense for my base", min_score=0)
+    assert {result["content"] for result in results} >= {"how do I defend my base against a raid"}
+
+def test_first_search_builds_in_the_background(memory_db, tmp_path):
+    db, _ = memory_db
+    db.save_message("bob", "s1", "question", "where can I find sulfur ore")
+    db.memory.flush()
+    # A fresh index over an empty directory has to build bob's memory from the database
+    db.memory.close()
+    db.memory = app.MemoryIndex(db, directory=str(tmp_path / "rebuilt"), embedder=RecordingEmbedder())
+    assert db.memory.search("bob", "sulfur ore", min_score=0) == []
+    db.memory.flush()
+    assert [result["content"] for result in db.memory.search("bob", "sulfur ore", min_score=0)] == [
+        "where can I find sulfur ore"]
+
+def test_write_behind_saves_are_indexed(write_behind_db, tmp_path):
+    db = write_behind_db
+    db.memory = app.MemoryIndex(db, directory=str(tmp_path / "memory"), embedder=RecordingEmbedder())
+    for i in range(5):
+        db.save_message("carol", "s1", "question", f"question {i} about metal fragments")
+    db.memory.flush()
+    contents = [result["content"] for result in db.memory.search("carol", "metal fragments", k=10, min_score=0)]
+    assert sorted(contents) == [f"question {i} about metal fragments" for i in range(5)]
+
+def test_indexing_errors_do_not_stop_the_indexer(memory_db):
+    db, embedder = memory_db
+    def broken(texts):
+        raise RuntimeError("embedding service down")
+    db.memory.embed = broken
+    db.save_message("dave", "s1", "question", "lost message")
+    db.memory.flush()
+    db.memory.embed = embedder
+    db.save_message("dave", "s1", "question", "kept message about cloth")
+    db.memory.flush()
+    assert "kept message about cloth" in [
+        result["content"] for result in db.memory.search("dave", "cloth", k=10, min_score=0)]
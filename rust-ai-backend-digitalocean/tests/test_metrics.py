@@ -0,0 +1,20 @@
+import app
+
+def sample_names(text):
+    return [line.split(" ")[0] for line in text.splitlines() if line and not line.startswith("#")]
+
+def test_metrics_have_no_duplicate_samples(client, tmp_path):
+    client.get("/metrics")
+    # A second app in the same process replaces the collectors of the first one
+    second = app.create_app(str(tmp_path / "second.db"), scheduler=False, warmup="off").test_client()
+    text = second.get("/metrics").get_data(as_text=True)
+    names = sample_names(text)
+    assert "app_db_pool_opened" in names
+    assert len(names) == len(set(names))
+
+def test_collector_errors_do_not_break_metrics():
+    metrics = app.Metrics()
+    metrics.add_collector("broken", lambda: 1 / 0)
+    metrics.add_collector("cache", lambda: {"hits": 3, "enabled": True, "name": "x"})
+    names = sample_names(metrics.render())
+    assert names == ["app_cache_hits", "app_cache_enabled"]
@@ -0,0 +1,54 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import app
+
+class FakeLanguageClient:
+    def __init__(self):
+        self.requests = []
+
+    def annotate_text(self, request, timeout=None):
+        self.requests.append(request)
+        return SimpleNamespace(
+            entities=[SimpleNamespace(name="raid", type_=7, salience=0.8)],
+            document_sentiment=SimpleNamespace(score=-0.4, magnitude=1.2))
+
+@pytest.fixture
+def language_client(monkeypatch):
+    pytest.importorskip("google.cloud.language_v1")
+    client = FakeLanguageClient()
+    monkeypatch.setattr(app, "get_language_client", lambda: client)
+    monkeypatch.setattr(app, "nlp_cache", app.NLPCache())
+    return client
+
+def test_entities_and_sentiment_share_one_call(language_client):
+    assert app.analyze_entities("I love to  raid") == [{"name": "raid", "type": "OTHER", "importance": 0.8}]
+    assert app.analyze_sentiment("i love to raid") == (-0.4, 1.2)  # Same text once normalized
+    assert len(language_client.requests) == 1
+    features = language_client.requests[0]["features"]
+    assert features == {"extract_entities": True, "extract_document_sentiment": True}
+    assert app.nlp_cache.stats()["hits"] == 1
+
+def test_persisted_results_survive_a_restart(db):
+    cache = app.NLPCache()
+    cache.persist_to(db)
+    cache.put("hello", {"entities": [], "sentiment": {"score": 0, "magnitude": 0}})
+    restarted = app.NLPCache()
+    restarted.persist_to(db)
+    assert restarted.get("  HELLO ") == {"entities": [], "sentiment": {"score": 0, "magnitude": 0}}
+    assert restarted.stats()["persistent_hits"] == 1
+
+def test_expired_and_excess_results_are_dropped(db, monkeypatch):
+    cache = app.NLPCache(max_size=2, ttl=60, max_rows=3)
+    cache.persist_to(db)
+    for i in range(5):
+        cache.put(f"text {i}", {"i": i})
+    assert cache.stats()["size"] == 2
+    cache.evict()
+    with db.get_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM nlp_cache").fetchone()[0] == 3
+    now = time.time()
+    monkeypatch.setattr(app.time, "time", lambda: now + 61)
+    assert cache.get("text 4") is None
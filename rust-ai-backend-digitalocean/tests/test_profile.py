@@ -0,0 +1,41 @@
+import pytest
+
+import app
+
+def naive_matches(keywords, text):
+    return [(keyword, value) for keyword, value in keywords.items() if keyword.lower() in text.lower()]
+
+@pytest.mark.parametrize("text", [
+    "I love Construction and raiding with my team",
+    "playing solo bothers me",
+    "hatehate ushers she hers",
+    "nothing here",
+    "",
+])
+def test_keyword_matcher_matches_substring_search(text):
+    keywords = {**app.PROFILE_KEYWORDS, "he": "x", "she": "y", "his": "z", "hers": "w", "usher": "v"}
+    assert app.KeywordMatcher(keywords).matches(text) == naive_matches(keywords, text)
+
+def test_keyword_matcher_from_file(tmp_path):
+    path = tmp_path / "keywords.json"
+    path.write_text('{"farming": "interest", "pvp": "style"}', encoding="utf-8")
+    matcher = app.KeywordMatcher.from_file(str(path))
+    assert matcher.matches("PVP and farming") == [("farming", "interest"), ("pvp", "style")]
+
+def analysis(magnitude, *names):
+    return {"sentiment": {"score": 0.5, "magnitude": magnitude},
+            "entities": [{"name": name, "type": "OTHER", "importance": 0.5} for name in names]}
+
+def test_profile_changes():
+    assert app.profile_changes(analysis(0.1, "raiding")) == {}
+    assert app.profile_changes(analysis(0.9, "base defense", "team play", "Raiding")) == {
+        "interest": "raiding", "style": "team play"}
+
+def test_update_profile_dynamically_upserts(db):
+    db.create_profile_if_not_exists("u1")
+    changes = app.update_profile_dynamically("u1", "", analysis(0.9, "base construction", "solo"), db)
+    assert changes == {"interest": "base construction"}
+    app.update_profile_dynamically("u1", "", analysis(0.9, "raiding"), db)
+    profile = db.get_profile("u1")
+    assert profile["interest"] == "raiding"
+    assert profile["role"] == "player"
@@ -0,0 +1,26 @@
+import app
+
+def context(history=(), summary=None, memories=None):
+    return {"profile": {"role": "player", "tone": "chill", "interest": "raids"},
+            "entities": [{"name": "outpost"}], "history": list(history), "summary": summary,
+            "memories": memories}
+
+def test_nothing_saved_when_everything_fits():
+    prompt, report = app.PromptBuilder(budget=2000).build("u", context(
+        [("question", "where is the outpost"), ("answer", "north of the dome")],
+        summary="Likes raiding.", memories=[{"type": "question", "content": "best gun"}]))
+    assert report["tokens_saved"] == 0
+    assert report["turns_dropped"] == 0 and report["summary_used"] and report["memories_used"] == 1
+    assert report["prompt_tokens"] == app.count_tokens(prompt)
+
+def test_tokens_saved_when_history_is_cut():
+    history = [("question", f"message number {i} about the big raid tonight") for i in range(200)]
+    prompt, report = app.PromptBuilder(budget=300).build("u", context(history, summary="Likes raiding. " * 200))
+    assert report["prompt_tokens"] <= 300
+    assert report["turns_dropped"] > 0
+    assert report["tokens_saved"] > 0
+    assert "Summary of earlier conversation" in prompt
+
+def test_tokens_saved_is_never_negative():
+    _, report = app.PromptBuilder(budget=50).build("u", context([("question", "hi")], summary="Short."))
+    assert report["tokens_saved"] >= 0
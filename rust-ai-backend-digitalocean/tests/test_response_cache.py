@@ -0,0 +1,54 @@
+import app
+
+def counting(value):
+    calls = []
+    def compute():
+        calls.append(1)
+        return value
+    return compute, calls
+
+def test_disabled_cache_always_computes():
+    cache = app.ResponseCache()
+    compute, calls = counting("answer")
+    for _ in range(2):
+        entry = cache.get_or_compute("chat", "k", compute, 60)
+        assert (entry.value, entry.hit, entry.expires_at) == ("answer", False, None)
+    assert len(calls) == 2
+    assert cache.headers(entry) == {}
+
+def test_cache_hits_from_memory_and_sqlite(db):
+    cache = app.ResponseCache()
+    cache.enable(db)
+    key = app.request_key("chat", q="how to raid")
+    compute, calls = counting("answer")
+    assert cache.get_or_compute("chat", key, compute, 60).hit is False
+    assert cache.get_or_compute("chat", key, compute, 60).hit is True
+    # A fresh process only has the SQLite tier
+    restarted = app.ResponseCache()
+    restarted.enable(db)
+    entry = restarted.get_or_compute("chat", key, compute, 60)
+    assert (entry.value, entry.hit) == ("answer", True)
+    assert len(calls) == 1
+    assert cache.headers(entry)["X-Cache"] == "HIT"
+    stats = restarted.stats()
+    assert (stats["hits"], stats["memory_hits"], stats["entries"]) == (1, 0, 1)
+
+def test_expired_and_empty_responses_are_recomputed(db):
+    cache = app.ResponseCache()
+    cache.enable(db)
+    compute, calls = counting("answer")
+    cache.get_or_compute("chat", "expired", compute, 0)
+    cache.get_or_compute("chat", "expired", compute, 0)
+    empty, empty_calls = counting("")
+    cache.get_or_compute("image", "empty", empty, 60)
+    assert cache.get_or_compute("image", "empty", empty, 60).hit is False
+    assert (len(calls), len(empty_calls)) == (2, 2)
+
+def test_memory_tier_is_bounded_and_eviction_respects_max_bytes(db):
+    cache = app.ResponseCache(max_items=2, max_bytes=300)
+    cache.enable(db)
+    for i in range(5):
+        cache.get_or_compute("chat", f"key{i}", lambda: "x" * 100, 60)
+    assert cache.stats()["size"] == 2
+    cache.evict()
+    assert cache.stats()["bytes"] <= 300
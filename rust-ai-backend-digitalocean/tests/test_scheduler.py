@@ -0,0 +1,36 @@
+import time
+
+import app
+
+def test_lease_has_one_holder_until_it_expires_or_is_released(db):
+    assert db.acquire_lease("scheduler", "a", 0.2)
+    assert not db.acquire_lease("scheduler", "b", 0.2)
+    assert db.acquire_lease("scheduler", "a", 0.2)  # Renewal
+    time.sleep(0.25)
+    assert db.acquire_lease("scheduler", "b", 0.2)
+    db.release_lease("scheduler", "a")  # Not the holder, no effect
+    assert not db.acquire_lease("scheduler", "a", 0.2)
+    db.release_lease("scheduler", "b")
+    assert db.acquire_lease("scheduler", "a", 0.2)
+
+def test_only_one_scheduler_leads_and_another_takes_over(db):
+    passes = []
+    schedulers = [app.Scheduler(db, interval=3600, lease_seconds=0.3) for _ in range(2)]
+    for scheduler in schedulers:
+        scheduler.summarizer.run_pass = lambda keep_going, scheduler=scheduler: passes.append(scheduler.owner)
+        scheduler.start()
+    deadline = time.time() + 2
+    while not passes and time.time() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.2)
+    assert [scheduler.leader for scheduler in schedulers].count(True) == 1
+    first = next(scheduler for scheduler in schedulers if scheduler.leader)
+    other = next(scheduler for scheduler in schedulers if scheduler is not first)
+    first.stop()  # Releases the lease
+    deadline = time.time() + 2
+    while not other.leader and time.time() < deadline:
+        time.sleep(0.01)
+    took_over = other.leader
+    other.stop()
+    assert took_over
+    assert passes[0] == first.owner and other.owner in passes
@@ -0,0 +1,58 @@
+import base64
+import json
+
+import pytest
+
+import app
+
+def encode(cursor):
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+@pytest.fixture
+def search_client(client, monkeypatch):
+    monkeypatch.setattr(app, "SEARCH_TOKEN", "secret")
+    for number in range(25):
+        app.db.save_message("player_1", "s", "question", f"raid number {number} on the outpost")
+    app.db.save_message("player_2", "s", "question", "a quiet raid at night")
+    return client
+
+def search(client, token="secret", **args):
+    return client.get("/search", query_string=args, headers={"Authorization": f"Bearer {token}"})
+
+def test_search_requires_a_token(client, monkeypatch):
+    assert client.get("/search", query_string={"q": "raid"}).status_code == 403  # SEARCH_TOKEN not set
+    monkeypatch.setattr(app, "SEARCH_TOKEN", "secret")
+    assert client.get("/search", query_string={"q": "raid"}).status_code == 401
+    assert search(client, token="wrong", q="raid").status_code == 401
+    assert search(client, q="raid").status_code == 200
+
+@pytest.mark.parametrize("order", ["rank", "recent"])
+def test_cursor_pagination(search_client, order):
+    seen = []
+    cursor = None
+    while True:
+        args = {"q": "raid", "order": order, "limit": 7}
+        if cursor:
+            args["cursor"] = cursor
+        page = search(search_client, **args).json
+        seen += [result["id"] for result in page["results"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert len(seen) == len(set(seen)) == 26
+    if order == "recent":
+        assert seen == sorted(seen, reverse=True)
+
+def test_search_of_one_user(search_client):
+    results = search(search_client, q="raid", user_id="player_2").json["results"]
+    assert [result["user_id"] for result in results] == ["player_2"]
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!", encode({"rank": 1}), encode([[2], 1]), encode([1.5, "x"]), encode([1.5]),
+    encode([True, 1]), encode([1.5, 2 ** 70]), encode([1, 2, 3]),
+])
+def test_bad_cursors_are_rejected(search_client, cursor):
+    assert search(search_client, q="raid", cursor=cursor).status_code == 400
+
+def test_bad_recent_cursor(search_client):
+    assert search(search_client, q="raid", order="recent", cursor=encode([-1.0, 3])).status_code == 400
@@ -0,0 +1,24 @@
+import json
+import os
+import subprocess
+import sys
+
+import app
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_heavy_dependencies_are_not_imported_with_the_module():
+    code = ("import json, sys, app; "
+            "print(json.dumps([name for name in ('openai', 'fitz', 'tiktoken', 'numpy') if name in sys.modules]))")
+    env = {**os.environ, "OPENAI_API_KEY": "test"}
+    output = subprocess.run([sys.executable, "-c", code], cwd=APP_DIR, env=env, capture_output=True, text=True,
+                            check=True).stdout
+    assert json.loads(output.splitlines()[-1]) == []
+
+def test_warm_up_loads_the_tokenizer(monkeypatch):
+    monkeypatch.setattr(app, "get_openai_client", lambda: None)
+    monkeypatch.setattr(app, "get_language_client", lambda: None)
+    app.warm_up()
+    assert "tiktoken" in sys.modules
+    assert app._encoding is not None
+    assert app.count_tokens("hello world") > 0
@@ -0,0 +1,48 @@
+import json
+
+import pytest
+
+import app
+
+@pytest.fixture
+def upstream(monkeypatch):
+    state = {"chunks": ["Build ", "walls ", "first."], "fail_after": None, "closed": False}
+    def stream_chat(self, messages, temperature, max_tokens, timeout):
+        try:
+            for i, chunk in enumerate(state["chunks"]):
+                if state["fail_after"] == i:
+                    raise RuntimeError("connection reset")
+                yield chunk
+        finally:
+            state["closed"] = True
+    monkeypatch.setattr(app.OpenAIClient, "_stream_chat", stream_chat)
+    monkeypatch.setattr(app, "annotate_text", lambda text, timeout=None: {
+        "entities": [], "sentiment": {"score": 0, "magnitude": 0}})
+    return state
+
+def events(response):
+    return [json.loads(line[len("data: "):]) for line in response.get_data(as_text=True).splitlines()
+            if line.startswith("data: ")]
+
+def test_ask_rust_streams_and_saves_the_full_answer(client, upstream):
+    response = client.post("/ask_rust", json={"user_id": "u1", "message": "how to start", "stream": True})
+    assert response.mimetype == "text/event-stream"
+    assert int(response.headers["X-Prompt-Tokens"]) > 0
+    received = events(response)
+    assert [event["delta"] for event in received[:-1]] == upstream["chunks"]
+    assert received[-1] == {"done": True, "response": "Build walls first."}
+    assert upstream["closed"]
+    assert app.db.get_user_history("u1")[-1] == ("answer", "Build walls first.")
+
+def test_accept_header_asks_for_a_stream(client, upstream):
+    response = client.post("/ask_rust", json={"user_id": "u1", "message": "hi"},
+                           headers={"Accept": "text/event-stream"})
+    assert response.mimetype == "text/event-stream"
+
+def test_failed_stream_sends_an_error_and_saves_nothing(client, upstream):
+    upstream["fail_after"] = 1
+    response = client.post("/ask_rust", json={"user_id": "u1", "message": "how to start", "stream": True})
+    body = response.get_data(as_text=True)
+    assert "event: error" in body
+    assert events(response)[0] == {"delta": "Build "}
+    assert all(type != "answer" for type, _ in app.db.get_user_history("u1"))
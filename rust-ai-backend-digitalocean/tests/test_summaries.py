@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+
+import app
+
+class FakeOpenAI:
+    def __init__(self):
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, **kwargs):
+        self.requests.append(messages[-1]["content"])
+        summary = f"summary {len(self.requests)}"
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=summary))], usage=None)
+
+def save_questions(db, user_id, count, start=0):
+    for i in range(start, start + count):
+        db.save_message(user_id, "s1", "question", f"message {i}")
+
+def test_only_users_with_enough_new_messages_are_summarised(db):
+    save_questions(db, "busy", 3)
+    save_questions(db, "quiet", 1)
+    openai = FakeOpenAI()
+    summarizer = app.Summarizer(db, openai, workers=2, rate_per_minute=0, min_messages=3)
+    assert db.get_dirty_users(3) == ["busy"]
+    assert summarizer.run_pass() == 1
+    assert db.get_latest_summary("busy") == "summary 1"
+    assert db.get_dirty_users(1) == ["quiet"]  # The summary covered busy's messages
+
+def test_incremental_summary_only_sends_new_messages(db):
+    openai = FakeOpenAI()
+    summarizer = app.Summarizer(db, openai, workers=1, rate_per_minute=0, min_messages=1)
+    save_questions(db, "u1", 2)
+    assert summarizer.summarize_user("u1")
+    assert not summarizer.summarize_user("u1")  # Cooldown
+    with db.get_connection() as conn:  # Move the summary before the cooldown
+        conn.execute("UPDATE user_summaries SET timestamp = datetime('now', '-2 days')")
+    save_questions(db, "u1", 2, start=2)
+    assert summarizer.summarize_user("u1")
+    assert "Current summary:\nsummary 1" in openai.requests[1]
+    assert "message 1" not in openai.requests[1]
+    assert "message 3" in openai.requests[1]
+
+def test_keep_going_stops_a_pass(db):
+    save_questions(db, "u1", 2)
+    summarizer = app.Summarizer(db, FakeOpenAI(), workers=1, rate_per_minute=0, min_messages=1)
+    assert summarizer.run_pass(keep_going=lambda: False) == 0
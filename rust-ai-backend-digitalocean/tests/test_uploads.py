@@ -0,0 +1,35 @@
+import hashlib
+import io
+import os
+
+import pytest
+from werkzeug.exceptions import RequestEntityTooLarge
+
+import app
+
+def test_spool_file_hashes_and_limits_while_writing(upload_dir):
+    spool = app.SpoolFile("../../notes.TXT", max_bytes=10)
+    assert os.path.dirname(spool.path) == str(upload_dir) and spool.path.endswith(".txt")
+    spool.write(b"hello ")
+    spool.write(b"rust")
+    assert (spool.size, spool.sha256) == (10, hashlib.sha256(b"hello rust").hexdigest())
+    with pytest.raises(RequestEntityTooLarge):
+        spool.write(b"!")
+    spool.discard()
+    assert os.listdir(upload_dir) == []
+
+def test_open_text_leaves_the_upload_open(upload_dir):
+    spool = app.SpoolFile("data.json")
+    spool.write('{"clé": 1}'.encode())
+    with app.open_text(spool) as text:
+        assert text.read() == '{"clé": 1}'
+    assert not spool.closed
+    assert app.analyze_json(spool) == "📂 JSON analyzed: Main keys: clé"
+    spool.discard()
+
+def test_uploads_are_spooled_once_and_deleted_after_the_request(client, upload_dir):
+    data = b'{"base": 1, "raid": 2}'
+    response = client.post("/upload_file", data={"file": (io.BytesIO(data), "plan.json"), "action": "process",
+                                                 "async": "0"}, content_type="multipart/form-data")
+    assert response.json["response"] == "📂 JSON analyzed: Main keys: base, raid"
+    assert os.listdir(upload_dir) == []
@@ -0,0 +1,25 @@
+import app
+
+def broken_params(conn):
+    raise RuntimeError("bug in a params function")
+
+def test_bad_ops_do_not_stop_the_writer(write_behind_db):
+    db = write_behind_db
+    db.writer.submit("u", [("INSERT INTO user_messages (user_id, session_id, type, content) VALUES (?, ?, ?, ?)",
+                            broken_params, True)])
+    db.writer.submit("u", [("not a tuple",)])
+    db.save_message("u", "s", "question", "still saved")
+    assert db.writer.wait_for_user("u", timeout=5)
+    assert db.get_user_history("u") == [("question", "still saved")]
+    stats = db.writer.stats()
+    assert stats["failed"] == 2 and stats["queued"] == 0
+    assert db.writer._thread.is_alive()
+
+def test_batches_keep_order_and_count(write_behind_db):
+    db = write_behind_db
+    for number in range(50):
+        db.save_message("u", "s", "question", f"message {number}")
+    assert db.writer.flush(timeout=5)
+    assert [content for _, content in db.get_user_history("u", limit=100)] == [f"message {n}" for n in range(50)]
+    stats = db.writer.stats()
+    assert stats["committed"] == 50 and stats["batches"] >= 1
@@ -0,0 +1,16 @@
+"""WSGI entry point for production servers, e.g.:
+
+    gunicorn --workers 4 --threads 8 --bind 0.0.0.0:8000 wsgi:application
+
+Every worker process builds its own app. Don't use --preload: SQLite connections and
+threads don't survive a fork. Summaries run in one worker at a time (see app.Scheduler),
+or in a separate `python app.py --scheduler` process if the workers get RUN_SCHEDULER=0.
+Each worker caches prompt contexts, checked against the context_versions table before use
+so that writes of the other workers are seen (CONTEXT_CACHE_VALIDATE=1, the default).
+
+openai, PyMuPDF and Google NLP are imported on first use. Set APP_WARMUP=blocking to load
+them before a worker serves traffic; `python app.py --startup-report` prints the cold start cost.
+"""
+from app import create_app
+
+application = create_app()